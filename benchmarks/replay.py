@@ -0,0 +1,300 @@
+"""Replay a recorded session against a local stand-in for Nanome.
+
+Record a session by adding 'record_session': 'session.trace.gz' to the
+plugin's custom data, then replay it offline with
+    python -m benchmarks.replay session.trace.gz
+
+Reports the latency from a recorded pose change to the next stream update,
+the number of rescores and DSX runs, and the bytes written to streams.
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+from datetime import timedelta
+import nanome
+import numpy as np
+from nanome._internal.enums import Messages
+from nanome._internal.network import PluginNetwork
+from nanome.api.serializers import CommandMessageSerializer
+from nanome.api.streams.callbacks import receive_create_stream_result
+from nanome.util import Process, enums
+from nanome.util.stream import StreamCreationError
+
+from dsx import scoring_algo
+from plugin.RealtimeScoring import RealtimeScoring
+from plugin.recorder import build_complex, load_trace
+
+PERCENTILES = [50, 90, 99]
+TICK_SECS = 0.05
+# Time to wait for pose changes at the end of the trace to be rendered.
+DRAIN_SECS = 60
+STREAM_DATA_TYPES = {
+    enums.StreamType.color: enums.StreamDataType.byte,
+    enums.StreamType.label: enums.StreamDataType.string,
+    enums.StreamType.shape_color: enums.StreamDataType.byte,
+}
+
+
+class ReplayNetwork:
+    """Stand-in for the plugin's connection to Nanome, serving a recorded trace.
+
+    Requests for complexes are answered with the recorded workspace state at
+    the current replay time. Stream updates are timed, and measured in the
+    bytes they serialize to.
+    """
+
+    def __init__(self, trace):
+        self._plugin = None
+        self.trace = trace
+        self.serializer = CommandMessageSerializer()
+        self.message_counts = Counter()
+        # (replay time, serialized bytes) of every stream update
+        self.stream_updates = []
+        # Replay time each recorded pose change was first sent to the plugin
+        self.served_times = {}
+        self.complex_events = [event for event in trace['events'] if event['type'] == 'complexes']
+        self.pose_change_times = find_pose_changes(self.complex_events)
+        self._command_id = 0
+        self._stream_id = 0
+        self._shape_index = 0
+        self._templates = {}
+        self.restart_clock()
+
+    def restart_clock(self):
+        self.start_time = time.perf_counter()
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def send_connect(self, code, arg):
+        return 0
+
+    def send(self, code, arg, expects_response):
+        command_id = self._command_id
+        self._command_id += 1
+        self.message_counts[code.name] += 1
+        handlers = {
+            Messages.complexes_request: self.on_complexes_request,
+            Messages.complex_list_request: self.on_complex_list_request,
+            Messages.stream_create: self.on_stream_create,
+            Messages.stream_feed: self.on_stream_feed,
+            Messages.set_shape: self.on_set_shape,
+            Messages.delete_shape: self.on_delete_shape,
+        }
+        handler = handlers.get(code)
+        if handler:
+            handler(command_id, code, arg)
+        return command_id
+
+    def _call(self, request_id, *args):
+        self._plugin._call(request_id, *args)
+
+    def respond(self, command_id, *args):
+        # Futures are only registered once send returns.
+        asyncio.get_event_loop().call_soon(self._call, command_id, *args)
+
+    def workspace_state(self):
+        """Get the latest recorded entry of every complex at the current replay time."""
+        now = self.elapsed()
+        state = {}
+        for event in self.complex_events:
+            if state and event['time'] > now:
+                break
+            for entry in event['complexes']:
+                state[entry['index']] = entry
+        return state
+
+    def build_complexes(self, comp_indices):
+        state = self.workspace_state()
+        complexes = []
+        for index in comp_indices:
+            entry = state.get(index)
+            if entry is None:
+                complexes.append(None)
+                continue
+            key = entry['structure']
+            template = self._templates.get(key)
+            comp = build_complex(self.trace['structures'][key], entry, template)
+            if template is None:
+                self._templates[key] = build_complex(self.trace['structures'][key], entry)
+            complexes.append(comp)
+        return complexes
+
+    def residue_complex_indices(self, residue_indices):
+        """Get indices of the complexes in the workspace containing residue_indices."""
+        residue_indices = set(residue_indices)
+        structures = self.trace['structures']
+        return [
+            index for index, entry in self.workspace_state().items()
+            if residue_indices.intersection(structures[entry['structure']]['residue_indices'])
+        ]
+
+    def on_complexes_request(self, command_id, code, comp_indices):
+        now = self.elapsed()
+        for change_time in self.pose_change_times:
+            if change_time <= now:
+                self.served_times.setdefault(change_time, now)
+        self.respond(command_id, self.build_complexes(comp_indices))
+
+    def on_complex_list_request(self, command_id, code, arg):
+        self.respond(command_id, self.build_complexes(self.workspace_state()))
+
+    def on_stream_create(self, command_id, code, arg):
+        stream_type, _, direction = arg
+        self._stream_id += 1
+        data_type = STREAM_DATA_TYPES.get(stream_type, enums.StreamDataType.float)
+        result = (StreamCreationError.NoError, self._stream_id, data_type, direction)
+        asyncio.get_event_loop().call_soon(receive_create_stream_result, self, result, command_id)
+
+    def on_stream_feed(self, command_id, code, arg):
+        message = self.serializer.serialize_message(command_id, code, arg, None, False)
+        self.stream_updates.append((self.elapsed(), len(message)))
+
+    def on_set_shape(self, command_id, code, shapes):
+        indices = []
+        for shape in shapes:
+            if shape.index == -1:
+                self._shape_index += 1
+                indices.append(self._shape_index)
+            else:
+                indices.append(shape.index)
+        self.respond(command_id, indices, [True] * len(shapes))
+
+    def on_delete_shape(self, command_id, code, indices):
+        self.respond(command_id, indices)
+
+    def latencies(self):
+        """Get latencies from pose changes to the first stream update after they were served."""
+        update_times = np.array([update_time for update_time, _ in self.stream_updates])
+        latencies = []
+        for change_time in self.pose_change_times:
+            served_time = self.served_times.get(change_time)
+            if served_time is None:
+                continue
+            later_updates = update_times[update_times >= served_time]
+            if len(later_updates):
+                latencies.append(later_updates.min() - change_time)
+        return latencies
+
+
+def find_pose_changes(complex_events):
+    """Get times of recorded events in which a complex moved or changed."""
+    last_entries = {}
+    change_times = []
+    for event in complex_events:
+        changed = False
+        for entry in event['complexes']:
+            pose = (entry['structure'], entry['position'], entry['rotation'])
+            last_pose = last_entries.get(entry['index'])
+            if last_pose is not None and last_pose != pose:
+                changed = True
+            last_entries[entry['index']] = pose
+        if changed:
+            change_times.append(event['time'])
+    return change_times
+
+
+def create_plugin(network, custom_data=None):
+    """Create a plugin instance connected to network."""
+    plugin = RealtimeScoring()
+    network._plugin = plugin
+    nanome.PluginInstance._instance = plugin
+    plugin._setup(0, network, None, None, None, None, [custom_data or {}], None)
+    # Run DSX in this process rather than through the process manager.
+    Process._manager = None
+    PluginNetwork._instance = network
+    plugin.start()
+    return plugin
+
+
+async def select(plugin, network, event):
+    """Start scoring the receptor and ligands of a recorded selection, like MainMenu.start_scoring."""
+    if getattr(plugin, 'color_stream', None):
+        plugin.stop_scoring()
+    receptor_index = event['receptor_index']
+    residue_indices = event['ligand_residue_indices']
+    ensemble_indices = event.get('ensemble_indices') or [receptor_index]
+    ligand_comp_indices = network.residue_complex_indices(residue_indices)
+    await plugin.fetch_complexes(ensemble_indices + ligand_comp_indices)
+    await plugin.setup_receptor_and_ligands(receptor_index, residue_indices, ensemble_indices)
+    await plugin.score_ligands()
+
+
+async def replay(trace, update_interval=None, custom_data=None):
+    """Replay trace in real time against a new plugin instance, and return a report."""
+    network = ReplayNetwork(trace)
+    plugin = create_plugin(network, custom_data)
+    if update_interval is not None:
+        plugin.update_interval = timedelta(seconds=update_interval)
+
+    counts = Counter()
+    score_ligands = plugin.score_ligands
+
+    async def counted_score_ligands():
+        counts['rescores'] += 1
+        await score_ligands()
+
+    def count_process(label, secs):
+        if label == 'DSX':
+            counts['dsx_runs'] += 1
+
+    plugin.score_ligands = counted_score_ligands
+    scoring_algo.add_process_hook(count_process)
+    try:
+        events = trace['events']
+        selections = [event for event in events if event['type'] == 'select']
+        end_time = max((event['time'] for event in events), default=0)
+        network.restart_clock()
+        while True:
+            while selections and selections[0]['time'] <= network.elapsed():
+                await select(plugin, network, selections.pop(0))
+            unresolved = len(network.latencies()) < len(network.pose_change_times)
+            elapsed = network.elapsed()
+            if elapsed > end_time and (not unresolved or elapsed > end_time + DRAIN_SECS):
+                break
+            plugin.update()
+            await asyncio.sleep(TICK_SECS)
+        while plugin.is_updating:
+            await asyncio.sleep(TICK_SECS)
+    finally:
+        scoring_algo.remove_process_hook(count_process)
+
+    latencies = network.latencies()
+    return {
+        'duration': network.elapsed(),
+        'pose_changes': len(network.pose_change_times),
+        'missed_pose_changes': len(network.pose_change_times) - len(latencies),
+        'latency_percentiles': {
+            percentile: float(np.percentile(latencies, percentile))
+            for percentile in PERCENTILES
+        } if latencies else {},
+        'rescores': counts['rescores'],
+        'dsx_runs': counts['dsx_runs'],
+        'stream_updates': len(network.stream_updates),
+        'stream_bytes': sum(size for _, size in network.stream_updates),
+    }
+
+
+def print_report(report):
+    print(f"Replayed {report['duration']:.1f}s")
+    print(f"Pose changes: {report['pose_changes']} ({report['missed_pose_changes']} not rendered)")
+    for percentile, latency in report['latency_percentiles'].items():
+        print(f"  p{percentile} latency: {latency * 1000:.0f} ms")
+    print(f"Rescores: {report['rescores']}, DSX runs: {report['dsx_runs']}")
+    print(f"Stream updates: {report['stream_updates']}, {report['stream_bytes']} bytes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace', help='Trace file recorded with the record_session custom data option')
+    parser.add_argument('--update-interval', type=float, help='Seconds between checks for moved complexes')
+    parser.add_argument('--incremental', action='store_true', help='Use incremental rescoring')
+    args = parser.parse_args()
+    custom_data = {'incremental_scoring': True} if args.incremental else {}
+    report = asyncio.run(replay(load_trace(args.trace), args.update_interval, custom_data))
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
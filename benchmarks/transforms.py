@@ -0,0 +1,54 @@
+"""Compare complex to workspace coordinate transforms for growing receptor sizes.
+
+Usage: python -m benchmarks.transforms
+"""
+import os
+import timeit
+from nanome.api import structure
+from nanome.util import Quaternion, Vector3
+
+from plugin.RealtimeScoring import RealtimeScoring
+
+ASSETS_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'assets')
+RECEPTOR_PDB = os.path.join(ASSETS_DIR, '5ceo_protein.pdb')
+COPY_COUNTS = [1, 4, 16]
+REPEATS = 5
+
+
+def per_atom_transform(comp_list):
+    """Transform used before atoms were transformed as numpy arrays."""
+    for comp in comp_list:
+        mat = comp.get_complex_to_workspace_matrix()
+        for atom in comp.atoms:
+            atom._old_position = atom.position
+            atom.position = mat * atom.position
+
+
+def build_receptor(copy_count):
+    """Stack copies of the test receptor into one complex."""
+    receptor = structure.Complex.io.from_pdb(path=RECEPTOR_PDB)
+    molecule = next(receptor.molecules)
+    for _ in range(copy_count - 1):
+        copy = structure.Complex.io.from_pdb(path=RECEPTOR_PDB)
+        for chain in list(next(copy.molecules).chains):
+            molecule.add_chain(chain)
+    receptor.position = Vector3(1.5, -2.0, 3.25)
+    receptor.rotation = Quaternion(0.2, 0.4, 0.1, 0.888)
+    return receptor
+
+
+def main():
+    print('{:>8} {:>14} {:>14} {:>8}'.format('atoms', 'per atom (ms)', 'numpy (ms)', 'speedup'))
+    for copy_count in COPY_COUNTS:
+        receptor = build_receptor(copy_count)
+        atom_count = sum(1 for _ in receptor.atoms)
+        per_atom = min(timeit.repeat(
+            lambda: per_atom_transform([receptor]), number=1, repeat=REPEATS))
+        vectorized = min(timeit.repeat(
+            lambda: RealtimeScoring.set_atoms_to_workspace_positions([receptor]), number=1, repeat=REPEATS))
+        print('{:>8} {:>14.2f} {:>14.2f} {:>7.1f}x'.format(
+            atom_count, per_atom * 1000, vectorized * 1000, per_atom / vectorized))
+
+
+if __name__ == '__main__':
+    main()
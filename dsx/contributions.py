@@ -0,0 +1,106 @@
+import re
+import numpy as np
+
+__all__ = ['PairContributionStore', 'PAIR_DTYPE']
+
+
+# One row per receptor atom x ligand atom contribution printed by `dsx -pp`.
+PAIR_DTYPE = np.dtype([
+    ('receptor_residue', np.int32),
+    ('receptor_atom', np.int32),
+    ('ligand_atom', np.int32),
+    ('receptor_type', np.uint16),
+    ('ligand_type', np.uint16),
+    ('score', np.float32),
+])
+
+# e.g C.3p_131_136__C.ar6x_1_1__0.0908237
+PAIR_LINE_PATTERN = re.compile(
+    r'^(\S+?)_(-?\d+)_(\d+)__(\S+?)_(-?\d+)_(\d+)__(\S+)$', re.MULTILINE)
+# Receptor-ligand pairs are listed in these sections, until the next '#' line.
+RECEPTOR_LIGAND_SECTION = '# Receptor-Ligand:'
+SECTION_END_PATTERN = re.compile(r'^#', re.MULTILINE)
+
+
+class PairContributionStore:
+    """Compact store of the pair contributions from a single scoring pass.
+
+    The underlying buffer is reused between passes, and only grows when a
+    pass has more contributions than any pass before it.
+    """
+
+    def __init__(self, capacity=1024):
+        self._buffer = np.zeros(capacity, dtype=PAIR_DTYPE)
+        self.size = 0
+        # DSX atom types are stored as codes into this list.
+        self.atom_types = []
+        self._type_codes = {}
+
+    @property
+    def pairs(self):
+        """Structured array view of the contributions of the current pass."""
+        return self._buffer[:self.size]
+
+    def clear(self):
+        self.size = 0
+
+    def type_code(self, atom_type):
+        code = self._type_codes.get(atom_type)
+        if code is None:
+            code = len(self.atom_types)
+            self._type_codes[atom_type] = code
+            self.atom_types.append(atom_type)
+        return code
+
+    def load_dsx_output(self, dsx_output):
+        """Replace stored contributions with the pairs printed in dsx_output."""
+        self.clear()
+        rows = []
+        for section in receptor_ligand_sections(dsx_output or ''):
+            rows += PAIR_LINE_PATTERN.findall(section)
+        if not rows:
+            return self.pairs
+        columns = list(zip(*rows))
+        count = len(rows)
+        if count > len(self._buffer):
+            self._buffer = np.zeros(max(count, 2 * len(self._buffer)), dtype=PAIR_DTYPE)
+        pairs = self._buffer[:count]
+        pairs['receptor_type'] = [self.type_code(atom_type) for atom_type in columns[0]]
+        pairs['receptor_residue'] = np.array(columns[1], dtype=np.int32)
+        pairs['receptor_atom'] = np.array(columns[2], dtype=np.int32)
+        pairs['ligand_type'] = [self.type_code(atom_type) for atom_type in columns[3]]
+        pairs['ligand_atom'] = np.array(columns[5], dtype=np.int32)
+        pairs['score'] = np.array(columns[6], dtype=np.float32)
+        self.size = count
+        return self.pairs
+
+    def residue_scores(self):
+        """Sum contributions per receptor residue.
+
+        Returns a tuple of (residue numbers, summed scores) arrays.
+        """
+        return self._group_by('receptor_residue', mean=False)
+
+    def ligand_atom_scores(self):
+        """Average contributions per ligand atom.
+
+        Returns a tuple of (ligand atom numbers, mean scores) arrays.
+        """
+        return self._group_by('ligand_atom', mean=True)
+
+    def _group_by(self, field, mean=False):
+        pairs = self.pairs
+        keys, inverse = np.unique(pairs[field], return_inverse=True)
+        totals = np.bincount(inverse, weights=pairs['score'], minlength=len(keys))
+        if mean:
+            totals /= np.bincount(inverse, minlength=len(keys))
+        return keys, totals.astype(np.float32)
+
+
+def receptor_ligand_sections(dsx_output):
+    """Get the Receptor-Ligand pair sections of the output of `dsx -pp`."""
+    sections = []
+    for section in dsx_output.split(RECEPTOR_LIGAND_SECTION)[1:]:
+        end = SECTION_END_PATTERN.search(section)
+        sections.append(section[:end.start()] if end else section)
+    return sections
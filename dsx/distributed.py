@@ -0,0 +1,437 @@
+"""Score ligands on worker processes, over TCP.
+
+Start workers, on this machine or others, with
+    python -m dsx.distributed --port 9030
+
+Then score with a Dispatcher, in place of scoring_algo.score_ligands or
+scoring_algo.score_ensemble:
+    dispatcher = Dispatcher(['localhost:9030', 'localhost:9031'])
+    ligand_scores = await dispatcher.score_ligands(receptor, ligand_comps)
+
+Each ligand is a separate job. Workers keep the receptors they have prepared,
+so jobs for a receptor go to workers that already have it. A job that fails
+is retried on another worker, and callers wait while every worker is busy.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import shutil
+import struct
+import tempfile
+import time
+from collections import OrderedDict
+from nanome.api import structure
+from nanome.util import Logs
+
+from dsx import scoring_algo
+
+__all__ = ['Dispatcher', 'ScoringWorker', 'WorkerError']
+
+
+DEFAULT_PORT = 9030
+# Number of prepared receptors kept by each worker, least recently used first.
+RECEPTOR_CACHE_SIZE = 8
+# Number of jobs sent to a worker before its results come back. Workers score
+# one job at a time, the next one waits in the socket so the worker isn't idle.
+MAX_JOBS_PER_WORKER = 2
+# Number of workers a job is tried on before giving up.
+MAX_ATTEMPTS = 3
+# Seconds before a job is considered lost and its worker failed.
+JOB_TIMEOUT = 120
+# Seconds before a failed worker is connected to again.
+RECONNECT_SECS = 5
+# Messages are JSON, prefixed by their length as a 4 byte big endian integer.
+HEADER = struct.Struct('>I')
+
+
+class WorkerError(Exception):
+    """A worker couldn't score a job."""
+
+
+async def read_message(reader):
+    header = await reader.readexactly(HEADER.size)
+    (size,) = HEADER.unpack(header)
+    return json.loads(await reader.readexactly(size))
+
+
+async def write_message(writer, message):
+    data = json.dumps(message).encode()
+    writer.write(HEADER.pack(len(data)) + data)
+    await writer.drain()
+
+
+def parse_address(address):
+    """Get (host, port) from a 'host:port' string."""
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+class ScoringWorker:
+    """Score jobs sent by Dispatchers with scoring_algo.score_ligands.
+
+    Atoms and residues are identified by their position in the files sent,
+    Dispatchers map them back to indices.
+    """
+
+    def __init__(self, receptor_cache_size=RECEPTOR_CACHE_SIZE):
+        self.receptor_cache_size = receptor_cache_size
+        # Receptor key to (complex, PDB path), least recently used first.
+        self.receptors = OrderedDict()
+        self.receptor_loads = 0
+        self.jobs_scored = 0
+        self.server = None
+        self._dir = tempfile.mkdtemp(prefix='realtime-scoring-worker-')
+        self._lock = None
+        self._writers = set()
+        self._connection_tasks = set()
+        self._receptor_ids = itertools.count()
+
+    async def serve(self, host='localhost', port=DEFAULT_PORT):
+        """Start listening for Dispatchers, and return the bound (host, port)."""
+        self._lock = asyncio.Lock()
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        """Stop listening, and close connections once their handlers have stopped."""
+        if self.server:
+            self.server.close()
+            for writer in list(self._writers):
+                writer.close()
+            for task in self._connection_tasks:
+                task.cancel()
+            await asyncio.gather(*self._connection_tasks, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connection_tasks.add(task)
+        self._writers.add(writer)
+        try:
+            await write_message(writer, {'type': 'hello', 'receptor_cache_size': self.receptor_cache_size})
+            # Jobs of a connection are answered in order.
+            while True:
+                message = await read_message(reader)
+                await write_message(writer, await self.handle_job(message))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            self._connection_tasks.discard(task)
+            writer.close()
+
+    async def handle_job(self, message):
+        job_id = message['job_id']
+        try:
+            # PAIR_STORE is shared, so only one job is scored at a time.
+            async with self._lock:
+                receptor = self.load_receptor(message['receptor_key'], message.get('receptor_pdb'))
+                if receptor is None:
+                    return {'type': 'missing_receptor', 'job_id': job_id}
+                receptor_comp, receptor_pdb = receptor
+                ligand_comp = self.load_ligand(message['ligand_sdf'])
+                ligand_scores = await scoring_algo.score_ligands(
+                    receptor_comp, [ligand_comp], receptor_pdb=receptor_pdb,
+                    aggregate_only=message.get('aggregate_only', False))
+        except Exception as e:
+            Logs.error(f"Scoring job {job_id} failed: {e}")
+            return {'type': 'error', 'job_id': job_id, 'message': str(e)}
+        self.jobs_scored += 1
+        return {'type': 'result', 'job_id': job_id, 'ligand_scores': ligand_scores[0]}
+
+    def load_receptor(self, receptor_key, receptor_pdb_text=None):
+        """Get the prepared (complex, PDB path) of a receptor, None if it isn't known and wasn't sent."""
+        if receptor_key in self.receptors:
+            self.receptors.move_to_end(receptor_key)
+            return self.receptors[receptor_key]
+        if receptor_pdb_text is None:
+            return None
+        # DSX reads the exact file the dispatcher wrote.
+        receptor_pdb = os.path.join(self._dir, f'{next(self._receptor_ids)}.pdb')
+        with open(receptor_pdb, 'w') as f:
+            f.write(receptor_pdb_text)
+        receptor_comp = structure.Complex.io.from_pdb(path=receptor_pdb)
+        for i, residue in enumerate(scoring_algo.get_current_molecule(receptor_comp).residues):
+            residue.index = i
+        self.receptors[receptor_key] = (receptor_comp, receptor_pdb)
+        self.receptor_loads += 1
+        while len(self.receptors) > self.receptor_cache_size:
+            _, (_, evicted_pdb) = self.receptors.popitem(last=False)
+            os.remove(evicted_pdb)
+        return self.receptors[receptor_key]
+
+    @staticmethod
+    def load_ligand(ligand_sdf_text):
+        ligand_comp = structure.Complex.io.from_sdf(string=ligand_sdf_text)
+        for i, atom in enumerate(scoring_algo.get_current_molecule(ligand_comp).atoms):
+            atom.index = i
+        return ligand_comp
+
+
+class WorkerConnection:
+    """Connection to a ScoringWorker, and what the dispatcher knows of it."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        # Number of jobs sent and not answered yet.
+        self.jobs = 0
+        # Keys of the receptors the worker has, least recently used first.
+        self.receptor_keys = OrderedDict()
+        self.receptor_cache_size = RECEPTOR_CACHE_SIZE
+        self.failed_at = None
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._connect_lock = None
+        self._pending = {}
+        self._job_ids = itertools.count()
+
+    def __repr__(self):
+        return f'{self.host}:{self.port}'
+
+    def usable(self, now):
+        return self.failed_at is None or now - self.failed_at >= RECONNECT_SECS
+
+    async def connect(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer:
+                return
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            hello = await read_message(reader)
+            self.receptor_cache_size = hello['receptor_cache_size']
+            self.receptor_keys.clear()
+            self.failed_at = None
+            self._reader, self._writer = reader, writer
+            self._reader_task = asyncio.ensure_future(self._read_replies(reader))
+
+    async def score(self, receptor_key, receptor_pdb_text, ligand_sdf_text, timeout=JOB_TIMEOUT, aggregate_only=False):
+        """Score a ligand on the worker, sending the receptor if the worker doesn't have it."""
+        await self.connect()
+        message = {
+            'type': 'score', 'receptor_key': receptor_key, 'ligand_sdf': ligand_sdf_text,
+            'aggregate_only': aggregate_only,
+        }
+        if receptor_key not in self.receptor_keys:
+            message['receptor_pdb'] = receptor_pdb_text
+        self.remember_receptor(receptor_key)
+        reply = await self.request(message, timeout)
+        if reply['type'] == 'missing_receptor':
+            # The worker dropped the receptor to make room for others.
+            message['receptor_pdb'] = receptor_pdb_text
+            self.remember_receptor(receptor_key)
+            reply = await self.request(message, timeout)
+        if reply['type'] == 'error':
+            raise WorkerError(reply['message'])
+        return reply['ligand_scores']
+
+    def remember_receptor(self, receptor_key):
+        self.receptor_keys[receptor_key] = True
+        self.receptor_keys.move_to_end(receptor_key)
+        while len(self.receptor_keys) > self.receptor_cache_size:
+            self.receptor_keys.popitem(last=False)
+
+    async def request(self, message, timeout):
+        if not self._writer:
+            raise ConnectionError(f"Lost connection to worker {self}")
+        job_id = next(self._job_ids)
+        future = asyncio.get_event_loop().create_future()
+        self._pending[job_id] = future
+        try:
+            await write_message(self._writer, dict(message, job_id=job_id))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(job_id, None)
+
+    def close(self, error=None):
+        """Close the connection, and fail the jobs waiting on it with error."""
+        if self._reader_task:
+            self._reader_task.cancel()
+        if self._writer:
+            self._writer.close()
+        self._reader = self._writer = None
+        error = error or ConnectionError(f"Closed connection to worker {self}")
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+
+    async def wait_closed(self):
+        """Wait for the replies of a closed connection to stop being read."""
+        task, self._reader_task = self._reader_task, None
+        if task:
+            await asyncio.gather(task, return_exceptions=True)
+
+    def fail(self, error):
+        """Close the connection, and fail the jobs waiting on it.
+
+        The worker isn't connected to again before RECONNECT_SECS.
+        """
+        self.failed_at = time.monotonic()
+        self.receptor_keys.clear()
+        self.close(error)
+
+    async def _read_replies(self, reader):
+        try:
+            while True:
+                reply = await read_message(reader)
+                future = self._pending.get(reply['job_id'])
+                if future and not future.done():
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            if reader is self._reader:
+                self.fail(ConnectionError(f"Lost connection to worker {self}: {e}"))
+
+
+class Dispatcher:
+    """Hand ligand scoring jobs to ScoringWorkers.
+
+    Jobs go to workers that already have their receptor when they have room,
+    then to the least busy ones. Workers take at most max_jobs at a time, and
+    jobs wait for room otherwise. A job that fails or times out is retried on
+    other workers, up to max_attempts workers in total. Failed workers are
+    connected to again after RECONNECT_SECS.
+    """
+
+    def __init__(self, addresses, max_jobs=MAX_JOBS_PER_WORKER, max_attempts=MAX_ATTEMPTS, job_timeout=JOB_TIMEOUT):
+        self.workers = [WorkerConnection(*parse_address(address)) for address in addresses]
+        self.max_jobs = max_jobs
+        self.max_attempts = max_attempts
+        self.job_timeout = job_timeout
+        self._available = None
+        # PDB of the last receptors scored by key, least recently used first.
+        self._receptor_pdbs = OrderedDict()
+
+    async def score_ligands(
+            self, receptor: structure.Complex, ligand_comps: 'list[structure.Complex]', aggregate_only=False):
+        """Score ligands like scoring_algo.score_ligands, spread over the workers.
+
+        Workers keep no previous scores, so there is no incremental scoring,
+        every ligand is scored in full.
+        """
+        if self._available is None:
+            self._available = asyncio.Condition()
+        receptor_key, receptor_pdb_text = self.prepare_receptor(receptor)
+        receptor_residues = list(scoring_algo.get_current_molecule(receptor).residues)
+
+        async def score_ligand(ligand_comp, ligand_sdf_text):
+            ligand_scores = await self.run_job(receptor_key, receptor_pdb_text, ligand_sdf_text, aggregate_only)
+            ligand_atoms = list(scoring_algo.get_current_molecule(ligand_comp).atoms)
+            return {
+                'complex_index': ligand_comp.index,
+                'aggregate_scores': ligand_scores['aggregate_scores'],
+                'atom_scores': [(ligand_atoms[i].index, score) for i, score in ligand_scores['atom_scores']],
+                'residue_scores': [
+                    (receptor_residues[i].index, score) for i, score in ligand_scores['residue_scores']],
+            }
+
+        with tempfile.TemporaryDirectory() as dir:
+            ligand_sdfs = []
+            for i, ligand_comp in enumerate(ligand_comps):
+                ligand_sdf = os.path.join(dir, f'{i}.sdf')
+                ligand_comp.io.to_sdf(ligand_sdf, scoring_algo.SDF_OPTIONS)
+                with open(ligand_sdf) as f:
+                    ligand_sdfs.append(f.read())
+        return await asyncio.gather(*[
+            score_ligand(ligand_comp, ligand_sdf_text)
+            for ligand_comp, ligand_sdf_text in zip(ligand_comps, ligand_sdfs)])
+
+    async def score_ensemble(self, receptors: 'list[structure.Complex]', ligand_comps: 'list[structure.Complex]'):
+        """Score ligands against every receptor like scoring_algo.score_ensemble, spread over the workers."""
+        ligand_scores = await asyncio.gather(*[
+            self.score_ligands(receptor, ligand_comps) for receptor in receptors])
+        return [
+            {'receptor_index': receptor.index, 'ligand_scores': receptor_scores}
+            for receptor, receptor_scores in zip(receptors, ligand_scores)
+        ]
+
+    def prepare_receptor(self, receptor):
+        """Get the key and PDB of receptor, only writing it if the receptor changed."""
+        receptor_key = '_'.join(map(str, scoring_algo.receptor_fingerprint(receptor)))
+        if receptor_key not in self._receptor_pdbs:
+            with tempfile.TemporaryDirectory() as dir:
+                receptor_pdb = os.path.join(dir, 'receptor.pdb')
+                receptor.io.to_pdb(receptor_pdb, scoring_algo.PDB_OPTIONS)
+                with open(receptor_pdb) as f:
+                    self._receptor_pdbs[receptor_key] = f.read()
+            while len(self._receptor_pdbs) > RECEPTOR_CACHE_SIZE:
+                self._receptor_pdbs.popitem(last=False)
+        self._receptor_pdbs.move_to_end(receptor_key)
+        return receptor_key, self._receptor_pdbs[receptor_key]
+
+    async def run_job(self, receptor_key, receptor_pdb_text, ligand_sdf_text, aggregate_only=False):
+        tried = set()
+        error = None
+        for _ in range(self.max_attempts):
+            worker = await self.acquire_worker(receptor_key, tried)
+            tried.add(worker)
+            try:
+                return await worker.score(
+                    receptor_key, receptor_pdb_text, ligand_sdf_text, self.job_timeout, aggregate_only)
+            except asyncio.TimeoutError:
+                error = WorkerError(f"Worker {worker} timed out")
+                worker.fail(error)
+            except WorkerError as e:
+                error = e
+            except (OSError, EOFError) as e:
+                error = e
+                worker.fail(e)
+            finally:
+                await self.release_worker(worker)
+            Logs.warning(f"Scoring job failed on worker {worker}: {error}")
+        raise WorkerError(f"Scoring job failed on {len(tried)} workers") from error
+
+    async def acquire_worker(self, receptor_key, tried=()):
+        """Wait for a worker with room for a job, preferring workers not tried yet that have the receptor."""
+        async with self._available:
+            while True:
+                now = time.monotonic()
+                workers = [worker for worker in self.workers if worker.usable(now)]
+                if not workers:
+                    raise WorkerError("No scoring workers available")
+                idle = [worker for worker in workers if worker.jobs < self.max_jobs]
+                if idle:
+                    worker = min(idle, key=lambda worker: (
+                        worker in tried, receptor_key not in worker.receptor_keys, worker.jobs))
+                    worker.jobs += 1
+                    return worker
+                await self._available.wait()
+
+    async def release_worker(self, worker):
+        async with self._available:
+            worker.jobs -= 1
+            self._available.notify_all()
+
+    async def close(self):
+        """Close the worker connections, failing the jobs waiting on them."""
+        for worker in self.workers:
+            worker.close()
+        await asyncio.gather(*[worker.wait_closed() for worker in self.workers])
+
+
+async def serve(host, port, receptor_cache_size):
+    worker = ScoringWorker(receptor_cache_size)
+    host, port = await worker.serve(host, port)
+    Logs.message(f"Scoring worker listening on {host}:{port}")
+    async with worker.server:
+        await worker.server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+    parser.add_argument(
+        '--receptor-cache-size', type=int, default=RECEPTOR_CACHE_SIZE, help='Number of prepared receptors kept')
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.receptor_cache_size))
+
+
+if __name__ == '__main__':
+    main()
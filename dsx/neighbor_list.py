@@ -0,0 +1,293 @@
+import numpy as np
+from dsx.potentials import NO_POTENTIAL
+
+__all__ = ['NeighborListScorer']
+
+
+# Type codes of atoms that can't be looked up in the potentials.
+UNTYPED = -2  # Not typed by the DSX pass the scorer was built from.
+IGNORED = -3  # Never scored by DSX (hydrogens, and receptor HETATMs other than metals).
+METALS = {'LI', 'NA', 'K', 'MG', 'CA', 'MN', 'FE', 'CO', 'NI', 'CU', 'ZN', 'CD', 'HG'}
+# Maximum number of ligand x receptor atom pairs scored at once by batch_score.
+BATCH_PAIRS = 1 << 22
+
+
+class NeighborListScorer:
+    """In-process DSX pair scoring of one ligand against a fixed receptor.
+
+    Keeps a Verlet neighbor list of receptor atoms within cutoff + skin of each
+    ligand atom. When the ligand moves, only the pair terms of atoms that moved
+    more than `tolerance` are recomputed, and the neighbor list is only rebuilt
+    once an atom has moved more than `skin` since the last build.
+
+    Atom types come from a DSX pass, which only lists pairs with a contribution.
+    Untyped pairs already within the cutoff in that pass are scored as 0, and
+    scoring fails (returns False) as soon as any other untyped pair comes
+    within the cutoff.
+    """
+
+    def __init__(
+            self, potentials, type_columns, receptor_positions, receptor_types,
+            receptor_residues, ligand_types, skin=1.0, tolerance=1e-3):
+        self.potentials = potentials
+        self.cutoff = potentials.cutoff
+        self.skin = skin
+        self.tolerance = tolerance
+        self.type_columns = type_columns
+        # Receptor atoms DSX never scores are dropped up front.
+        scored = receptor_types != IGNORED
+        self.receptor_positions = np.asarray(receptor_positions, dtype=np.float64)[scored]
+        self.receptor_types = receptor_types[scored]
+        self.receptor_residues = receptor_residues[scored]
+        self.ligand_types = ligand_types
+        self.build_count = 0
+        # Flat (ligand atom, receptor atom) indices of untyped pairs scored as 0
+        self._zero_pairs = np.zeros(0, dtype=np.intp)
+        self._reference_positions = None
+        self._last_positions = None
+
+    @classmethod
+    def from_dsx_files(cls, potentials, pair_store, receptor_pdb, ligand_mol2, **kwargs):
+        """Create a scorer from the files and pair contributions of a DSX pass, scored at the ligand's file pose."""
+        receptor_atoms = read_pdb_atoms(receptor_pdb)
+        ligand_atoms = read_mol2_atoms(ligand_mol2)
+        return cls.from_pair_store(potentials, pair_store, receptor_atoms, ligand_atoms, **kwargs)
+
+    @classmethod
+    def from_pair_store(cls, potentials, pair_store, receptor_atoms, ligand_atoms, **kwargs):
+        """Create a scorer typing atoms from the contributions in pair_store.
+
+        receptor_atoms is a tuple of (serials, positions, residue numbers, ignored flags),
+        and ligand_atoms a tuple of (ids, positions, ignored flags).
+        """
+        serials, receptor_positions, receptor_residues, receptor_ignored = receptor_atoms
+        ligand_ids, ligand_positions, ligand_ignored = ligand_atoms
+        pairs = pair_store.pairs
+        receptor_types = np.full(len(serials), UNTYPED, dtype=np.int32)
+        order = np.argsort(serials)
+        receptor_rows = order[np.searchsorted(serials, pairs['receptor_atom'], sorter=order)]
+        receptor_types[receptor_rows] = pairs['receptor_type']
+        receptor_types[receptor_ignored] = IGNORED
+        ligand_types = np.full(len(ligand_ids), UNTYPED, dtype=np.int32)
+        order = np.argsort(ligand_ids)
+        ligand_rows = order[np.searchsorted(ligand_ids, pairs['ligand_atom'], sorter=order)]
+        ligand_types[ligand_rows] = pairs['ligand_type']
+        ligand_types[ligand_ignored] = IGNORED
+        type_columns = potentials.type_columns(pair_store.atom_types)
+        scorer = cls(
+            potentials, type_columns, receptor_positions, receptor_types,
+            receptor_residues, ligand_types, **kwargs)
+        scorer.set_zero_pairs(ligand_positions)
+        scorer.score(ligand_positions)
+        return scorer
+
+    def set_zero_pairs(self, ligand_positions):
+        """Score untyped pairs within the cutoff of the pose DSX typed atoms in as 0."""
+        positions = np.asarray(ligand_positions, dtype=np.float64)
+        distances = np.linalg.norm(positions[:, None, :] - self.receptor_positions[None, :, :], axis=2)
+        columns = self._pair_columns(
+            np.arange(len(positions))[:, None],
+            np.arange(len(self.receptor_positions))[None, :])
+        self._zero_pairs = np.flatnonzero((distances < self.cutoff) & (columns == UNTYPED))
+
+    def score(self, ligand_positions):
+        """Update scores for a new ligand pose.
+
+        Returns False if the pose can't be scored without another DSX pass.
+        """
+        positions = np.asarray(ligand_positions, dtype=np.float64)
+        if self._reference_positions is None or self._max_displacement(positions) > self.skin:
+            self._build_neighbor_list(positions)
+            moved = np.arange(len(positions))
+        else:
+            displacement = np.linalg.norm(positions - self._last_positions, axis=1)
+            moved = np.nonzero(displacement > self.tolerance)[0]
+        if len(moved) and not self._update_atoms(positions, moved):
+            return False
+        self._last_positions[moved] = positions[moved]
+        return True
+
+    @property
+    def atom_scores(self):
+        """Mean contribution of each ligand atom's contacts, 0 for atoms without contacts."""
+        counts = self._atom_contacts
+        return np.divide(self._atom_totals, counts, out=np.zeros(len(counts)), where=counts > 0)
+
+    @property
+    def atom_contacts(self):
+        return self._atom_contacts
+
+    @property
+    def contact_count(self):
+        return int(self._atom_contacts.sum())
+
+    def residue_scores(self):
+        """Sum contributions per receptor residue, as (residue numbers, scores) arrays."""
+        residues = self.receptor_residues[self._neighbors[self._contacts]]
+        keys, inverse = np.unique(residues, return_inverse=True)
+        totals = np.bincount(inverse, weights=self._values[self._contacts], minlength=len(keys))
+        return keys, totals
+
+    def full_score(self, ligand_positions):
+        """Score a pose against every receptor atom, without the neighbor list.
+
+        Returns (total score, contact count), or None if the pose needs another DSX pass.
+        """
+        positions = np.asarray(ligand_positions, dtype=np.float64)
+        distances = np.linalg.norm(positions[:, None, :] - self.receptor_positions[None, :, :], axis=2)
+        ligand_rows = np.arange(len(positions))[:, None]
+        receptor_rows = np.arange(len(self.receptor_positions))[None, :]
+        columns = self._pair_columns(ligand_rows, receptor_rows)
+        pair_ids = ligand_rows * len(self.receptor_positions) + receptor_rows
+        values, contacts = self._pair_values(distances, columns, pair_ids)
+        if values is None:
+            return None
+        return values.sum(), int(contacts.sum())
+
+    def pocket_rows(self, ligand_positions, margin):
+        """Get rows of receptor atoms within the cutoff of a ligand pose, once its atoms move up to margin."""
+        positions = np.asarray(ligand_positions, dtype=np.float64)
+        distances = np.linalg.norm(positions[:, None, :] - self.receptor_positions[None, :, :], axis=2)
+        return np.flatnonzero((distances < self.cutoff + margin).any(axis=0))
+
+    def batch_score(self, poses, receptor_rows=None):
+        """Score many poses of the ligand at once, without the neighbor list.
+
+        poses is a (P, N, 3) array, scored against receptor_rows (every receptor
+        atom by default). Returns (total scores, scorable flags) arrays of length P,
+        where poses that would need another DSX pass aren't scorable.
+        """
+        poses = np.asarray(poses, dtype=np.float64)
+        if receptor_rows is None:
+            receptor_rows = np.arange(len(self.receptor_positions))
+        receptor_positions = self.receptor_positions[receptor_rows]
+        ligand_rows = np.arange(poses.shape[1])[:, None]
+        columns = self._pair_columns(ligand_rows, receptor_rows[None, :])
+        pair_ids = ligand_rows * len(self.receptor_positions) + receptor_rows[None, :]
+        unscorable = (columns == UNTYPED) & ~np.isin(pair_ids, self._zero_pairs)
+        scored = columns >= 0
+        totals = np.zeros(len(poses))
+        scorable = np.ones(len(poses), dtype=bool)
+        # Bound the size of the (poses, ligand atoms, receptor atoms) arrays.
+        chunk_size = max(1, BATCH_PAIRS // max(columns.size, 1))
+        for start in range(0, len(poses), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            distances = np.linalg.norm(
+                poses[chunk, :, None, :] - receptor_positions[None, None, :, :], axis=3)
+            in_range = distances < self.cutoff
+            scorable[chunk] = ~(in_range & unscorable).any(axis=(1, 2))
+            contacts = in_range & scored
+            values = np.zeros(distances.shape)
+            values[contacts] = self.potentials.lookup(
+                distances[contacts], np.broadcast_to(columns, distances.shape)[contacts])
+            totals[chunk] = values.sum(axis=(1, 2))
+        return totals, scorable
+
+    def _max_displacement(self, positions):
+        return np.linalg.norm(positions - self._reference_positions, axis=1).max(initial=0)
+
+    def _build_neighbor_list(self, positions):
+        distances = np.linalg.norm(positions[:, None, :] - self.receptor_positions[None, :, :], axis=2)
+        within = distances < self.cutoff + self.skin
+        within[self.ligand_types == IGNORED] = False
+        width = max(int(within.sum(axis=1).max(initial=0)), 1)
+        # Pad rows to the same width, padding entries are masked out.
+        self._neighbors = np.zeros((len(positions), width), dtype=np.intp)
+        self._mask = np.zeros((len(positions), width), dtype=bool)
+        for row, receptor_atoms in enumerate(within):
+            neighbors = np.nonzero(receptor_atoms)[0]
+            self._neighbors[row, :len(neighbors)] = neighbors
+            self._mask[row, :len(neighbors)] = True
+        self._columns = self._pair_columns(np.arange(len(positions))[:, None], self._neighbors)
+        self._values = np.zeros(self._neighbors.shape)
+        self._contacts = np.zeros(self._neighbors.shape, dtype=bool)
+        self._atom_totals = np.zeros(len(positions))
+        self._atom_contacts = np.zeros(len(positions), dtype=np.int64)
+        self.total = 0.0
+        self._reference_positions = positions.copy()
+        self._last_positions = positions.copy()
+        self.build_count += 1
+
+    def _pair_columns(self, ligand_rows, receptor_rows):
+        """Get potential columns of ligand x receptor atom pairs.
+
+        Pairs with an untyped atom get UNTYPED, and pairs with an ignored atom NO_POTENTIAL.
+        """
+        ligand_types = self.ligand_types[ligand_rows]
+        receptor_types = self.receptor_types[receptor_rows]
+        columns = self.type_columns[np.maximum(receptor_types, 0), np.maximum(ligand_types, 0)]
+        ignored = (ligand_types == IGNORED) | (receptor_types == IGNORED)
+        untyped = (ligand_types == UNTYPED) | (receptor_types == UNTYPED)
+        columns = np.where(ignored, NO_POTENTIAL, columns)
+        return np.where(untyped, UNTYPED, columns)
+
+    def _pair_values(self, distances, columns, pair_ids):
+        in_range = distances < self.cutoff
+        untyped = in_range & (columns == UNTYPED)
+        if np.any(untyped) and not np.isin(pair_ids[untyped], self._zero_pairs).all():
+            return None, None
+        contacts = in_range & (columns >= 0)
+        values = np.zeros(distances.shape)
+        values[contacts] = self.potentials.lookup(distances[contacts], columns[contacts])
+        return values, contacts
+
+    def _update_atoms(self, positions, rows):
+        neighbors = self._neighbors[rows]
+        distances = np.linalg.norm(self.receptor_positions[neighbors] - positions[rows, None, :], axis=2)
+        distances[~self._mask[rows]] = np.inf
+        pair_ids = rows[:, None] * len(self.receptor_positions) + neighbors
+        values, contacts = self._pair_values(distances, self._columns[rows], pair_ids)
+        if values is None:
+            return False
+        # Patch the cached totals with the difference of the recomputed atoms.
+        atom_totals = values.sum(axis=1)
+        atom_contacts = contacts.sum(axis=1)
+        self.total += atom_totals.sum() - self._atom_totals[rows].sum()
+        self._atom_totals[rows] = atom_totals
+        self._atom_contacts[rows] = atom_contacts
+        self._values[rows] = values
+        self._contacts[rows] = contacts
+        return True
+
+
+def read_pdb_atoms(pdb_path, ignore_hetatms=True):
+    """Get serials, positions, residue numbers and ignored flags of atoms in the first model of a PDB file.
+
+    Like DSX, HETATMs other than metals are ignored unless ignore_hetatms is False.
+    """
+    serials, positions, residues, ignored = [], [], [], []
+    with open(pdb_path) as f:
+        for line in f:
+            if line.startswith('ENDMDL'):
+                break
+            if not line.startswith(('ATOM', 'HETATM')):
+                continue
+            serials.append(int(line[6:11]))
+            positions.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+            residues.append(int(line[22:26]))
+            element = (line[76:78].strip() or line[12:14].strip()).upper()
+            ignored_hetatm = ignore_hetatms and line.startswith('HETATM') and element not in METALS
+            ignored.append(element == 'H' or ignored_hetatm)
+    return (
+        np.array(serials), np.array(positions).reshape(-1, 3),
+        np.array(residues), np.array(ignored, dtype=bool))
+
+
+def read_mol2_atoms(mol2_path):
+    """Get ids, positions and ignored flags of atoms in the first molecule of a mol2 file."""
+    ids, positions, ignored = [], [], []
+    in_atoms = False
+    with open(mol2_path) as f:
+        for line in f:
+            if line.startswith('@<TRIPOS>'):
+                if in_atoms:
+                    break
+                in_atoms = line.startswith('@<TRIPOS>ATOM')
+                continue
+            items = line.split()
+            if not in_atoms or len(items) < 6:
+                continue
+            ids.append(int(items[0]))
+            positions.append((float(items[2]), float(items[3]), float(items[4])))
+            ignored.append(items[5].split('.')[0] == 'H')
+    return np.array(ids), np.array(positions).reshape(-1, 3), np.array(ignored, dtype=bool)
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import numpy as np
+
+__all__ = ['PairPotentials', 'SharedPotentials', 'load_pair_potentials', 'load_shared_potentials']
+
+
+DIR = os.path.dirname(__file__)
+POTENTIALS_DIR = os.path.join(DIR, 'bin', 'pdb_pot_0511')
+# Header of DSX .bin tables: 4 int32 values, the last two being potential and bin counts.
+HEADER_DTYPE = np.dtype('<i4')
+HEADER_SIZE = 4
+BIN_WIDTH = 0.01  # Angstrom
+NO_POTENTIAL = -1
+
+# Tables and the keys file mapping atom types to their columns.
+TABLE_KEYS = {
+    'potentials_repulsive': 'potentials.keys',
+    'sas_potentials': 'sas_potentials.keys',
+    'pro_sas_potentials': 'pro_sas_potentials.keys',
+}
+
+# Layout of the shared cache file:
+# header (magic, format version, index length, sha256 of the source files),
+# a JSON index of table shapes, offsets and keys, then aligned float32 tables.
+CACHE_MAGIC = b'DSXPOTS\x00'
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct('<8sII32s')
+CACHE_ALIGNMENT = 64
+# Formatted with a digest of the potentials directory, so every set of potentials has its own file.
+CACHE_FILENAME = 'realtime-scoring-potentials-{}.bin'
+# Shared memory mount, so every process maps the same physical pages.
+SHM_DIR = '/dev/shm'
+
+
+class PairPotentials:
+    """Distance dependent DSX pair potentials.
+
+    values[bin, column] is the score of an atom pair whose distance falls in
+    the bin, and `columns` maps 'receptortype_ligandtype' keys to columns.
+    """
+
+    def __init__(self, values, columns, bin_width=BIN_WIDTH):
+        self.values = values
+        self.columns = columns
+        self.bin_width = bin_width
+
+    @property
+    def cutoff(self):
+        return (self.values.shape[0] - 1) * self.bin_width
+
+    def column(self, receptor_type, ligand_type):
+        return self.columns.get(f'{receptor_type}_{ligand_type}', NO_POTENTIAL)
+
+    def type_columns(self, atom_types):
+        """Get a (T, T) array of columns for every receptor x ligand pair of atom_types."""
+        count = len(atom_types)
+        type_columns = np.full((count, count), NO_POTENTIAL, dtype=np.int32)
+        for i, receptor_type in enumerate(atom_types):
+            for j, ligand_type in enumerate(atom_types):
+                type_columns[i, j] = self.column(receptor_type, ligand_type)
+        return type_columns
+
+    def lookup(self, distances, columns):
+        """Score pairs at distances using potential columns."""
+        bins = np.minimum((distances / self.bin_width).astype(np.intp), self.values.shape[0] - 1)
+        return self.values[bins, columns]
+
+
+class SharedPotentials:
+    """Read-only potential tables memory mapped from the shared cache file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, _, index_length, self.checksum = CACHE_HEADER.unpack_from(self._mmap)
+        index = json.loads(self._mmap[CACHE_HEADER.size:CACHE_HEADER.size + index_length])
+        self.tables = {}
+        self.columns = {}
+        for name, entry in index.items():
+            bin_count, potential_count = entry['shape']
+            values = np.frombuffer(
+                self._mmap, dtype='<f4', count=bin_count * potential_count, offset=entry['offset'])
+            self.tables[name] = values.reshape(bin_count, potential_count)
+            self.columns[name] = entry['columns']
+
+    def pair_potentials(self, name='potentials_repulsive'):
+        return PairPotentials(self.tables[name], self.columns[name])
+
+
+# Cache path to (source stamp, SharedPotentials) of the potentials mapped by this process.
+_shared_potentials = {}
+
+
+def load_pair_potentials(potentials_dir=POTENTIALS_DIR, name='potentials_repulsive'):
+    """Load DSX pair potentials, mapped from the shared cache file."""
+    return load_shared_potentials(potentials_dir).pair_potentials(name)
+
+
+def load_shared_potentials(potentials_dir=POTENTIALS_DIR, cache_dir=None):
+    """Map the potential tables of potentials_dir from the shared cache file.
+
+    The cache file is built once per host, and rebuilt automatically when its
+    format version or the checksum of the source files doesn't match. Source
+    files are only hashed again by a process when their sizes or modification
+    times change.
+    """
+    path = cache_path(potentials_dir, cache_dir)
+    stamp = source_stamp(potentials_dir)
+    cached = _shared_potentials.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    checksum = source_checksum(potentials_dir)
+    if not cache_is_valid(path, checksum):
+        build_cache(potentials_dir, path, checksum)
+    shared = SharedPotentials(path)
+    _shared_potentials[path] = (stamp, shared)
+    return shared
+
+
+def default_cache_dir():
+    return SHM_DIR if os.access(SHM_DIR, os.W_OK) else tempfile.gettempdir()
+
+
+def cache_path(potentials_dir=POTENTIALS_DIR, cache_dir=None):
+    """Get the path of the shared cache file of potentials_dir."""
+    dir_digest = hashlib.sha1(os.path.realpath(potentials_dir).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir or default_cache_dir(), CACHE_FILENAME.format(dir_digest))
+
+
+def source_files(potentials_dir):
+    for name, keys_name in sorted(TABLE_KEYS.items()):
+        yield f'{name}.bin'
+        yield keys_name
+
+
+def source_stamp(potentials_dir):
+    """Get the names, sizes and modification times of the table and keys files in potentials_dir."""
+    stamp = []
+    for filename in source_files(potentials_dir):
+        stat = os.stat(os.path.join(potentials_dir, filename))
+        stamp.append((filename, stat.st_size, stat.st_mtime_ns))
+    return tuple(stamp)
+
+
+def source_checksum(potentials_dir):
+    """sha256 digest of the table and keys files in potentials_dir."""
+    digest = hashlib.sha256()
+    for filename in source_files(potentials_dir):
+        digest.update(filename.encode())
+        with open(os.path.join(potentials_dir, filename), 'rb') as f:
+            digest.update(f.read())
+    return digest.digest()
+
+
+def cache_is_valid(cache_path, checksum):
+    try:
+        with open(cache_path, 'rb') as f:
+            header = f.read(CACHE_HEADER.size)
+    except OSError:
+        return False
+    if len(header) != CACHE_HEADER.size:
+        return False
+    magic, version, _, cached_checksum = CACHE_HEADER.unpack(header)
+    return magic == CACHE_MAGIC and version == CACHE_VERSION and cached_checksum == checksum
+
+
+def build_cache(potentials_dir, cache_path, checksum):
+    """Parse DSX tables and write them to cache_path in the shared layout."""
+    tables = {name: read_table(potentials_dir, name, keys_name) for name, keys_name in TABLE_KEYS.items()}
+    # Offsets depend on the index length, so lay out the index until it is stable.
+    offsets = {name: 0 for name in tables}
+    while True:
+        index = {
+            name: {'shape': list(values.shape), 'offset': offsets[name], 'columns': columns}
+            for name, (values, columns) in tables.items()
+        }
+        index_bytes = json.dumps(index).encode()
+        offset = align(CACHE_HEADER.size + len(index_bytes))
+        new_offsets = {}
+        for name, (values, _) in tables.items():
+            new_offsets[name] = offset
+            offset = align(offset + values.nbytes)
+        if new_offsets == offsets:
+            break
+        offsets = new_offsets
+    # Write to a temporary file first, so other processes never map a partial cache.
+    cache_dir = os.path.dirname(cache_path)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(index_bytes), checksum))
+            f.write(index_bytes)
+            for name, (values, _) in tables.items():
+                f.seek(offsets[name])
+                f.write(values.astype('<f4').tobytes())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_table(potentials_dir, name, keys_name):
+    """Read a DSX .bin table as a (bins, potentials) array, and its keys."""
+    with open(os.path.join(potentials_dir, f'{name}.bin'), 'rb') as f:
+        header = np.fromfile(f, dtype=HEADER_DTYPE, count=HEADER_SIZE)
+        potential_count, bin_count = int(header[2]), int(header[3])
+        values = np.fromfile(f, dtype='<f4', count=potential_count * bin_count)
+    with open(os.path.join(potentials_dir, keys_name)) as f:
+        tokens = f.read().split()
+    columns = {key: int(column) for key, column in zip(tokens[::2], tokens[1::2])}
+    return values.reshape(bin_count, potential_count), columns
+
+
+def align(offset):
+    return -(-offset // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
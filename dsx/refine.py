@@ -0,0 +1,103 @@
+import time
+import numpy as np
+
+__all__ = ['refine_pose']
+
+
+# Number of trial poses scored at once.
+BATCH_SIZE = 256
+# Standard deviations of the translation (Å) and rotation (radians) of each trial move.
+STEP_TRANSLATION = 0.25
+STEP_ANGLE = np.radians(4)
+# Maximum distance any atom may move from its starting position (Å).
+MAX_SHIFT = 2.0
+# Monte Carlo temperature, in DSX score units.
+TEMPERATURE = 1.0
+
+
+def refine_pose(
+        scorer, positions, budget_secs, batch_size=BATCH_SIZE, max_shift=MAX_SHIFT,
+        step_translation=STEP_TRANSLATION, step_angle=STEP_ANGLE, temperature=TEMPERATURE,
+        untyped_as_zero=True, seed=None, clock=time.perf_counter):
+    """Search rigid-body moves of a ligand around its pose for a lower total score.
+
+    Each step scores batch_size random moves of the current pose with
+    scorer.batch_score, and moves to the best of them following the Metropolis
+    criterion. Moves that take any atom further than max_shift from where it
+    started are rejected. The search stops once budget_secs have elapsed.
+
+    Atoms DSX didn't type at the starting pose can come into contact after
+    small moves. Their pairs are scored as 0, so scores of moved poses are
+    estimates until DSX rescores the refined pose. If untyped_as_zero is
+    False, poses with such pairs are rejected instead.
+
+    Returns a dict with the 4x4 'transform' from the starting pose to the best
+    pose, the 'initial_score' and 'score' of both poses, and the number of
+    'trials' scored.
+    """
+    start_time = clock()
+    rng = np.random.default_rng(seed)
+    positions = np.asarray(positions, dtype=np.float64)
+    receptor_rows = scorer.pocket_rows(positions, max_shift)
+    scores, _ = scorer.batch_score(positions[None], receptor_rows)
+    initial_score = current_score = best_score = float(scores[0])
+    current = best = np.eye(4)
+    centroid = positions.mean(axis=0)
+    trials = 0
+    while clock() - start_time < budget_secs:
+        center = current[:3, :3] @ centroid + current[:3, 3]
+        transforms = random_moves(rng, batch_size, center, step_translation, step_angle) @ current
+        poses = transform_positions(transforms, positions)
+        scores, scorable = scorer.batch_score(poses, receptor_rows)
+        shifts = np.linalg.norm(poses - positions, axis=2).max(axis=1)
+        rejected = shifts > max_shift
+        if not untyped_as_zero:
+            rejected |= ~scorable
+        scores[rejected] = np.inf
+        trials += batch_size
+        i = int(np.argmin(scores))
+        if not np.isfinite(scores[i]):
+            continue
+        delta = scores[i] - current_score
+        if delta < 0 or rng.random() < np.exp(-delta / temperature):
+            current, current_score = transforms[i], float(scores[i])
+            if current_score < best_score:
+                best, best_score = current, current_score
+    return {
+        'transform': best,
+        'initial_score': initial_score,
+        'score': best_score,
+        'trials': trials,
+    }
+
+
+def random_moves(rng, count, center, step_translation, step_angle):
+    """Get (count, 4, 4) random rotations about center, followed by random translations."""
+    axes = rng.normal(size=(count, 3))
+    axes /= np.linalg.norm(axes, axis=1, keepdims=True)
+    angles = rng.normal(0, step_angle, count)
+    rotations = rotation_matrices(axes, angles)
+    moves = np.tile(np.eye(4), (count, 1, 1))
+    moves[:, :3, :3] = rotations
+    translations = rng.normal(0, step_translation, (count, 3))
+    moves[:, :3, 3] = center - rotations @ center + translations
+    return moves
+
+
+def rotation_matrices(axes, angles):
+    """Get rotation matrices of angles about unit axes, with Rodrigues' formula."""
+    x, y, z = axes.T
+    zeros = np.zeros(len(axes))
+    cross = np.stack([
+        np.stack([zeros, -z, y], axis=1),
+        np.stack([z, zeros, -x], axis=1),
+        np.stack([-y, x, zeros], axis=1),
+    ], axis=1)
+    sin = np.sin(angles)[:, None, None]
+    cos = np.cos(angles)[:, None, None]
+    return np.eye(3) + sin * cross + (1 - cos) * cross @ cross
+
+
+def transform_positions(transforms, positions):
+    """Apply (P, 4, 4) transforms to (N, 3) positions, giving (P, N, 3) poses."""
+    return positions @ transforms[:, :3, :3].transpose(0, 2, 1) + transforms[:, None, :3, 3]
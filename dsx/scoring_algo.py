@@ -1,108 +1,436 @@
-import itertools
+import asyncio
+import atexit
+import contextvars
+import functools
+import hashlib
 import io
 import os
+import shutil
 import tempfile
+import time
+import numpy as np
+from collections import OrderedDict
 from nanome.api import structure
 from nanome.util import Logs, Process
 
-__all__ = ['score_ligands']
+from dsx import refine
+from dsx.contributions import PairContributionStore
+from dsx.neighbor_list import NeighborListScorer
+from dsx.potentials import load_pair_potentials
+
+__all__ = ['score_ligands', 'iter_ligand_scores', 'score_aggregates', 'score_ensemble', 'refine_ligand_pose']
 
 
 DIR = os.path.dirname(__file__)
+DSX_PATH = os.path.join(DIR, 'bin', 'dsx_linux_64.lnx')
+NANOBABEL_PATH = 'nanobabel'
+# Potentials directory passed to DSX, may be replaced by a staged copy during warmup.
+POTENTIALS_DIR = os.path.join(DIR, 'bin', 'pdb_pot_0511')
 
 SDF_OPTIONS = structure.Complex.io.SDFSaveOptions()
 PDB_OPTIONS = structure.Complex.io.PDBSaveOptions()
 PDB_OPTIONS.write_bonds = True
 
+# Pair contributions are parsed into a single store reused between scoring passes.
+PAIR_STORE = PairContributionStore()
+# In-process scorers used by incremental mode, keyed by the atom indices of each
+# ligand, least recently used first.
+INCREMENTAL_SCORERS = OrderedDict()
+# Maximum number of ligands that keep an in-process scorer.
+MAX_INCREMENTAL_SCORERS = 256
+# Receptor PDB files kept between ensemble scoring passes, keyed by receptor fingerprint.
+RECEPTOR_FILES = {}
+# Maximum number of DSX processes run at once when scoring an ensemble.
+MAX_PARALLEL_DSX = os.cpu_count() or 1
+_pair_potentials = None
+_receptor_files_dir = None
+# Functions called after each process run by run_process in the current context,
+# see add_process_hook.
+_process_hooks = contextvars.ContextVar('process_hooks', default=())
+
 
-async def score_ligands(receptor: structure.Complex, ligand_comps: 'list[structure.Complex]'):
+async def score_ligands(
+        receptor: structure.Complex, ligand_comps: 'list[structure.Complex]', incremental=False, receptor_pdb=None,
+        aggregate_only=False):
     output = []
+    async for ligand_data in iter_ligand_scores(
+            receptor, ligand_comps, incremental=incremental, receptor_pdb=receptor_pdb,
+            aggregate_only=aggregate_only):
+        output.append(ligand_data)
+    return output
+
+
+async def iter_ligand_scores(
+        receptor: structure.Complex, ligand_comps: 'list[structure.Complex]', incremental=False, receptor_pdb=None,
+        aggregate_only=False):
+    """Yield the scoring results of each ligand as soon as DSX has finished with it.
+
+    receptor_pdb is the path of a PDB file already written for receptor, see
+    prepare_receptor. A temporary one is written when it isn't given.
+
+    In incremental mode, ligands scored by DSX before are rescored in-process,
+    recomputing only the pair terms of atoms that moved. DSX is only run again
+    when the receptor or the ligand's atoms change, or an atom DSX didn't type
+    comes into contact.
+
+    In aggregate only mode, see score_aggregates, results only have aggregate
+    scores, and incremental mode doesn't apply.
+    """
+    if aggregate_only:
+        for ligand_data in await score_aggregates(receptor, ligand_comps, receptor_pdb):
+            yield ligand_data
+        return
+    receptor_key = incremental and receptor_fingerprint(receptor)
     with tempfile.TemporaryDirectory() as dir:
-        receptor_pdb = tempfile.NamedTemporaryFile(dir=dir, delete=False, suffix='.pdb')
-        receptor.io.to_pdb(receptor_pdb.name, PDB_OPTIONS)
         # For each ligand, generate a PDB file and run DSX
         for ligand_comp in ligand_comps:
-            ligand_sdf = tempfile.NamedTemporaryFile(dir=dir, delete=False, suffix='.sdf')
-            ligand_comp.io.to_sdf(ligand_sdf.name, SDF_OPTIONS)
-            # Convert ligand sdf to a mol2.
-            ligand_mol2 = tempfile.NamedTemporaryFile(dir=dir, delete=False, suffix='.mol2')
-            # Convert ligand from sdf to mol2.
-            await nanobabel_convert(ligand_sdf.name, ligand_mol2.name)
-            # Run DSX and retreive data from the subprocess.
-            dsx_results_file = tempfile.NamedTemporaryFile(dir=dir, delete=False, suffix='.txt')
-            dsx_output = await run_dsx(receptor_pdb.name, ligand_mol2.name, dsx_results_file.name)
-            atom_scores = parse_output(dsx_output, ligand_comp)
-            aggregate_scores = parse_results(dsx_results_file.name)
-            ligand_data = {
-                'complex_index': ligand_comp.index,
-                'aggregate_scores': aggregate_scores,
-                'atom_scores': atom_scores
-            }
-            output.append(ligand_data)
-    return output
+            if incremental:
+                ligand_atoms = list(get_current_molecule(ligand_comp).atoms)
+                ligand_key = tuple(atom.index for atom in ligand_atoms)
+                ligand_data = score_incremental(receptor, receptor_key, ligand_comp, ligand_atoms)
+                if ligand_data:
+                    yield ligand_data
+                    continue
+            if receptor_pdb is None:
+                receptor_pdb = os.path.join(dir, 'receptor.pdb')
+                receptor.io.to_pdb(receptor_pdb, PDB_OPTIONS)
+            ligand_mol2 = await prepare_ligand(ligand_comp, dir)
+            ligand_data = await score_ligand_file(receptor, receptor_pdb, ligand_comp, ligand_mol2, dir)
+            if incremental:
+                scorer = NeighborListScorer.from_dsx_files(
+                    get_pair_potentials(), PAIR_STORE, receptor_pdb, ligand_mol2)
+                if len(scorer.ligand_types) == len(ligand_atoms):
+                    INCREMENTAL_SCORERS[ligand_key] = (receptor_key, scorer)
+                    INCREMENTAL_SCORERS.move_to_end(ligand_key)
+            yield ligand_data
+    if incremental:
+        # Forget the scorers of ligands that haven't been scored for longest. Ligands
+        # missing from this call may still be scored later, in another batch of poses.
+        while len(INCREMENTAL_SCORERS) > MAX_INCREMENTAL_SCORERS:
+            INCREMENTAL_SCORERS.popitem(last=False)
+
+
+async def score_aggregates(receptor: structure.Complex, ligand_comps: 'list[structure.Complex]', receptor_pdb=None):
+    """Score the total and per contact scores of ligands, without per atom and residue scores.
+
+    DSX scores every ligand in a single run, and doesn't write pair potentials.
+    """
+    if not ligand_comps:
+        return []
+    with tempfile.TemporaryDirectory() as dir:
+        if receptor_pdb is None:
+            receptor_pdb = os.path.join(dir, 'receptor.pdb')
+            receptor.io.to_pdb(receptor_pdb, PDB_OPTIONS)
+        ligand_mol2s = await asyncio.gather(*[
+            prepare_ligand(ligand_comp, dir) for ligand_comp in ligand_comps])
+        results = await run_dsx_results(receptor_pdb, ligand_mol2s, dir)
+        if len(results) == len(ligand_comps):
+            aggregate_scores = [[result] for result in results]
+        else:
+            # Rows can't be matched to ligands when DSX skips some of them.
+            Logs.warning(f"DSX scored {len(results)} of {len(ligand_comps)} ligands, scoring them separately.")
+            aggregate_scores = [
+                await run_dsx_results(receptor_pdb, [ligand_mol2], dir) for ligand_mol2 in ligand_mol2s]
+    return [
+        {
+            'complex_index': ligand_comp.index,
+            'aggregate_scores': ligand_aggregate_scores,
+            'atom_scores': [],
+            'residue_scores': []
+        }
+        for ligand_comp, ligand_aggregate_scores in zip(ligand_comps, aggregate_scores)
+    ]
+
 
+async def run_dsx_results(receptor_pdb, ligand_mol2s, dir):
+    """Run DSX once on several ligand files without pair potentials, and parse its results table."""
+    ligands_mol2 = tempfile.NamedTemporaryFile(dir=dir, delete=False, suffix='.mol2')
+    with open(ligands_mol2.name, 'w') as ligands_file:
+        for ligand_mol2 in ligand_mol2s:
+            with open(ligand_mol2) as ligand_file:
+                ligands_file.write(ligand_file.read().rstrip('\n') + '\n')
+    dsx_results_file = tempfile.NamedTemporaryFile(dir=dir, delete=False, suffix='.txt')
+    await run_dsx(receptor_pdb, ligands_mol2.name, dsx_results_file.name, pair_potentials=False)
+    return parse_results(dsx_results_file.name)
 
-async def run_dsx(receptor_pdb, ligands_mol2, output_file_path) -> str:
-    """Run DSX and write output to provided output_file."""
-    dsx_path = os.path.join(DIR, 'bin', 'dsx_linux_64.lnx')
-    pdb_pot_0511 = os.path.join(DIR, 'bin', 'pdb_pot_0511')
-    dsx_args = [
-        dsx_path, '-P', receptor_pdb, '-L', ligands_mol2, '-D', pdb_pot_0511,
-        '-pp', '-F', output_file_path
+
+async def score_ensemble(receptors: 'list[structure.Complex]', ligand_comps: 'list[structure.Complex]'):
+    """Score ligands against every receptor of an ensemble.
+
+    Ligands are converted to mol2 once, and DSX runs for every receptor and
+    ligand pair in parallel. Receptor PDB files are kept between calls until
+    their receptor moves or leaves the ensemble.
+
+    Returns a list of {'receptor_index', 'ligand_scores'} dicts in the order of
+    receptors, where ligand_scores are the results of score_ligands.
+    """
+    receptor_pdbs = [prepare_receptor(receptor) for receptor in receptors]
+    prune_receptor_files(receptor_pdbs)
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_DSX)
+
+    async def score_pair(receptor, receptor_pdb, ligand_comp, ligand_mol2, dir):
+        async with semaphore:
+            # Pairs finish in any order, so each one gets its own store.
+            return await score_ligand_file(
+                receptor, receptor_pdb, ligand_comp, ligand_mol2, dir, PairContributionStore())
+
+    with tempfile.TemporaryDirectory() as dir:
+        ligand_mol2s = await asyncio.gather(*[
+            prepare_ligand(ligand_comp, dir) for ligand_comp in ligand_comps])
+        ligand_scores = await asyncio.gather(*[
+            score_pair(receptor, receptor_pdb, ligand_comp, ligand_mol2, dir)
+            for receptor, receptor_pdb in zip(receptors, receptor_pdbs)
+            for ligand_comp, ligand_mol2 in zip(ligand_comps, ligand_mol2s)])
+    ligand_count = len(ligand_comps)
+    return [
+        {
+            'receptor_index': receptor.index,
+            'ligand_scores': ligand_scores[i * ligand_count:(i + 1) * ligand_count]
+        }
+        for i, receptor in enumerate(receptors)
     ]
-    dsx_stdout = io.StringIO()
+
+
+async def refine_ligand_pose(receptor: structure.Complex, ligand_comp: structure.Complex, budget_secs, **options):
+    """Search rigid-body moves of a ligand around its current pose for a lower score.
+
+    DSX runs once to type the receptor and ligand atoms, then trial poses are
+    scored in batches in-process, in a worker thread. Options are passed on to
+    refine.refine_pose.
+
+    Returns the result of refine.refine_pose, or None if DSX didn't type every ligand atom.
+    """
+    ligand_atoms = list(get_current_molecule(ligand_comp).atoms)
+    pair_store = PairContributionStore()
+    with tempfile.TemporaryDirectory() as dir:
+        receptor_pdb = os.path.join(dir, 'receptor.pdb')
+        receptor.io.to_pdb(receptor_pdb, PDB_OPTIONS)
+        ligand_mol2 = await prepare_ligand(ligand_comp, dir)
+        await score_ligand_file(receptor, receptor_pdb, ligand_comp, ligand_mol2, dir, pair_store)
+        scorer = NeighborListScorer.from_dsx_files(get_pair_potentials(), pair_store, receptor_pdb, ligand_mol2)
+    if len(scorer.ligand_types) != len(ligand_atoms):
+        return None
+    positions = np.array([atom.position.unpack() for atom in ligand_atoms])
+    refine_pose = functools.partial(refine.refine_pose, scorer, positions, budget_secs, **options)
+    return await asyncio.get_event_loop().run_in_executor(None, refine_pose)
+
+
+async def prepare_ligand(ligand_comp, dir):
+    """Write ligand_comp to a mol2 file in dir, and return its path."""
+    ligand_sdf = tempfile.NamedTemporaryFile(dir=dir, delete=False, suffix='.sdf')
+    ligand_comp.io.to_sdf(ligand_sdf.name, SDF_OPTIONS)
+    # Convert ligand from sdf to mol2.
+    ligand_mol2 = tempfile.NamedTemporaryFile(dir=dir, delete=False, suffix='.mol2')
+    await nanobabel_convert(ligand_sdf.name, ligand_mol2.name)
+    return ligand_mol2.name
+
+
+async def score_ligand_file(receptor, receptor_pdb, ligand_comp, ligand_mol2, dir, pair_store=None):
+    """Run DSX on prepared receptor and ligand files, and parse the results of the ligand."""
+    if pair_store is None:
+        pair_store = PAIR_STORE
+    # Run DSX and retreive data from the subprocess.
+    dsx_results_file = tempfile.NamedTemporaryFile(dir=dir, delete=False, suffix='.txt')
+    dsx_output = await run_dsx(receptor_pdb, ligand_mol2, dsx_results_file.name)
+    atom_scores = parse_output(dsx_output, ligand_comp, pair_store)
+    residue_scores = parse_residue_scores(pair_store, receptor)
+    aggregate_scores = parse_results(dsx_results_file.name)
+    return {
+        'complex_index': ligand_comp.index,
+        'aggregate_scores': aggregate_scores,
+        'atom_scores': atom_scores,
+        'residue_scores': residue_scores
+    }
+
+
+def prepare_receptor(receptor):
+    """Get the path of a PDB file of receptor, only writing it if the receptor changed."""
+    global _receptor_files_dir
+    receptor_key = receptor_fingerprint(receptor)
+    receptor_pdb = RECEPTOR_FILES.get(receptor_key)
+    if receptor_pdb and os.path.exists(receptor_pdb):
+        return receptor_pdb
+    if _receptor_files_dir is None:
+        _receptor_files_dir = tempfile.mkdtemp(prefix='realtime-scoring-receptors-')
+        atexit.register(remove_receptor_files_dir)
+    receptor_pdb = os.path.join(_receptor_files_dir, f'{receptor.index}_{receptor_key[1]}.pdb')
+    receptor.io.to_pdb(receptor_pdb, PDB_OPTIONS)
+    RECEPTOR_FILES[receptor_key] = receptor_pdb
+    return receptor_pdb
+
+
+def remove_receptor_files_dir():
+    """Delete the directory of cached receptor files, and forget about them."""
+    global _receptor_files_dir
+    if _receptor_files_dir is not None:
+        shutil.rmtree(_receptor_files_dir, ignore_errors=True)
+        _receptor_files_dir = None
+    RECEPTOR_FILES.clear()
+
+
+def prune_receptor_files(keep_paths):
+    """Delete cached receptor files that are not in keep_paths."""
+    keep_paths = set(keep_paths)
+    for receptor_key, receptor_pdb in list(RECEPTOR_FILES.items()):
+        if receptor_pdb not in keep_paths:
+            del RECEPTOR_FILES[receptor_key]
+            if os.path.exists(receptor_pdb):
+                os.remove(receptor_pdb)
+
+
+def score_incremental(receptor, receptor_key, ligand_comp, ligand_atoms):
+    """Rescore a ligand with its cached in-process scorer, None if DSX needs to run."""
+    ligand_key = tuple(atom.index for atom in ligand_atoms)
+    cached_receptor_key, scorer = INCREMENTAL_SCORERS.get(ligand_key, (None, None))
+    if not scorer or cached_receptor_key != receptor_key:
+        return None
+    INCREMENTAL_SCORERS.move_to_end(ligand_key)
+    positions = np.array([atom.position.unpack() for atom in ligand_atoms])
+    if not scorer.score(positions):
+        Logs.debug("Ligand contacts atoms without DSX types, rescoring with DSX.")
+        del INCREMENTAL_SCORERS[ligand_key]
+        return None
+    total_score = scorer.total
+    contact_count = scorer.contact_count
+    aggregate_scores = [{
+        'total_score': round(total_score, 3),
+        'per_contact_score': round(total_score / contact_count, 3) if contact_count else 0.0
+    }]
+    atom_scores = [
+        (ligand_atoms[i].index, score)
+        for i, score in enumerate(scorer.atom_scores.tolist())
+        if scorer.atom_contacts[i]
+    ]
+    return {
+        'complex_index': ligand_comp.index,
+        'aggregate_scores': aggregate_scores,
+        'atom_scores': atom_scores,
+        'residue_scores': map_residue_scores(receptor, *scorer.residue_scores())
+    }
+
+
+def receptor_fingerprint(receptor):
+    """Identify a receptor by its index and atom positions."""
+    positions = np.array([atom.position.unpack() for atom in receptor.atoms])
+    return receptor.index, hashlib.sha1(positions.tobytes()).hexdigest()
+
+
+def get_pair_potentials():
+    global _pair_potentials
+    if _pair_potentials is None:
+        _pair_potentials = load_pair_potentials(POTENTIALS_DIR)
+    return _pair_potentials
+
+
+def get_current_molecule(comp):
+    return next(
+        mol for i, mol in enumerate(comp.molecules)
+        if i == comp.current_frame
+    )
+
+
+async def run_dsx(receptor_pdb, ligands_mol2, output_file_path, pair_potentials=True) -> str:
+    """Run DSX and write output to provided output_file.
+
+    The potential of every atom pair is only written to stdout if pair_potentials is True.
+    """
+    dsx_path = DSX_PATH
+    dsx_args = [dsx_path, '-P', receptor_pdb, '-L', ligands_mol2, '-D', POTENTIALS_DIR]
+    if pair_potentials:
+        dsx_args.append('-pp')
+    dsx_args += ['-F', output_file_path]
     try:
-        dsx_process = Process(dsx_path, dsx_args, label="DSX", output_text=True)
-        dsx_process.on_output = lambda output: dsx_stdout.write(output + '\n')
-        await dsx_process.start()
+        return await run_process(dsx_path, dsx_args, label="DSX")
     except Exception:
         Logs.error("Couldn't execute dsx, please check if executable is in the plugin folder and has permissions. Try executing chmod +x " + dsx_path)
         return
-    return dsx_stdout.getvalue()
 
 
 async def nanobabel_convert(input_file, output_file):
-    nanobabel_path = 'nanobabel'
+    nanobabel_path = NANOBABEL_PATH
     cmd_args = ['convert', '-i', input_file, '-o', output_file]
-    nanobabel_process = Process(nanobabel_path, cmd_args, label="nanobabel", output_text=True)
-    await nanobabel_process.start()
+    await run_process(nanobabel_path, cmd_args, label="nanobabel")
+
+
+async def run_process(executable_path, args, label=""):
+    """Run an executable and return its stdout.
+
+    Plugins run it with their process manager. Outside of a plugin, such as on
+    scoring workers, it runs as an asyncio subprocess, so the event loop
+    keeps running meanwhile.
+    """
+    start_time = time.perf_counter()
+    try:
+        if Process._manager is None:
+            process = await asyncio.create_subprocess_exec(
+                executable_path, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            stdout, _ = await process.communicate()
+            return stdout.decode()
+        stdout = io.StringIO()
+        process = Process(executable_path, args, label=label, output_text=True)
+        process.on_output = lambda output: stdout.write(output + '\n')
+        await process.start()
+        return stdout.getvalue()
+    finally:
+        secs = time.perf_counter() - start_time
+        for hook in _process_hooks.get():
+            hook(label, secs)
+
+
+def add_process_hook(hook):
+    """Call hook(label, secs) after each process run by run_process, until remove_process_hook.
+
+    Hooks only apply to the current context, which tasks created from it inherit,
+    so processes run by other sessions or tasks aren't reported.
+    """
+    _process_hooks.set(_process_hooks.get() + (hook,))
 
 
-def parse_output(dsx_output, ligand_comp):
-    """Get per atom scores from output of DSX process."""
-    ligand_sets = dsx_output.split("# Receptor-Ligand:")[1:]
-    scores = dict()
+def remove_process_hook(hook):
+    _process_hooks.set(tuple(registered for registered in _process_hooks.get() if registered != hook))
+
+
+def parse_output(dsx_output, ligand_comp, pair_store=None):
+    """Get per atom scores from output of DSX process.
+
+    Pair contributions are kept in pair_store (PAIR_STORE by default) until the next call.
+    """
+    if pair_store is None:
+        pair_store = PAIR_STORE
+    pair_store.load_dsx_output(dsx_output)
+    if not pair_store.size:
+        return []
+    # Attach calculated score to each atom
+    ligand_atoms = list(get_current_molecule(ligand_comp).atoms)
     atom_scores = list()
-    for ligand_set in ligand_sets:
-        for line in ligand_set.splitlines():
-            if not line or line.startswith("#"):
-                continue
-            line_items = line.split("__")
-            try:
-                atom_items = line_items[1].split("_")
-            except IndexError:
-                continue
-            score = float(line_items[2])
-            ireceptor_iligand = (int(atom_items[1]), int(atom_items[2]))
-            if ireceptor_iligand not in atom_scores:
-                scores[ireceptor_iligand] = [score]
-            else:
-                scores[ireceptor_iligand].append(score)
-        if not scores:
-            continue
-        # Attach calculated score to each atom
-        ligand_molecule = next(
-            mol for i, mol in enumerate(ligand_comp.molecules)
-            if i == ligand_comp.current_frame
-        )
-
-        for atom_tuple, score_arr in scores.items():
-            score = sum(score_arr) / len(score_arr)
-            atom = next(itertools.islice(ligand_molecule.atoms, atom_tuple[1] - 1, atom_tuple[1]))
-            atom_scores.append((atom.index, score))
+    atom_numbers, scores = pair_store.ligand_atom_scores()
+    for atom_number, score in zip(atom_numbers.tolist(), scores.tolist()):
+        atom = ligand_atoms[atom_number - 1]
+        atom_scores.append((atom.index, score))
     return atom_scores
 
 
+def parse_residue_scores(pair_store, receptor):
+    """Get summed scores of each receptor residue from parsed pair contributions."""
+    if not pair_store.size:
+        return []
+    return map_residue_scores(receptor, *pair_store.residue_scores())
+
+
+def map_residue_scores(receptor, residue_numbers, scores):
+    """Get (residue index, score) tuples from arrays of receptor residue numbers and scores."""
+    # DSX reports residues by their serial number in the receptor PDB.
+    residues_by_serial = {}
+    for residue in get_current_molecule(receptor).residues:
+        residues_by_serial.setdefault(residue.serial, residue)
+    residue_scores = list()
+    for residue_number, score in zip(residue_numbers.tolist(), scores.tolist()):
+        residue = residues_by_serial.get(residue_number)
+        if residue:
+            residue_scores.append((residue.index, score))
+    return residue_scores
+
+
 def parse_results(dsx_output_file):
     """Parse the output of DSX and return a list of total scores and per contact scores."""
     data = []
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import time
+from nanome.api import structure
+from nanome.util import Logs
+
+from dsx import potentials, scoring_algo
+
+__all__ = ['warmup']
+
+
+ASSETS_DIR = os.path.join(scoring_algo.DIR, 'assets')
+WARMUP_RECEPTOR_PDB = os.path.join(ASSETS_DIR, 'warmup_receptor.pdb')
+WARMUP_LIGAND_PDB = os.path.join(ASSETS_DIR, 'warmup_ligand.pdb')
+# Shared memory mount, potentials copied here are read from RAM by every DSX run.
+TMPFS_DIR = '/dev/shm'
+STAGED_DIR_NAME = 'realtime-scoring-pdb_pot_0511'
+READ_CHUNK_SIZE = 1 << 20
+
+
+async def warmup(stage_potentials=True):
+    """Prepare DSX so the first interactive score runs at steady state latency.
+
+    Checks that executables can be run, stages the potentials directory in tmpfs,
+    maps the shared potential tables, reads the DSX binary and its bundled
+    libraries into the page cache, and scores a small bundled complex. Returns a dict of timings in seconds.
+    """
+    timings = {}
+    start = time.perf_counter()
+    errors = check_executables()
+    timings['check_executables'] = time.perf_counter() - start
+    for error in errors:
+        Logs.error(error)
+    if errors:
+        return timings
+
+    if stage_potentials:
+        start = time.perf_counter()
+        staged_dir = stage_potentials_dir()
+        if staged_dir:
+            scoring_algo.POTENTIALS_DIR = staged_dir
+        timings['stage_potentials'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scoring_algo.get_pair_potentials()
+    timings['map_potentials'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bin_dir = os.path.dirname(scoring_algo.DSX_PATH)
+    preload_files(os.path.join(bin_dir, filename) for filename in os.listdir(bin_dir))
+    potentials_dir = scoring_algo.POTENTIALS_DIR
+    preload_files(os.path.join(potentials_dir, filename) for filename in os.listdir(potentials_dir))
+    timings['preload_files'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    receptor = structure.Complex.io.from_pdb(path=WARMUP_RECEPTOR_PDB)
+    ligand = structure.Complex.io.from_pdb(path=WARMUP_LIGAND_PDB)
+    results = await scoring_algo.score_ligands(receptor, [ligand])
+    timings['self_test'] = time.perf_counter() - start
+    if not results or not results[0]['aggregate_scores']:
+        Logs.error("DSX self-test did not return any scores.")
+    return timings
+
+
+def check_executables():
+    """Get a list of errors for the executables needed for scoring."""
+    errors = []
+    dsx_path = scoring_algo.DSX_PATH
+    if not os.access(dsx_path, os.X_OK):
+        errors.append(f"DSX is not executable. Try executing chmod +x {dsx_path}")
+    if not shutil.which(scoring_algo.NANOBABEL_PATH):
+        errors.append(f"Couldn't find executable {scoring_algo.NANOBABEL_PATH}, ligands can't be converted to mol2.")
+    return errors
+
+
+def stage_potentials_dir(tmpfs_dir=TMPFS_DIR):
+    """Copy potentials into tmpfs, and return the path of the copy.
+
+    The copy is shared by every plugin session on the host, and is only
+    made if it doesn't exist yet, or if the potentials changed since it was
+    made. Returns None if tmpfs is not available.
+    """
+    if not os.access(tmpfs_dir, os.W_OK):
+        Logs.debug(f"{tmpfs_dir} is not writable, potentials won't be staged.")
+        return None
+    staged_dir = os.path.join(tmpfs_dir, STAGED_DIR_NAME)
+    source_dir = os.path.join(os.path.dirname(scoring_algo.DSX_PATH), 'pdb_pot_0511')
+    if os.path.isdir(staged_dir):
+        if is_current_copy(source_dir, staged_dir):
+            return staged_dir
+        Logs.message("Staged potentials are out of date, staging them again.")
+    # Copy to a temporary directory first, so other sessions never see a partial copy.
+    tmp_dir = tempfile.mkdtemp(dir=tmpfs_dir)
+    try:
+        shutil.copytree(source_dir, os.path.join(tmp_dir, 'pdb_pot_0511'))
+        if os.path.isdir(staged_dir):
+            # Moved out of the way, and deleted with the temporary directory.
+            os.rename(staged_dir, os.path.join(tmp_dir, 'stale'))
+        os.rename(os.path.join(tmp_dir, 'pdb_pot_0511'), staged_dir)
+    except OSError:
+        # Another session finished staging first.
+        if not os.path.isdir(staged_dir):
+            raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return staged_dir
+
+
+def is_current_copy(source_dir, copy_dir):
+    """Whether copy_dir has the same files as source_dir, with the same sizes and modification times."""
+    try:
+        copies = {entry.name: entry.stat() for entry in os.scandir(copy_dir)}
+        sources = {entry.name: entry.stat() for entry in os.scandir(source_dir)}
+    except OSError:
+        return False
+    return copies.keys() == sources.keys() and all(
+        (copies[name].st_size, copies[name].st_mtime_ns) == (stat.st_size, stat.st_mtime_ns)
+        for name, stat in sources.items())
+
+
+def preload_files(paths):
+    """Read files once so they are in the page cache."""
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            while f.read(READ_CHUNK_SIZE):
+                pass
@@ -1,20 +1,46 @@
+import asyncio
 import inspect
 import nanome
+import time
 from datetime import datetime, timedelta
 from nanome.api import structure
 from nanome.api.shapes import Shape, Sphere
 from nanome.util import async_callback, Logs, Color, enums
 
-from dsx import scoring_algo
+from dsx import distributed, scoring_algo, warmup
 from plugin.utils import ScoringOutputSchema
 from plugin.SettingsMenu import SettingsMenu
 from plugin.menu import MainMenu
+from plugin.recorder import SessionRecorder
+from plugin.scheduler import PoseScheduler
+from plugin.profiler import CycleProfiler, profiled_cycle
 from plugin import utils
 
 
 class RealtimeScoring(nanome.AsyncPluginInstance):
 
-    scoring_algorithm = scoring_algo.score_ligands
+    # May be a coroutine, a regular function, or an async generator yielding
+    # results for one ligand at a time.
+    scoring_algorithm = scoring_algo.iter_ligand_scores
+    # Scores ligands against several receptors, returning a list of
+    # {'receptor_index', 'ligand_scores'} dicts. May be a coroutine or a regular function.
+    ensemble_scoring_algorithm = scoring_algo.score_ensemble
+    # Minimum time between checks for moved complexes.
+    update_interval = timedelta(seconds=3)
+    # Number of ligand complexes from which poses are scored progressively,
+    # starting with the ones that moved, rather than all at once.
+    prioritized_min_poses = 20
+    # Time spent refreshing poses that didn't move, on each update.
+    refresh_budget = timedelta(seconds=2)
+    # Number of best poses listed in the results panel when scoring progressively.
+    ranking_size = 10
+    # Searches for a better pose of a ligand complex around its current one,
+    # see scoring_algo.refine_ligand_pose. May be a coroutine or a regular function.
+    refine_algorithm = scoring_algo.refine_ligand_pose
+    # Time spent refining the poses of every ligand complex, shared between them.
+    refine_budget = timedelta(seconds=5)
+    # Number of update and scoring cycles profiled from the settings menu.
+    profile_cycle_count = 5
 
     def start(self):
         self.menu = MainMenu(self)
@@ -31,6 +57,8 @@ class RealtimeScoring(nanome.AsyncPluginInstance):
         self.color_negative_score = Color(0, 0, 255, 200)  # Blue
         self.color_positive_score = Color(255, 0, 0, 200)  # Red
         self.realtime_enabled = True
+        self.warmup_enabled = False
+        self.incremental_scoring = False
         # Configure settings based on custom data added at runtime.
         if custom_data.get('color_negative_score'):
             self.color_negative_score = custom_data.get('color_negative_score')
@@ -38,98 +66,232 @@ class RealtimeScoring(nanome.AsyncPluginInstance):
             self.color_positive_score = custom_data.get('color_positive_score')
         if custom_data.get('realtime_enabled'):
             self.realtime_enabled = custom_data.get('realtime_enabled')
+        if custom_data.get('warmup'):
+            self.warmup_enabled = True
+        if custom_data.get('incremental_scoring'):
+            self.incremental_scoring = True
+        # Only score total and per contact scores of poses scored progressively, see score_prioritized
+        if custom_data.get('aggregate_only_scoring'):
+            self.settings.aggregate_only = True
+        # Path of a trace file to record the session to, see benchmarks/replay.py
+        record_path = custom_data.get('record_session')
+        self.recorder = None
+        if isinstance(record_path, str):
+            self.recorder = SessionRecorder(self, record_path)
+            self.recorder.attach()
+        # Addresses of scoring workers to score on instead of this process, see dsx.distributed
+        scoring_workers = custom_data.get('scoring_workers')
+        self.dispatcher = None
+        if isinstance(scoring_workers, list) and scoring_workers:
+            self.dispatcher = distributed.Dispatcher(scoring_workers)
+            if self.incremental_scoring:
+                Logs.warning("Scoring workers don't support incremental scoring, every ligand is scored in full.")
+        self.profiler = None
+        # Number of update and scoring cycles to profile from the start
+        profile_cycles = custom_data.get('profile_cycles')
+        if isinstance(profile_cycles, int) and profile_cycles > 0:
+            self.start_profiling(profile_cycles)
 
         self.last_update = datetime.now()
         self.is_updating = False
         # api structures
         self.receptor_index = None
         self.ligand_residue_indices = []
+        # Every receptor selected when scoring an ensemble
+        self.ensemble_indices = []
+        # Shallow complexes listed in the menu
+        self.complex_list = []
+        # Deep complexes, only for the selected receptor and ligands
         self.complex_cache = []
+        self.scheduler = PoseScheduler(self.refresh_budget.total_seconds())
+        if self.warmup_enabled:
+            self.run_warmup()
+
+    def on_stop(self):
+        if self.recorder:
+            self.recorder.save()
+        self.stop_profiling()
+        if self.dispatcher:
+            asyncio.ensure_future(self.dispatcher.close())
+        # Sessions run in child processes, which exit without running atexit handlers.
+        scoring_algo.remove_receptor_files_dir()
+
+    def start_profiling(self, cycle_count=None):
+        """Profile the next cycle_count update and scoring cycles, see CycleProfiler."""
+        cycle_count = cycle_count or self.profile_cycle_count
+        Logs.message(f"Profiling the next {cycle_count} cycles.")
+        self.profiler = CycleProfiler(cycle_count, on_finished=self.on_profiling_finished)
+
+    def stop_profiling(self):
+        """Write the stats of a capture in progress."""
+        if self.profiler and not self.profiler.finished:
+            self.profiler.finish()
+
+    def on_profiling_finished(self, profiler):
+        self.settings.profiling = False
+
+    @async_callback
+    async def run_warmup(self):
+        """Run DSX once in the background, so the first score isn't slowed by cold caches."""
+        Logs.message("Warming up DSX.")
+        timings = await warmup.warmup()
+        summary = ', '.join(f'{step}: {secs:.3f}s' for step, secs in timings.items())
+        Logs.message(f"Warmup finished. {summary}")
 
     @async_callback
     async def on_run(self):
-        complex_list = await self.request_complex_list()
-        comp_indices = set([comp.index for comp in complex_list])
-        self.complex_cache = await self.request_complexes(comp_indices)
+        self.complex_list = await self.request_complex_list()
         self.menu.render(force_enable=True)
+        self.menu.prefetch_ligands()
+
+    async def fetch_complexes(self, comp_indices, refresh=False):
+        """Get deep complexes, only requesting the ones that are not cached yet, unless refresh is True."""
+        cached = {comp.index: comp for comp in self.complex_cache}
+        missing = [index for index in comp_indices if refresh or index not in cached]
+        if missing:
+            Logs.debug(f"Fetching {len(missing)} deep complexes")
+            for comp in await self.request_complexes(missing):
+                if comp is not None:
+                    cached[comp.index] = comp
+            self.complex_cache = list(cached.values())
+        return [cached.get(index) for index in comp_indices]
+
+    def evict_complexes(self, keep_indices):
+        """Drop deep complexes that are no longer selected or being scored."""
+        keep_indices = set(keep_indices)
+        if getattr(self, 'color_stream', None):
+            keep_indices.add(self.receptor_index)
+            keep_indices.update(self.ensemble_indices)
+            keep_indices.update(res.complex.index for res in self.ligand_residues)
+        self.complex_cache = [
+            comp for comp in self.complex_cache
+            if comp.index in keep_indices
+        ]
 
     @async_callback
     async def update(self):
         if not self.realtime_enabled:
             return
-        update_time_secs = 3
         has_receptor = getattr(self, 'receptor_comp', None)
         has_ligands = getattr(self, 'ligand_residues', None)
         has_color_stream = getattr(self, 'color_stream', None)
         has_label_stream = getattr(self, 'label_stream', None)
-        due_for_update = datetime.now() - self.last_update > timedelta(seconds=update_time_secs)
+        due_for_update = datetime.now() - self.last_update > self.update_interval
         if all([
             has_receptor, has_ligands, has_color_stream,
                 has_label_stream, due_for_update, not self.is_updating]):
-            Logs.debug("Updating cached ligands.")
-            self.is_updating = True
-
-            # Get updated complexes:
-            lig_comp_indices = set()
-            for res in self.ligand_residues:
-                lig_comp_indices.add(res.complex.index)
-
-            comp_indices = set([self.receptor_comp.index] + list(lig_comp_indices))
-            updated_comps = await self.request_complexes(comp_indices)
-            # If any of the complexes were deleted, destroy the streams
-            if any([comp is None for comp in updated_comps]):
-                Logs.message("Receptor or ligand deleted. Stopping streams.")
-                # Use the score button so that the UI is updated.
-                btn_score = self.menu.btn_score
-                btn_score.selected = False
-                self.menu.on_scoring_button_pressed(btn_score)
-                self.receptor_index = None
-                self.ligand_residue_indices = []
-                return
-
-            self.set_atoms_to_workspace_positions(updated_comps)
-            self.last_update = datetime.now()
-            # Check if positions have changed in workspace
-            needs_rescore = False
-            needs_stream_update = False
-            for cached_comp, updated_comp in zip(self.complex_cache, updated_comps):
-                position_changed = cached_comp.position.unpack() != updated_comp.position.unpack()
-                rotation_changed = str(cached_comp.rotation) != str(updated_comp.rotation)
-                atoms_changed = sum(1 for _ in cached_comp.atoms) != sum(1 for _ in updated_comp.atoms)
-                if position_changed or rotation_changed:
-                    needs_rescore = True
-                if atoms_changed:
-                    needs_rescore = True
-                    needs_stream_update = True
-                    break
-
-            # Update cached complexes
-            for i in range(len(self.complex_cache) - 1, -1, -1):
-                cached_comp = self.complex_cache[i]
-                if cached_comp.index in comp_indices:
-                    updated_version = next(cmp for cmp in updated_comps if cmp.index == cached_comp.index)
-                    if updated_version:
-                        Logs.debug("Updating cached complex")
-                        self.complex_cache[i] = updated_version
-            # Update ligand residues with updated complexes
-            if needs_stream_update:
-                Logs.message("Receptor or ligand modified. Recreating streams.")
-                await self.start_ligand_streams(self.ligand_atoms)
-            if needs_rescore:
-                Logs.message("Complex Positions changed. Rescoring Ligands.")
-                await self.score_ligands()
-            self.is_updating = False
+            await self.update_complexes()
+
+    @profiled_cycle
+    async def update_complexes(self):
+        """Rescore ligands if the receptor or ligand complexes moved or changed."""
+        Logs.debug("Updating cached ligands.")
+        self.is_updating = True
+
+        # Get updated complexes:
+        lig_comp_indices = set()
+        for res in self.ligand_residues:
+            lig_comp_indices.add(res.complex.index)
+
+        comp_indices = set([self.receptor_comp.index] + self.ensemble_indices + list(lig_comp_indices))
+        updated_comps = await self.request_complexes(comp_indices)
+        # If any of the complexes were deleted, destroy the streams
+        if any([comp is None for comp in updated_comps]):
+            Logs.message("Receptor or ligand deleted. Stopping streams.")
+            # Use the score button so that the UI is updated.
+            btn_score = self.menu.btn_score
+            btn_score.selected = False
+            self.menu.on_scoring_button_pressed(btn_score)
+            self.receptor_index = None
+            self.ligand_residue_indices = []
+            self.ensemble_indices = []
+            return
+
+        self.set_atoms_to_workspace_positions(updated_comps)
+        self.last_update = datetime.now()
+        # Check if positions have changed in workspace
+        needs_rescore = False
+        needs_stream_update = False
+        moved_indices = set()
+        cached_comps = {comp.index: comp for comp in self.complex_cache}
+        for updated_comp in updated_comps:
+            cached_comp = cached_comps[updated_comp.index]
+            position_changed = cached_comp.position.unpack() != updated_comp.position.unpack()
+            rotation_changed = str(cached_comp.rotation) != str(updated_comp.rotation)
+            atoms_changed = sum(1 for _ in cached_comp.atoms) != sum(1 for _ in updated_comp.atoms)
+            if position_changed or rotation_changed:
+                needs_rescore = True
+                moved_indices.add(updated_comp.index)
+            if atoms_changed:
+                needs_rescore = True
+                needs_stream_update = True
+                break
+
+        # Update cached complexes
+        for i in range(len(self.complex_cache) - 1, -1, -1):
+            cached_comp = self.complex_cache[i]
+            if cached_comp.index in comp_indices:
+                updated_version = next(cmp for cmp in updated_comps if cmp.index == cached_comp.index)
+                if updated_version:
+                    Logs.debug("Updating cached complex")
+                    self.complex_cache[i] = updated_version
+        # Update ligand residues with updated complexes
+        if needs_stream_update:
+            Logs.message("Receptor or ligand modified. Updating spheres and streams.")
+            await self.start_ligand_streams(self.ligand_atoms)
+        if self.prioritizing_poses:
+            # Every pose is out of date when the receptor moves, but
+            # the ones that moved themselves are scored first.
+            if needs_stream_update or self.receptor_index in moved_indices:
+                self.scheduler.invalidate()
+            self.scheduler.mark_moved(moved_indices)
+            needs_rescore = bool(self.scheduler.pending)
+        if needs_rescore:
+            Logs.message("Complex Positions changed. Rescoring Ligands.")
+            await self.score_ligands()
+        self.is_updating = False
 
     async def start_ligand_streams(self, ligand_atoms):
-        """Set up streams and Shapes used for rendering scoring results."""
-        self.destroy_spheres()
-        self.spheres = self.generate_spheres(self.ligand_atoms)
-        await Shape.upload_multiple(self.spheres)
+        """Set up streams and Shapes used for rendering scoring results.
+
+        Only spheres for added or removed atoms are uploaded or destroyed, and
+        streams are only recreated when the atoms they write to have changed.
+        """
+        ligand_atoms = list(ligand_atoms)
         atom_indices = [atom.index for atom in ligand_atoms]
+        self.spheres = await self.update_spheres(ligand_atoms)
+        if atom_indices == getattr(self, 'stream_atom_indices', None) and getattr(self, 'color_stream', None):
+            return
+        if getattr(self, 'color_stream', None):
+            self.stop_streams()
         sphere_indices = [sphere.index for sphere in self.spheres]
         self.label_stream, _ = await self.create_writing_stream(atom_indices, enums.StreamType.label)
         self.color_stream, _ = await self.create_writing_stream(sphere_indices, enums.StreamType.shape_color)
         self.size_stream, _ = await self.create_writing_stream(sphere_indices, enums.StreamType.sphere_shape_radius)
+        self.stream_atom_indices = atom_indices
+
+    async def update_spheres(self, ligand_atoms):
+        """Get a sphere for every ligand atom, reusing spheres that already exist."""
+        spheres_by_atom = {
+            sphere.anchors[0].target: sphere
+            for sphere in getattr(self, 'spheres', [])
+        }
+        atom_indices = set(atom.index for atom in ligand_atoms)
+        removed_spheres = [
+            sphere for atom_index, sphere in spheres_by_atom.items()
+            if atom_index not in atom_indices
+        ]
+        if removed_spheres:
+            Logs.debug(f"Destroying {len(removed_spheres)} spheres")
+            Shape.destroy_multiple(removed_spheres)
+        new_atoms = [atom for atom in ligand_atoms if atom.index not in spheres_by_atom]
+        if new_atoms:
+            Logs.debug(f"Uploading {len(new_atoms)} spheres")
+            new_spheres = self.generate_spheres(new_atoms)
+            await Shape.upload_multiple(new_spheres)
+            for atom, sphere in zip(new_atoms, new_spheres):
+                spheres_by_atom[atom.index] = sphere
+        return [spheres_by_atom[atom.index] for atom in ligand_atoms]
 
     @staticmethod
     def get_atoms(struct_list):
@@ -151,6 +313,24 @@ class RealtimeScoring(nanome.AsyncPluginInstance):
             if comp.index == self.receptor_index
         ), None)
 
+    @property
+    def receptor_comps(self):
+        """Get the receptor complexes of the ensemble being scored."""
+        cached = {comp.index: comp for comp in self.complex_cache}
+        return [cached[index] for index in self.ensemble_indices if index in cached]
+
+    @property
+    def scoring_ensemble(self):
+        return len(self.ensemble_indices) > 1
+
+    @property
+    def prioritizing_poses(self):
+        """Whether there are enough ligand complexes to score them progressively."""
+        if self.scoring_ensemble:
+            return False
+        pose_indices = set(res.complex.index for res in self.ligand_residues)
+        return len(pose_indices) >= self.prioritized_min_poses
+
     @property
     def ligand_residues(self):
         """Get the indices of all ligands."""
@@ -166,17 +346,21 @@ class RealtimeScoring(nanome.AsyncPluginInstance):
         """Set all atoms in a list of complexes to their positions in the workspace."""
         for comp in comp_list:
             # Update coordinates to be relative to workspace
-            mat = comp.get_complex_to_workspace_matrix()
-            for atom in comp.atoms:
-                atom._old_position = atom.position
-                atom.position = mat * atom.position
+            mat = utils.matrix_to_array(comp.get_complex_to_workspace_matrix())
+            atoms = list(comp.atoms)
+            positions = utils.transform_positions(utils.atom_positions(atoms), mat)
+            utils.set_atom_positions(atoms, positions)
 
-    async def setup_receptor_and_ligands(self, receptor_index, residue_indices):
+    async def setup_receptor_and_ligands(self, receptor_index, residue_indices, ensemble_indices=None):
         # Let's make sure we have deep receptor and ligand complexes
         self.receptor_index = receptor_index
         self.ligand_residue_indices = residue_indices
+        self.ensemble_indices = list(ensemble_indices or [receptor_index])
+        self.scheduler = PoseScheduler(self.refresh_budget.total_seconds())
+        self.settings.aggregate_only_usable = self.prioritizing_poses
         await self.start_ligand_streams(self.ligand_atoms)
 
+    @profiled_cycle
     async def score_ligands(self):
         if not getattr(self, 'receptor_comp', None):
             Logs.error("Receptor not set")
@@ -187,34 +371,270 @@ class RealtimeScoring(nanome.AsyncPluginInstance):
         if not getattr(self, 'ligand_residues', None):
             Logs.warning("Ligand Residues not specified")
             return
-        score_data = await self.calculate_scores(self.receptor_comp, self.ligand_residues)
-
-        # Concatenate all ligand results into a single list
+        if self.scoring_ensemble:
+            await self.score_ensemble()
+            return
+        if self.prioritizing_poses:
+            await self.score_prioritized()
+            return
+        # Render results as soon as each batch of ligands has been scored.
         all_atom_scores = []
+        aggregate_scores = []
+        residue_scores = []
+        options = self.scoring_options
+        async for score_data in self.iter_scores(
+                self.receptor_comp, self.ligand_residues, self.session_scoring_algorithm, **options):
+            for ligand_scores in score_data:
+                all_atom_scores += ligand_scores['atom_scores']
+                aggregate_scores.append(ligand_scores['aggregate_scores'])
+                residue_scores.append(ligand_scores.get('residue_scores', []))
+            await self.render_atom_scores(all_atom_scores)
+            self.menu.update_ligand_scores(aggregate_scores, residue_scores)
+
+    async def score_prioritized(self):
+        """Score the next batch of poses chosen by the scheduler.
+
+        Spheres and labels show the latest scores of every pose, and the
+        results panel ranks the best poses, updated after each pose is scored.
+        When scoring aggregate scores only, the ranked poses are then scored
+        in detail, so spheres and labels only show those.
+        """
+        residues_by_pose = {}
+        for res in self.ligand_residues:
+            residues_by_pose.setdefault(res.complex.index, []).append(res)
+        self.scheduler.update_poses(residues_by_pose)
+        batch = self.scheduler.next_batch()
+        Logs.debug(f"Scoring {len(batch)} of {len(residues_by_pose)} poses")
+        options = dict(self.scoring_options, aggregate_only=self.settings.aggregate_only)
+        # Algorithms that don't support aggregate only scoring always score in detail
+        detailed = not self.supported_options(options, self.session_scoring_algorithm).get('aggregate_only')
+        batch_residues = [res for key in batch for res in residues_by_pose[key]]
+        start_time = time.perf_counter()
+        async for score_data in self.iter_scores(
+                self.receptor_comp, batch_residues, self.session_scoring_algorithm, **options):
+            end_time = time.perf_counter()
+            secs = (end_time - start_time) / max(len(score_data), 1)
+            self.record_pose_scores(batch, score_data, secs, detailed)
+            start_time = end_time
+            await self.render_pose_scores(len(residues_by_pose))
+        if detailed:
+            return
+        detail_keys = self.scheduler.missing_detail(self.ranking_size)
+        if not detail_keys:
+            return
+        Logs.debug(f"Scoring {len(detail_keys)} ranked poses in detail")
+        detail_residues = [res for key in detail_keys for res in residues_by_pose[key]]
+        options['aggregate_only'] = False
+        async for score_data in self.iter_scores(
+                self.receptor_comp, detail_residues, self.session_scoring_algorithm, **options):
+            self.record_pose_scores(detail_keys, score_data)
+            await self.render_pose_scores(len(residues_by_pose))
+
+    def record_pose_scores(self, keys, score_data, secs=None, detailed=True):
+        """Store ligand scores in the scheduler by their complex index, which must be one of keys."""
         for ligand_scores in score_data:
+            key = ligand_scores.get('complex_index')
+            if key not in keys:
+                Logs.warning(f"Ignoring scores of complex {key}, which isn't one of the poses being scored.")
+                continue
+            self.scheduler.record(key, ligand_scores, secs, detailed)
+
+    async def render_pose_scores(self, pose_count):
+        """Render the latest scores of every pose, and rank the best ones."""
+        all_atom_scores = []
+        for ligand_scores in self.scheduler.results.values():
             all_atom_scores += ligand_scores['atom_scores']
+        await self.render_atom_scores(all_atom_scores)
+        self.menu.update_pose_ranking(
+            self.scheduler.ranking(self.ranking_size), len(self.scheduler.results), pose_count)
+
+    async def score_ensemble(self):
+        """Score ligands against every receptor of the ensemble.
 
-        aggregate_scores = [score['aggregate_scores'] for score in score_data]
+        Spheres and labels show the scores against each ligand's best receptor.
+        """
+        ensemble_scores = await self.calculate_ensemble_scores(
+            self.receptor_comps, self.ligand_residues, self.session_ensemble_scoring_algorithm)
+        summaries = self.summarize_ensemble(ensemble_scores)
+        all_atom_scores = []
+        for summary in summaries:
+            all_atom_scores += summary['atom_scores']
         await self.render_atom_scores(all_atom_scores)
-        self.menu.update_ligand_scores(aggregate_scores)
+        self.menu.update_ensemble_scores(summaries)
+
+    async def refine_poses(self):
+        """Move each ligand complex to the best pose found around its current pose.
+
+        Complexes share refine_budget, each getting an equal part of the time left,
+        and are moved as soon as a better pose is found. Ligands that are part of a
+        receptor complex can't be moved on their own, and are skipped.
+        """
+        receptor = self.receptor_comp
+        if not receptor:
+            Logs.error("Receptor not set")
+            return
+        residues_by_comp = {}
+        for res in self.ligand_residues:
+            residues_by_comp.setdefault(res.complex, []).append(res)
+        for comp in list(residues_by_comp):
+            if comp.index in self.ensemble_indices + [receptor.index]:
+                Logs.warning(f"Can't refine the pose of {comp.full_name}, its ligand is part of a receptor.")
+                del residues_by_comp[comp]
+        deadline = time.perf_counter() + self.refine_budget.total_seconds()
+        for i, (comp, residues) in enumerate(residues_by_comp.items()):
+            secs_left = deadline - time.perf_counter()
+            if secs_left <= 0:
+                Logs.message(f"Refine budget spent, {len(residues_by_comp) - i} ligand complexes weren't refined")
+                break
+            result = await self.calculate_refined_pose(
+                receptor, self.extract_ligand_comps(residues)[0], secs_left / (len(residues_by_comp) - i))
+            if not result or result['score'] >= result['initial_score']:
+                Logs.message(f"No better pose found for {comp.full_name}")
+                continue
+            Logs.message(
+                f"Refined pose of {comp.full_name} from {result['initial_score']:.3f} "
+                f"to {result['score']:.3f}, after {result['trials']} trial poses")
+            # Cached complexes are left as they are, so update() rescores the moved poses.
+            moved_comp = comp._shallow_copy(structure.Complex())
+            moved_comp.index = comp.index
+            utils.move_complex(moved_comp, result['transform'])
+            self.update_structures_shallow([moved_comp])
 
     @classmethod
-    async def calculate_scores(cls, receptor_comp, ligand_residues):
-        # write ligand residues to separate complex
-        ligand_comps = list(set([lig.complex for lig in ligand_residues]))
-        for i, lig in enumerate(ligand_comps):
-            ligand_comps[i] = utils.extract_residues_from_complex(lig, ligand_residues)
+    async def calculate_refined_pose(cls, receptor_comp, ligand_comp, budget_secs):
+        if inspect.iscoroutinefunction(cls.refine_algorithm):
+            return await cls.refine_algorithm(receptor_comp, ligand_comp, budget_secs)
+        return cls.refine_algorithm(receptor_comp, ligand_comp, budget_secs)
+
+    @classmethod
+    async def calculate_ensemble_scores(cls, receptor_comps, ligand_residues, algorithm=None):
+        """Score ligands against every receptor with algorithm, ensemble_scoring_algorithm by default."""
+        algorithm = algorithm or cls.ensemble_scoring_algorithm
+        ligand_comps = cls.extract_ligand_comps(ligand_residues)
+        if inspect.iscoroutinefunction(algorithm):
+            ensemble_scores = await algorithm(receptor_comps, ligand_comps)
+        else:
+            ensemble_scores = algorithm(receptor_comps, ligand_comps)
+        for receptor_scores in ensemble_scores:
+            cls.validate_scores(receptor_scores['ligand_scores'])
+        return ensemble_scores
+
+    @staticmethod
+    def summarize_ensemble(ensemble_scores):
+        """Get per receptor, best and mean aggregate scores of each ligand.
+
+        The best receptor is the one with the lowest total score, and its atom
+        and residue scores are kept for rendering.
+        """
+        summaries = []
+        ligand_count = len(ensemble_scores[0]['ligand_scores']) if ensemble_scores else 0
+        for i in range(ligand_count):
+            receptor_scores = [
+                (receptor_scores['receptor_index'], receptor_scores['ligand_scores'][i])
+                for receptor_scores in ensemble_scores
+                if receptor_scores['ligand_scores'][i]['aggregate_scores']
+            ]
+            if not receptor_scores:
+                continue
+            best_index, best_scores = min(
+                receptor_scores, key=lambda item: item[1]['aggregate_scores'][0]['total_score'])
+            aggregates = [ligand_scores['aggregate_scores'][0] for _, ligand_scores in receptor_scores]
+            mean_scores = {
+                name: round(sum(aggregate[name] for aggregate in aggregates) / len(aggregates), 3)
+                for name in aggregates[0]
+            }
+            summaries.append({
+                'complex_index': best_scores['complex_index'],
+                'receptor_scores': [
+                    (receptor_index, ligand_scores['aggregate_scores'][0])
+                    for receptor_index, ligand_scores in receptor_scores
+                ],
+                'best_receptor_index': best_index,
+                'best_scores': best_scores['aggregate_scores'][0],
+                'mean_scores': mean_scores,
+                'atom_scores': best_scores['atom_scores'],
+                'residue_scores': best_scores.get('residue_scores', []),
+            })
+        return summaries
+
+    @classmethod
+    async def calculate_scores(cls, receptor_comp, ligand_residues, algorithm=None, **options):
+        ligand_scores = []
+        async for score_data in cls.iter_scores(receptor_comp, ligand_residues, algorithm, **options):
+            ligand_scores.extend(score_data)
+        return ligand_scores
+
+    @classmethod
+    async def iter_scores(cls, receptor_comp, ligand_residues, algorithm=None, **options):
+        """Yield lists of validated ligand results as they become available.
+
+        Ligands are scored with algorithm, scoring_algorithm by default.
+        Async generator scoring algorithms produce one list per ligand,
+        other algorithms produce a single list containing every ligand.
+        Options are only passed on if the scoring algorithm accepts them.
+        """
+        algorithm = algorithm or cls.scoring_algorithm
+        options = cls.supported_options(options, algorithm)
+        ligand_comps = cls.extract_ligand_comps(ligand_residues)
+
+        if inspect.isasyncgenfunction(algorithm):
+            async for ligand_score in algorithm(receptor_comp, ligand_comps, **options):
+                cls.validate_scores([ligand_score])
+                yield [ligand_score]
+            return
 
         # Await scoring algorithm if it is a coroutine
-        if inspect.iscoroutinefunction(cls.scoring_algorithm):
-            ligand_scores = await cls.scoring_algorithm(receptor_comp, ligand_comps)
+        if inspect.iscoroutinefunction(algorithm):
+            ligand_scores = await algorithm(receptor_comp, ligand_comps, **options)
         else:
-            ligand_scores = cls.scoring_algorithm(receptor_comp, ligand_comps)
+            ligand_scores = algorithm(receptor_comp, ligand_comps, **options)
+        cls.validate_scores(ligand_scores)
+        yield ligand_scores
+
+    @staticmethod
+    def extract_ligand_comps(ligand_residues):
+        """Write ligand residues to a separate complex for each complex they belong to.
+
+        Complexes are in the order their first residue appears in ligand_residues,
+        and keep the index of the complex they were extracted from, so scores can
+        be matched to it by their complex_index.
+        """
+        ligand_comps = list(dict.fromkeys(lig.complex for lig in ligand_residues))
+        for i, lig in enumerate(ligand_comps):
+            ligand_comps[i] = utils.extract_residues_from_complex(lig, ligand_residues)
+            ligand_comps[i].index = lig.index
+        return ligand_comps
+
+    @classmethod
+    def supported_options(cls, options, algorithm=None):
+        """Filter out options that aren't parameters of algorithm, scoring_algorithm by default."""
+        parameters = inspect.signature(algorithm or cls.scoring_algorithm).parameters
+        return {name: value for name, value in options.items() if name in parameters}
 
+    @property
+    def session_scoring_algorithm(self):
+        """Scoring algorithm of this session, which scores on the scoring workers if there are any."""
+        if self.dispatcher:
+            return self.dispatcher.score_ligands
+        return type(self).scoring_algorithm
+
+    @property
+    def session_ensemble_scoring_algorithm(self):
+        """Ensemble scoring algorithm of this session, which scores on the scoring workers if there are any."""
+        if self.dispatcher:
+            return self.dispatcher.score_ensemble
+        return type(self).ensemble_scoring_algorithm
+
+    @property
+    def scoring_options(self):
+        """Keyword arguments passed to scoring algorithms that support them."""
+        return {'incremental': self.incremental_scoring}
+
+    @staticmethod
+    def validate_scores(ligand_scores):
         validation_errors = ScoringOutputSchema(many=True).validate(ligand_scores)
         if validation_errors:
             raise ValueError("Validation errors: ", validation_errors)
-        return ligand_scores
 
     async def render_atom_scores(self, score_data):
         # Update the sphere color around each atom
@@ -322,20 +742,29 @@ class RealtimeScoring(nanome.AsyncPluginInstance):
         self.color_stream = None
         self.label_stream = None
         self.size_stream = None
+        self.stream_atom_indices = None
 
     def stop_scoring(self):
         self.stop_streams()
         self.destroy_spheres()
+        self.settings.aggregate_only_usable = True
 
     def destroy_spheres(self):
         if getattr(self, 'spheres', False):
             Shape.destroy_multiple(self.spheres)
+        self.spheres = []
 
     def on_advanced_settings(self):
         self.settings.open_menu()
 
     @async_callback
     async def on_complex_list_changed(self):
-        comp_list = await self.request_complex_list()
-        self.complex_cache = await self.request_complexes([cmp.index for cmp in comp_list])
+        self.complex_list = await self.request_complex_list()
+        # Drop deep complexes that were removed from the workspace
+        comp_indices = set(comp.index for comp in self.complex_list)
+        self.complex_cache = [
+            comp for comp in self.complex_cache
+            if comp.index in comp_indices
+        ]
         await self.menu.render()
+        self.menu.prefetch_ligands()
@@ -18,6 +18,24 @@ class SettingsMenu():
         self._btn_labels.toggle_on_press = True
         self._btn_labels.selected = False
 
+        self._btn_ensemble: ui.Button = self._menu.root.find_node('EnsembleButton').get_content()
+        self._btn_ensemble.toggle_on_press = True
+        self._btn_ensemble.selected = False
+
+        self._btn_aggregate_only: ui.Button = self._menu.root.find_node('AggregateOnlyButton').get_content()
+        self._btn_aggregate_only.toggle_on_press = True
+        self._btn_aggregate_only.selected = False
+        self._btn_aggregate_only.register_pressed_callback(self.on_aggregate_only_pressed)
+        # Only poses scored progressively are scored aggregate only
+        ln_aggregate_only: ui.LayoutNode = self._menu.root.find_node('Aggregate Only')
+        self._lbl_aggregate_only: ui.Label = ln_aggregate_only.find_node('Label').get_content()
+        self._lbl_aggregate_only.text_value = f"Only Rank Scores ({plugin.prioritized_min_poses}+ Poses)"
+
+        self._btn_profile: ui.Button = self._menu.root.find_node('ProfileButton').get_content()
+        self._btn_profile.toggle_on_press = True
+        self._btn_profile.selected = False
+        self._btn_profile.register_pressed_callback(self.on_profile_pressed)
+
         self._btn_score_all_frames: ui.Button = self._menu.root.find_node('AllFramesButton').get_content()
         self._btn_score_all_frames.toggle_on_press = True
         self._btn_score_all_frames.selected = False
@@ -43,6 +61,55 @@ class SettingsMenu():
         self._btn_labels.selected = value
         self._plugin.update_content(self._btn_labels)
 
+    def on_aggregate_only_pressed(self, button):
+        # Rescore every pose in the new mode.
+        self._plugin.scheduler.invalidate()
+
+    @property
+    def aggregate_only(self):
+        """Whether poses scored progressively only get total and per contact scores.
+
+        Per atom and residue scores are still calculated for the ranked poses,
+        and for ligands that aren't scored progressively.
+        """
+        return self._btn_aggregate_only.selected
+
+    @aggregate_only.setter
+    def aggregate_only(self, value):
+        self._btn_aggregate_only.selected = value
+        self._plugin.update_content(self._btn_aggregate_only)
+
+    @property
+    def aggregate_only_usable(self):
+        """Whether aggregate only scoring applies to the poses being scored, the button is unusable otherwise."""
+        return not self._btn_aggregate_only.unusable
+
+    @aggregate_only_usable.setter
+    def aggregate_only_usable(self, value):
+        self._btn_aggregate_only.unusable = not value
+        self._plugin.update_content(self._btn_aggregate_only)
+
+    def on_profile_pressed(self, button):
+        if button.selected:
+            self._plugin.start_profiling()
+        else:
+            self._plugin.stop_profiling()
+
+    @property
+    def profiling(self):
+        """Whether the next update and scoring cycles are being profiled."""
+        return self._btn_profile.selected
+
+    @profiling.setter
+    def profiling(self, value):
+        self._btn_profile.selected = value
+        self._plugin.update_content(self._btn_profile)
+
+    @property
+    def score_ensembles(self):
+        """Whether several receptors can be selected, and ligands scored against each of them."""
+        return self._btn_ensemble.selected
+
     @property
     def score_all_frames(self):
         return self._btn_score_all_frames.selected
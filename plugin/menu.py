@@ -1,11 +1,16 @@
+import itertools
 import nanome
 from os import path
 from nanome.api import ui
 from nanome.util import Logs, async_callback
 from nanome.util.enums import NotificationTypes
 
+from plugin import utils
+
 BASE_PATH = path.dirname(f'{path.realpath(__file__)}')
 MENU_PATH = path.join(BASE_PATH, 'menu_json', 'menu.json')
+# Number of receptor residues listed under each ligand in the results panel
+TOP_RESIDUE_COUNT = 5
 
 
 class MainMenu:
@@ -21,12 +26,19 @@ class MainMenu:
         self.btn_score: ui.Button = self._menu.root.find_node("btn_score", True).get_content()
         self.btn_score.register_pressed_callback(self.on_scoring_button_pressed)
         self.btn_score.toggle_on_press = True
+        self.ln_refine: ui.LayoutNode = self._menu.root.find_node("btn_refine", True)
+        self.btn_refine: ui.Button = self.ln_refine.get_content()
+        self.btn_refine.register_pressed_callback(self.on_refine_pressed)
 
         self._pfb_complex = nanome.ui.LayoutNode()
         pfb_btn = self._pfb_complex.add_new_button()
         pfb_btn.toggle_on_press = True
         self._pfb_result = nanome.ui.LayoutNode()
         self._pfb_result.add_new_label()
+        # (topology fingerprint, ligands) of the current molecule of each complex,
+        # by complex index. Ligands are (name, residue indices) tuples.
+        self.ligand_cache = {}
+        self._detecting_indices = set()
 
     @async_callback
     async def on_scoring_button_pressed(self, button):
@@ -37,7 +49,9 @@ class MainMenu:
         self.plugin.update_content(button)
 
     async def start_scoring(self):
+        await self.load_selected_complexes()
         receptor_index = self.receptor_index
+        receptor_indices = self.receptor_indices
         residue_indices = self.ligand_residue_indices
         Logs.message("Start Scoring")
         Logs.debug(f"Residue Count: {len(residue_indices)}")
@@ -45,6 +59,7 @@ class MainMenu:
             # Don't switch panels if realtime is enabled
             self.ln_selection.enabled = False
             self.ln_results.enabled = True
+            self.ln_refine.enabled = True
 
         if receptor_index is None:
             self.plugin.send_notification(
@@ -67,7 +82,7 @@ class MainMenu:
             self.plugin.update_menu(self._menu)
 
         await self.plugin.setup_receptor_and_ligands(
-            receptor_index, residue_indices)
+            receptor_index, residue_indices, receptor_indices)
         await self.plugin.score_ligands()
         if self.plugin.realtime_enabled:
             self._menu.title = "Scores"
@@ -77,8 +92,17 @@ class MainMenu:
         self.plugin.stop_scoring()
         self.ln_selection.enabled = True
         self.ln_results.enabled = False
+        self.ln_refine.enabled = False
         self.plugin.update_menu(self._menu)
 
+    @async_callback
+    async def on_refine_pressed(self, button):
+        button.unusable = True
+        self.plugin.update_content(button)
+        await self.plugin.refine_poses()
+        button.unusable = False
+        self.plugin.update_content(button)
+
     @async_callback
     async def render(self, force_enable=False):
         if not self.plugin.realtime_enabled:
@@ -89,9 +113,9 @@ class MainMenu:
             self.btn_score.toggle_on_press = False
             self.btn_score.disable_on_press = True
             self.plugin.update_content(self.btn_score)
-        complex_list = self.plugin.complex_cache
+        complex_list = self.plugin.complex_list
         self.populate_list(self._ls_receptors, complex_list, self.on_receptor_pressed)
-        self.populate_list(self._ls_ligands, complex_list)
+        self.populate_list(self._ls_ligands, complex_list, self.on_ligand_pressed)
         if force_enable:
             self._menu.enabled = True
         self.plugin.update_menu(self._menu)
@@ -103,6 +127,14 @@ class MainMenu:
             if item.get_content().selected:
                 return item.get_content().index
 
+    @property
+    def receptor_indices(self):
+        """Get the complex indices of every selected receptor button."""
+        return [
+            item.get_content().index for item in self._ls_receptors.items
+            if item.get_content().selected
+        ]
+
     @property
     def ligand_residue_indices(self):
         """Get the list of residues from the currently selected buttons."""
@@ -113,66 +145,146 @@ class MainMenu:
                 residues.extend(btn.residue_indices)
         return residues
 
+    @property
+    def selected_complex_indices(self):
+        """Get indices of the receptor and ligand complexes currently selected."""
+        comp_indices = set(self.receptor_indices)
+        for item in self._ls_ligands.items:
+            btn = item.get_content()
+            if btn.selected:
+                comp_indices.add(btn.index)
+        return comp_indices
+
+    async def load_ligand_button(self, ligand_btn):
+        """Fetch the deep complex of a ligand button, and store its residue indices the first time."""
+        # The deep complex may have been evicted since the button was last selected.
+        comp = (await self.plugin.fetch_complexes([ligand_btn.index]))[0]
+        if comp and not hasattr(ligand_btn, 'residue_indices'):
+            ligand_btn.residue_indices = [res.index for res in comp.residues]
+
+    async def load_selected_complexes(self):
+        """Make sure deep complexes are available for every selected button."""
+        if self.receptor_indices:
+            await self.plugin.fetch_complexes(self.receptor_indices)
+        for item in self._ls_ligands.items:
+            btn = item.get_content()
+            if btn.selected:
+                await self.load_ligand_button(btn)
+
+    @async_callback
+    async def on_ligand_pressed(self, ligand_btn):
+        if ligand_btn.selected:
+            await self.load_ligand_button(ligand_btn)
+        else:
+            self.plugin.evict_complexes(self.selected_complex_indices)
+
     @async_callback
     async def on_receptor_pressed(self, receptor_btn):
-        # Deselect every other receptor button
-        for item in self._ls_receptors.items:
-            item_btn = item.get_content()
-            item_btn.selected = \
-                item_btn._content_id == receptor_btn._content_id
+        # Deselect every other receptor button, unless scoring an ensemble of receptors
+        ensemble = self.plugin.settings.score_ensembles
+        if not ensemble:
+            for item in self._ls_receptors.items:
+                item_btn = item.get_content()
+                item_btn.selected = \
+                    item_btn._content_id == receptor_btn._content_id
 
-        # Remove previously extracted ligand items from list
+        # Remove ligand items extracted from receptors that are no longer selected
         # Iterate in reverse order for simpler deletions
+        receptor_indices = self.receptor_indices
         for i in range(len(self._ls_ligands.items) - 1, -1, -1):
             item = self._ls_ligands.items[i]
             item_btn = item.get_content()
-            if hasattr(item_btn, 'extracted_ligand'):
+            if hasattr(item_btn, 'extracted_ligand') and (not ensemble or item_btn.index not in receptor_indices):
                 self._ls_ligands.items.remove(item)
+        if not receptor_btn.selected:
+            self.plugin.evict_complexes(self.selected_complex_indices)
+            self.disable_receptor_ligands()
+            self.plugin.update_menu(self._menu)
+            return
 
-        # Extract ligands from receptor, and add as entry to ligand list
+        # Extract ligands from receptor, and add as entry to ligand list.
+        # The receptor is requested again in case it was edited, but its ligands
+        # are only detected again if its topology changed.
         receptor_index = receptor_btn.index
-        complex_list = self.plugin.complex_cache
-        receptor = next(
-            cmp for cmp in complex_list
-            if cmp.index == receptor_index)
-        mol = next(
-            ml for i, ml in enumerate(receptor.molecules)
-            if i == receptor.current_frame)
-        ligands = await mol.get_ligands()
-        mol_size_is_1 = sum(1 for _ in mol.residues) == 1
-        ligand_count_is_1 = len(ligands) == 1
+        receptor = (await self.plugin.fetch_complexes([receptor_index], refresh=True))[0]
+        self.plugin.evict_complexes(self.selected_complex_indices)
+        if not receptor:
+            Logs.warning("Selected receptor is no longer in the workspace.")
+            return
         # Create new button for every ligand.
-        for lig in ligands:
-            # Molecules with 1 residue should use the residue name instead of ligand name
-            # Workaround for naming bug when ligand is split from receptor
-            if mol_size_is_1 and ligand_count_is_1:
-                ligand_name = next(lig.residues).name
-            else:
-                ligand_name = lig.name
-            residue = next(lig.residues)
+        for ligand_name, residue_indices in await self.get_receptor_ligands(receptor):
             clone = self._pfb_complex.clone()
             btn = clone.get_content()
             btn.text.value.set_all(ligand_name)
             btn.index = receptor.index
-            btn.residue_indices = [res.index for res in lig.residues]
+            btn.residue_indices = residue_indices
             btn.extracted_ligand = True
-            # make sure structure tree is stored on residue, we will need it later
-            for residue in lig.residues:
-                # Find the chain that this residue belongs to, and set parent
-                res_chain = next(
-                    chain for chain in mol.chains
-                    if chain.name == residue.chain.name
-                )
-                residue._parent = res_chain
             self._ls_ligands.items.append(clone)
 
-        # Disable corresponding ligand button for selected receptor
+        self.disable_receptor_ligands()
+        self.plugin.update_menu(self._menu)
+
+    @async_callback
+    async def prefetch_ligands(self):
+        """Detect the ligands of listed complexes in the background.
+
+        Deep complexes are requested one at a time, for complexes whose ligands
+        aren't known yet, and only their ligands are kept, so that pressing a
+        receptor doesn't wait for ligand detection.
+        """
+        listed_indices = [comp.index for comp in self.plugin.complex_list]
+        for index in set(self.ligand_cache) - set(listed_indices):
+            del self.ligand_cache[index]
+        for index in listed_indices:
+            if index in self.ligand_cache or index in self._detecting_indices:
+                continue
+            self._detecting_indices.add(index)
+            try:
+                comp = (await self.plugin.request_complexes([index]))[0]
+                if comp:
+                    await self.get_receptor_ligands(comp)
+            finally:
+                self._detecting_indices.discard(index)
+
+    async def get_receptor_ligands(self, receptor):
+        """Get the ligands of a deep complex, only detecting them again if its topology changed."""
+        mol = next(
+            ml for i, ml in enumerate(receptor.molecules)
+            if i == receptor.current_frame)
+        fingerprint = utils.topology_fingerprint(mol)
+        cached = self.ligand_cache.get(receptor.index)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        ligands = await self.detect_ligands(mol)
+        self.ligand_cache[receptor.index] = (fingerprint, ligands)
+        return ligands
+
+    @staticmethod
+    async def detect_ligands(mol):
+        """Get the (name, residue indices) of every ligand in a molecule."""
+        ligands = await mol.get_ligands()
+        # Molecules with 1 residue should use the residue name instead of ligand name
+        # Workaround for naming bug when ligand is split from receptor
+        use_residue_name = len(ligands) == 1 and len(list(itertools.islice(mol.residues, 2))) == 1
+        chains = {chain.name: chain for chain in mol.chains}
+        detected = []
+        for lig in ligands:
+            residues = list(lig.residues)
+            ligand_name = residues[0].name if use_residue_name else lig.name
+            # make sure structure tree is stored on residue, we will need it later
+            for residue in residues:
+                residue._parent = chains[residue.chain.name]
+            detected.append((ligand_name, [res.index for res in residues]))
+        return detected
+
+    def disable_receptor_ligands(self):
+        """Disable the ligand buttons of selected receptors."""
+        receptor_names = set(
+            item.get_content().text.value.selected for item in self._ls_receptors.items
+            if item.get_content().selected)
         for item in self._ls_ligands.items:
             ligand_btn = item.get_content()
-            receptor_btn_txt = receptor_btn.text.value.selected
-            ligand_btn_txt = ligand_btn.text.value.selected
-            ligand_btn.unusable = receptor_btn_txt == ligand_btn_txt
-        self.plugin.update_menu(self._menu)
+            ligand_btn.unusable = ligand_btn.text.value.selected in receptor_names
 
     def populate_list(self, ui_list, complex_list, callback=None):
         ui_list.items = []
@@ -181,23 +293,86 @@ class MainMenu:
             btn = clone.get_content()
             btn.text.value.set_all(comp.full_name)
             btn.index = comp.index
-            btn.residue_indices = [res.index for res in comp.residues]
             if callback:
                 btn.register_pressed_callback(callback)
             ui_list.items.append(clone)
         self.plugin.update_content(ui_list)
 
-    def update_ligand_scores(self, aggregate_score_list):
+    def update_ligand_scores(self, aggregate_score_list, residue_score_list=None):
+        """Show aggregate scores, and top contributing residues, of every ligand scored so far."""
         results_list = self.ln_results.get_content()
         results_list.items = []
-        scores_set = aggregate_score_list[0]
-        if not scores_set:
+        if not any(aggregate_score_list):
             Logs.warning("No aggregate scores returned by scoring algorithm.")
             return
-        scores = scores_set[0]
-        for name, score in scores.items():
-            clone = self._pfb_result.clone()
-            lbl = clone._get_content()
-            lbl.text_value = '{}: {}'.format(name, score)
-            results_list.items.append(clone)
+        residue_score_list = residue_score_list or []
+        # Prefix rows with the ligand number when there is more than one ligand
+        multiple_ligands = len(aggregate_score_list) > 1
+        for i, scores_set in enumerate(aggregate_score_list, 1):
+            if not scores_set:
+                continue
+            prefix = 'Ligand {} '.format(i) if multiple_ligands else ''
+            scores = scores_set[0]
+            for name, score in scores.items():
+                self.add_result_row(results_list, '{}{}: {}'.format(prefix, name, score))
+            if i <= len(residue_score_list):
+                for residue, score in self.top_residues(residue_score_list[i - 1]):
+                    text = '{}{} {}: {:.2f}'.format(prefix, residue.name, residue.serial, score)
+                    self.add_result_row(results_list, text)
         self.plugin.update_content(results_list)
+
+    def update_ensemble_scores(self, ensemble_summaries):
+        """Show each ligand's scores against every receptor, and its best and mean scores."""
+        results_list = self.ln_results.get_content()
+        results_list.items = []
+        if not ensemble_summaries:
+            Logs.warning("No aggregate scores returned by ensemble scoring algorithm.")
+            return
+        receptor_names = {comp.index: comp.full_name for comp in self.plugin.receptor_comps}
+        multiple_ligands = len(ensemble_summaries) > 1
+        for i, summary in enumerate(ensemble_summaries, 1):
+            prefix = 'Ligand {} '.format(i) if multiple_ligands else ''
+            for receptor_index, scores in summary['receptor_scores']:
+                receptor_name = receptor_names.get(receptor_index, receptor_index)
+                text = '{}{} {}'.format(prefix, receptor_name, self.format_scores(scores))
+                self.add_result_row(results_list, text)
+            best_name = receptor_names.get(summary['best_receptor_index'], summary['best_receptor_index'])
+            best_scores = self.format_scores(summary['best_scores'])
+            self.add_result_row(results_list, '{}best ({}) {}'.format(prefix, best_name, best_scores))
+            self.add_result_row(results_list, '{}mean {}'.format(prefix, self.format_scores(summary['mean_scores'])))
+        self.plugin.update_content(results_list)
+
+    def update_pose_ranking(self, ranking, scored_count, pose_count):
+        """Show the best poses scored so far, and how many poses have been scored."""
+        results_list = self.ln_results.get_content()
+        results_list.items = []
+        if scored_count < pose_count:
+            self.add_result_row(results_list, 'Scored {}/{} poses'.format(scored_count, pose_count))
+        comp_names = {comp.index: comp.full_name for comp in self.plugin.complex_cache}
+        for rank, (comp_index, ligand_scores) in enumerate(ranking, 1):
+            name = comp_names.get(comp_index, comp_index)
+            text = '#{} {} {}'.format(rank, name, self.format_scores(ligand_scores['aggregate_scores'][0]))
+            self.add_result_row(results_list, text)
+        self.plugin.update_content(results_list)
+
+    @staticmethod
+    def format_scores(scores):
+        return ', '.join('{}: {}'.format(name, score) for name, score in scores.items())
+
+    def add_result_row(self, results_list, text):
+        clone = self._pfb_result.clone()
+        lbl = clone._get_content()
+        lbl.text_value = text
+        results_list.items.append(clone)
+
+    def top_residues(self, residue_scores, count=TOP_RESIDUE_COUNT):
+        """Get the receptor residues with the most favorable (lowest) scores."""
+        receptor = self.plugin.receptor_comp
+        if not receptor or not residue_scores:
+            return []
+        residues = {res.index: res for res in receptor.residues}
+        ranked = sorted(residue_scores, key=lambda residue_score: residue_score[1])
+        return [
+            (residues[res_index], score) for res_index, score in ranked
+            if res_index in residues
+        ][:count]
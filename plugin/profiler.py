@@ -0,0 +1,107 @@
+import cProfile
+import functools
+import os
+import pstats
+import tempfile
+from collections import defaultdict
+from datetime import datetime
+from nanome.util import Logs
+
+from dsx import scoring_algo
+
+__all__ = ['CycleProfiler', 'profiled_cycle']
+
+
+# Number of hot spots logged once a capture is finished.
+HOT_SPOT_COUNT = 10
+
+
+class CycleProfiler:
+    """Profile the next few update and scoring cycles of a plugin.
+
+    Coroutines are profiled with cProfile while a cycle is running. Time spent
+    waiting on child processes doesn't show up there, so the processes run by
+    the cycle are timed through a scoring_algo process hook, and added to the
+    stats as '~child-process' entries named by their label. Stats are written in pstats format once
+    cycle_count cycles have finished, and the top hot spots are logged.
+    """
+
+    def __init__(self, cycle_count, path=None, on_finished=None):
+        self.cycle_count = cycle_count
+        self.path = path or os.path.join(
+            tempfile.gettempdir(), f'realtime-scoring-{datetime.now():%Y%m%d-%H%M%S}.pstats')
+        self.on_finished = on_finished
+        self.cycles = 0
+        self.finished = False
+        self.profile = cProfile.Profile()
+        # Label of each child process, to (call count, total seconds)
+        self.child_times = defaultdict(lambda: [0, 0.0])
+        self._depth = 0
+
+    def begin_cycle(self):
+        self._depth += 1
+        if self._depth == 1:
+            scoring_algo.add_process_hook(self.record_child_process)
+            self.profile.enable()
+
+    def end_cycle(self):
+        self._depth -= 1
+        if self._depth:
+            return
+        self.profile.disable()
+        scoring_algo.remove_process_hook(self.record_child_process)
+        self.cycles += 1
+        if self.cycles >= self.cycle_count:
+            self.finish()
+
+    def finish(self):
+        """Write stats and log hot spots, even if fewer cycles than requested were profiled."""
+        if self.finished:
+            return
+        self.finished = True
+        if self._depth:
+            self.profile.disable()
+        stats = self.stats()
+        stats.dump_stats(self.path)
+        Logs.message(f"Profiled {self.cycles} cycles to {self.path}")
+        for line in self.hot_spots(stats):
+            Logs.message(line)
+        if self.on_finished:
+            self.on_finished(self)
+
+    def stats(self):
+        stats = pstats.Stats(self.profile)
+        for name, (calls, secs) in self.child_times.items():
+            stats.stats[('~child-process', 0, name)] = (calls, calls, secs, secs, {})
+        return stats
+
+    def hot_spots(self, stats, count=HOT_SPOT_COUNT):
+        """Get lines describing the functions with the most time spent in them, and child processes."""
+        ranked = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:count]
+        lines = ["Hot spots (own time, cumulative time, calls):"]
+        for (filename, line, name), (_, calls, own_secs, cumulative_secs, _) in ranked:
+            location = f'{os.path.basename(filename)}:{line}' if line else filename
+            lines.append(f"  {own_secs:.3f}s {cumulative_secs:.3f}s {calls} {name} ({location})")
+        return lines
+
+    def record_child_process(self, label, secs):
+        if self.finished:
+            return
+        times = self.child_times[label]
+        times[0] += 1
+        times[1] += secs
+
+
+def profiled_cycle(method):
+    """Profile calls of a plugin coroutine method as cycles, while its profiler is capturing."""
+    @functools.wraps(method)
+    async def wrapper(plugin, *args, **kwargs):
+        profiler = getattr(plugin, 'profiler', None)
+        if profiler is None or profiler.finished:
+            return await method(plugin, *args, **kwargs)
+        profiler.begin_cycle()
+        try:
+            return await method(plugin, *args, **kwargs)
+        finally:
+            profiler.end_cycle()
+    return wrapper
@@ -0,0 +1,129 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+from nanome.api import structure
+from nanome.util import Logs, Quaternion, Vector3
+
+from plugin import utils
+
+__all__ = ['SessionRecorder', 'load_trace', 'build_complex']
+
+
+TRACE_VERSION = 1
+
+
+class SessionRecorder:
+    """Record the complexes a plugin session receives, so it can be replayed offline.
+
+    Wraps the plugin's request_complexes and setup_receptor_and_ligands. Every
+    distinct structure is stored once, as PDB text along with its atom and
+    residue indices, and every response is stored as the time it was received
+    with the transform and structure of each complex.
+    """
+
+    def __init__(self, plugin, path):
+        self.plugin = plugin
+        self.path = path
+        self.clock = time.perf_counter
+        self.start_time = self.clock()
+        self.structures = {}
+        self.events = []
+        self._request_complexes = plugin.request_complexes
+        self._setup_receptor_and_ligands = plugin.setup_receptor_and_ligands
+
+    def attach(self):
+        self.plugin.request_complexes = self.request_complexes
+        self.plugin.setup_receptor_and_ligands = self.setup_receptor_and_ligands
+
+    async def request_complexes(self, id_list, callback=None):
+        complexes = await self._request_complexes(id_list, callback)
+        self.record_complexes(complexes)
+        return complexes
+
+    async def setup_receptor_and_ligands(self, receptor_index, residue_indices, ensemble_indices=None):
+        self.record_selection(receptor_index, residue_indices, ensemble_indices)
+        return await self._setup_receptor_and_ligands(receptor_index, residue_indices, ensemble_indices)
+
+    def record_complexes(self, complexes):
+        """Record complexes, before any of their atoms are moved to workspace positions."""
+        entries = []
+        for comp in complexes:
+            if comp is None:
+                continue
+            entries.append({
+                'index': comp.index,
+                'structure': self.add_structure(comp),
+                'position': list(comp.position.unpack()),
+                'rotation': [comp.rotation.x, comp.rotation.y, comp.rotation.z, comp.rotation.w],
+            })
+        self.events.append({'type': 'complexes', 'time': self.elapsed(), 'complexes': entries})
+
+    def record_selection(self, receptor_index, residue_indices, ensemble_indices=None):
+        self.events.append({
+            'type': 'select', 'time': self.elapsed(),
+            'receptor_index': receptor_index,
+            'ligand_residue_indices': list(residue_indices),
+            'ensemble_indices': list(ensemble_indices or []),
+        })
+
+    def add_structure(self, comp):
+        """Store the structure of comp if it wasn't seen before, and return its key."""
+        atoms = list(comp.atoms)
+        atom_indices = [atom.index for atom in atoms]
+        digest = hashlib.sha1(str(atom_indices).encode())
+        digest.update(utils.atom_positions(atoms).tobytes())
+        key = digest.hexdigest()[:16]
+        if key not in self.structures:
+            with tempfile.NamedTemporaryFile(suffix='.pdb') as pdb_file:
+                comp.io.to_pdb(pdb_file.name)
+                pdb_text = pdb_file.read().decode()
+            self.structures[key] = {
+                'name': comp.full_name,
+                'pdb': pdb_text,
+                'atom_indices': atom_indices,
+                'residue_indices': [residue.index for residue in comp.residues],
+            }
+        return key
+
+    def elapsed(self):
+        return self.clock() - self.start_time
+
+    def save(self, path=None):
+        path = path or self.path
+        trace = {'version': TRACE_VERSION, 'structures': self.structures, 'events': self.events}
+        with gzip.open(path, 'wt') as f:
+            json.dump(trace, f)
+        Logs.message(f"Recorded {len(self.events)} events to {os.path.abspath(path)}")
+        return path
+
+
+def load_trace(path):
+    with gzip.open(path, 'rt') as f:
+        trace = json.load(f)
+    if trace.get('version') != TRACE_VERSION:
+        raise ValueError(f"Unsupported trace version {trace.get('version')}")
+    return trace
+
+
+def build_complex(structure_data, entry, template=None):
+    """Create a deep complex from a recorded structure and complex entry.
+
+    Copying a template complex previously built from the same structure is
+    much faster than parsing the PDB text again.
+    """
+    if template is not None:
+        comp = template._deep_copy()
+    else:
+        comp = structure.Complex.io.from_pdb(string=structure_data['pdb'])
+    comp.index = entry['index']
+    comp.full_name = structure_data['name']
+    comp.position = Vector3(*entry['position'])
+    comp.rotation = Quaternion(*entry['rotation'])
+    for atom, index in zip(comp.atoms, structure_data['atom_indices']):
+        atom.index = index
+    for residue, index in zip(comp.residues, structure_data['residue_indices']):
+        residue.index = index
+    return comp
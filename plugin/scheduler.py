@@ -0,0 +1,124 @@
+import time
+
+__all__ = ['PoseScheduler']
+
+
+# Assumed time to score a pose, until one has been timed.
+DEFAULT_POSE_SECS = 0.25
+# Weight of the latest pose in the moving average of scoring times.
+POSE_SECS_WEIGHT = 0.2
+
+
+class PoseScheduler:
+    """Choose which poses to score next, when there are too many to rescore every update.
+
+    Poses are keyed by the index of their ligand complex. Poses that moved are
+    always scored, most recently moved first. Poses without a current score
+    are then refreshed, oldest score first, for as long as the time they are
+    expected to take fits in the budget. At least one pose is scored whenever
+    any are pending, so the whole set is eventually refreshed.
+
+    Poses scored with aggregate scores only can be scored again in detail,
+    best ranked first, see missing_detail.
+    """
+
+    def __init__(self, budget_secs, pose_secs=DEFAULT_POSE_SECS):
+        self.budget_secs = budget_secs
+        # Moving average of the time taken to score a pose.
+        self.pose_secs = pose_secs
+        self.clock = time.monotonic
+        self.keys = []
+        # Latest ligand scores, and the time they were recorded
+        self.results = {}
+        self.scored_at = {}
+        # Time poses moved, since they were last scored
+        self.moved_at = {}
+        # Poses whose scores are out of date, but that didn't move themselves
+        self.stale = set()
+        # Poses whose latest scores include per atom and residue scores
+        self.detailed = set()
+
+    def update_poses(self, keys):
+        """Set the poses being scored, and forget about any others."""
+        self.keys = list(keys)
+        keep = set(self.keys)
+        for state in [self.results, self.scored_at, self.moved_at]:
+            for key in set(state) - keep:
+                del state[key]
+        self.stale &= keep
+        self.detailed &= keep
+
+    def mark_moved(self, keys):
+        now = self.clock()
+        for key in keys:
+            if key in self.keys:
+                self.moved_at[key] = now
+
+    def invalidate(self, keys=None):
+        """Mark poses as needing a refresh, every pose if keys is None."""
+        self.stale.update(self.keys if keys is None else set(keys) & set(self.keys))
+
+    @property
+    def pending(self):
+        """Get the poses that moved, are stale, or were never scored."""
+        return [
+            key for key in self.keys
+            if key in self.moved_at or key in self.stale or key not in self.results
+        ]
+
+    def next_batch(self):
+        """Get the keys of the poses to score next, in order."""
+        pending = self.pending
+        moved = sorted(
+            (key for key in pending if key in self.moved_at),
+            key=lambda key: self.moved_at[key], reverse=True)
+        refresh = sorted(
+            (key for key in pending if key not in self.moved_at),
+            key=lambda key: self.scored_at.get(key, float('-inf')))
+        batch = moved
+        budget = self.budget_secs - len(moved) * self.pose_secs
+        for key in refresh:
+            if batch and budget < self.pose_secs:
+                break
+            batch.append(key)
+            budget -= self.pose_secs
+        return batch
+
+    def record(self, key, ligand_scores, secs=None, detailed=True):
+        """Store the scores of a pose, and the time it took to score it.
+
+        Times of detailed rescores of poses, not scheduled by next_batch, can be left out.
+        """
+        self.results[key] = ligand_scores
+        self.scored_at[key] = self.clock()
+        self.moved_at.pop(key, None)
+        self.stale.discard(key)
+        if detailed:
+            self.detailed.add(key)
+        else:
+            self.detailed.discard(key)
+        if secs is not None:
+            self.pose_secs += POSE_SECS_WEIGHT * (secs - self.pose_secs)
+
+    def ranking(self, count=None):
+        """Get (key, ligand_scores) of the poses with the lowest total scores.
+
+        Scoring algorithms without a total score are ranked by their first aggregate score.
+        """
+        ranked = sorted(
+            (
+                (key, ligand_scores) for key, ligand_scores in self.results.items()
+                if ligand_scores.get('aggregate_scores') and ligand_scores['aggregate_scores'][0]
+            ),
+            key=lambda item: rank_score(item[1]['aggregate_scores'][0]))
+        return ranked[:count]
+
+    def missing_detail(self, count=None):
+        """Get the keys of the first count ranked poses that were scored without detail."""
+        return [key for key, _ in self.ranking(count) if key not in self.detailed]
+
+
+def rank_score(aggregate_scores):
+    if 'total_score' in aggregate_scores:
+        return aggregate_scores['total_score']
+    return next(iter(aggregate_scores.values()))
@@ -1,4 +1,7 @@
+import hashlib
+import numpy as np
 from nanome.api import structure
+from nanome.util import Matrix, Quaternion, Vector3
 from marshmallow import Schema, fields
 
 
@@ -20,6 +23,12 @@ class ScoringOutputSchema(Schema):
         fields.Tuple((fields.Int(), fields.Float())),
         required=True)
 
+    # List of tuples, where the first element is a receptor residue index and
+    # the second element is the summed score of its contacts with the ligand.
+    residue_scores = fields.List(
+        fields.Tuple((fields.Int(), fields.Float())),
+        required=False)
+
 
 def extract_residues_from_complex(comp, residue_list, comp_name=None):
     """Copy comp, and remove all residues that are not part of the binding site."""
@@ -40,3 +49,46 @@ def extract_residues_from_complex(comp, residue_list, comp_name=None):
             new_ch.residues = reses_on_chain
             new_mol.add_chain(new_ch)
     return new_comp
+
+
+def atom_positions(atoms):
+    """Get positions of a list of atoms as a contiguous (N, 3) array."""
+    return np.array([atom.position.unpack() for atom in atoms], dtype=np.float64).reshape(-1, 3)
+
+
+def matrix_to_array(matrix):
+    """Convert a 4x4 nanome Matrix to a numpy array."""
+    return np.array([matrix[i] for i in range(4)], dtype=np.float64)
+
+
+def move_complex(comp, transform):
+    """Apply a 4x4 transformation matrix, in workspace coordinates, to the position and rotation of comp."""
+    matrix = transform @ matrix_to_array(comp.get_complex_to_workspace_matrix())
+    rotation = Matrix(4, 4)
+    for i in range(4):
+        rotation[i] = matrix[i].tolist()
+    comp.position = Vector3(*matrix[:3, 3].tolist())
+    comp.rotation = Quaternion.from_matrix(rotation)
+
+
+def transform_positions(positions, matrix):
+    """Apply a 4x4 transformation matrix to an (N, 3) array of positions."""
+    return positions @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def set_atom_positions(atoms, positions):
+    """Write an (N, 3) array of positions back to a list of atoms."""
+    for atom, (x, y, z) in zip(atoms, positions.tolist()):
+        atom._old_position = atom.position
+        atom.position = Vector3(x, y, z)
+
+
+def topology_fingerprint(mol):
+    """Identify the chains, residues and atoms of a molecule, ignoring their positions."""
+    digest = hashlib.sha1(str(mol.index).encode())
+    for chain in mol.chains:
+        digest.update(chain.name.encode())
+        for residue in chain.residues:
+            digest.update(f'{residue.index}:{residue.name}'.encode())
+            digest.update(str([atom.index for atom in residue.atoms]).encode())
+    return digest.hexdigest()
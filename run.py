@@ -9,7 +9,13 @@ if __name__ == "__main__":
     # custom_data = {
     #     'color_positive_score': Color.Red(),
     #     'color_negative_score': Color.Blue(),
-    #     'realtime_enabled': True
+    #     'realtime_enabled': True,
+    #     'warmup': True,
+    #     'incremental_scoring': True,
+    #     'aggregate_only_scoring': True,
+    #     'record_session': 'session.trace.gz',
+    #     'profile_cycles': 5,
+    #     'scoring_workers': ['localhost:9030', 'localhost:9031']
     # }
     plugin_name = 'Realtime Scoring'
     description = "Display realtime scoring info about a selected ligand."
@@ -0,0 +1,41 @@
+import nanome
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+from nanome._internal.network.plugin_network import PluginNetwork
+from nanome.api import structure
+from nanome.util import Process, Vector3
+from benchmarks import replay
+from plugin.recorder import SessionRecorder, load_trace
+from tests.utils import assets_dir, generate_random_indices, run_awaitable
+
+
+class ReplayTestCase(unittest.TestCase):
+
+    def test_record_and_replay(self):
+        """Replay a recorded session in which the ligand is moved once."""
+        receptor_comp = structure.Complex.io.from_pdb(path=os.path.join(assets_dir, '5ceo_protein.pdb'))
+        ligand_comp = structure.Complex.io.from_pdb(path=os.path.join(assets_dir, '50D.pdb'))
+        generate_random_indices(receptor_comp)
+        generate_random_indices(ligand_comp)
+        recorder = SessionRecorder(MagicMock(), 'session.trace.gz')
+        times = iter([0.0, 0.0, 0.3])
+        recorder.clock = lambda: next(times)
+        recorder.start_time = 0.0
+        recorder.record_selection(receptor_comp.index, [res.index for res in ligand_comp.residues])
+        recorder.record_complexes([receptor_comp, ligand_comp])
+        ligand_comp.position = Vector3(0.2, 0, 0)
+        recorder.record_complexes([receptor_comp, ligand_comp])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace = load_trace(recorder.save(os.path.join(tmp_dir, 'session.trace.gz')))
+        # The replayed plugin replaces these for the whole process
+        with patch.object(nanome.PluginInstance, '_instance'), patch.object(Process, '_manager'), \
+                patch.object(PluginNetwork, '_instance'):
+            report = run_awaitable(replay.replay, trace, update_interval=0.1)
+        self.assertEqual(report['pose_changes'], 1)
+        self.assertEqual(report['missed_pose_changes'], 0)
+        self.assertGreater(report['latency_percentiles'][50], 0)
+        self.assertGreaterEqual(report['rescores'], 2)
+        self.assertGreaterEqual(report['dsx_runs'], 2)
+        self.assertGreater(report['stream_bytes'], 0)
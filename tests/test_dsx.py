@@ -1,23 +1,21 @@
 import asyncio
 import itertools
+import nanome
 import os
+import shutil
+import socket
+import tempfile
 import unittest
-
+import numpy as np
 from nanome.api import structure
-from dsx import scoring_algo
+from nanome.util import Process
+from dsx import distributed, potentials, refine, scoring_algo, warmup
+from dsx.contributions import PairContributionStore
+from dsx.neighbor_list import NeighborListScorer, read_pdb_atoms
+from dsx.potentials import load_pair_potentials
 from random import randint
-
-
-assets_dir = os.path.join(os.path.dirname(__file__), 'assets')
-
-
-def run_awaitable(awaitable, *args, **kwargs):
-    loop = asyncio.get_event_loop()
-    if loop.is_running:
-        loop = asyncio.new_event_loop()
-    result = loop.run_until_complete(awaitable(*args, **kwargs))
-    loop.close()
-    return result
+from unittest.mock import MagicMock, patch
+from tests.utils import assets_dir, run_awaitable
 
 
 class DsxTestCase(unittest.TestCase):
@@ -49,3 +47,322 @@ class DsxTestCase(unittest.TestCase):
         aggregate_scores = scoring_algo.parse_results(results_file)
         self.assertEqual(aggregate_scores[0]['total_score'], expected_total_score)
         self.assertEqual(aggregate_scores[0]['per_contact_score'], expected_per_contact_score)
+
+    def test_pair_contributions(self):
+        results_file = os.path.join(assets_dir, 'dsx_output.txt')
+        with open(results_file, 'r') as f:
+            dsx_output = f.read()
+        store = PairContributionStore(capacity=16)
+        pairs = store.load_dsx_output(dsx_output)
+        self.assertEqual(len(pairs), 639)
+        self.assertEqual(pairs['score'].dtype, np.float32)
+        # Pair contributions add up to the total score in dsx_results.txt
+        self.assertAlmostEqual(float(pairs['score'].sum()), -127.995, places=1)
+        residue_numbers, residue_scores = store.residue_scores()
+        self.assertAlmostEqual(float(residue_scores.sum()), float(pairs['score'].sum()), places=3)
+        atom_numbers, _ = store.ligand_atom_scores()
+        self.assertEqual(len(atom_numbers), 29)
+        # Buffer is reused by later passes that fit in it.
+        buffer = store._buffer
+        store.load_dsx_output(dsx_output)
+        self.assertIs(store._buffer, buffer)
+        self.assertEqual(store.size, 639)
+        # Pair lines outside of Receptor-Ligand sections are not counted
+        other_section = '# Cofactor-Ligand:\nC.3_1_1__C.ar6x_1_1__0.5\n'
+        store.load_dsx_output(
+            dsx_output.replace('# End of pair potentials', other_section + '# End of pair potentials'))
+        self.assertEqual(store.size, 639)
+
+    def test_parse_residue_scores(self):
+        results_file = os.path.join(assets_dir, 'dsx_output.txt')
+        with open(results_file, 'r') as f:
+            dsx_output = f.read()
+        scoring_algo.parse_output(dsx_output, self.ligand_comp)
+        residue_scores = scoring_algo.parse_residue_scores(scoring_algo.PAIR_STORE, self.receptor_comp)
+        receptor_residue_indices = {res.index for res in self.receptor_comp.residues}
+        self.assertTrue(residue_scores)
+        for residue_index, _ in residue_scores:
+            self.assertIn(residue_index, receptor_residue_indices)
+
+    def test_check_executables(self):
+        self.assertEqual(warmup.check_executables(), [])
+
+    def test_stage_potentials_dir(self):
+        with tempfile.TemporaryDirectory() as tmpfs_dir:
+            staged_dir = warmup.stage_potentials_dir(tmpfs_dir)
+            self.assertEqual(
+                sorted(os.listdir(staged_dir)),
+                sorted(os.listdir(os.path.join(scoring_algo.DIR, 'bin', 'pdb_pot_0511'))))
+            # Existing copy is reused
+            mtime = os.stat(staged_dir).st_mtime_ns
+            self.assertEqual(warmup.stage_potentials_dir(tmpfs_dir), staged_dir)
+            self.assertEqual(os.stat(staged_dir).st_mtime_ns, mtime)
+            self.assertEqual(os.listdir(tmpfs_dir), [warmup.STAGED_DIR_NAME])
+            # and staged again once it's out of date
+            staged_file = os.path.join(staged_dir, sorted(os.listdir(staged_dir))[0])
+            with open(staged_file, 'a') as f:
+                f.write('stale')
+            self.assertFalse(warmup.is_current_copy(os.path.join(scoring_algo.DIR, 'bin', 'pdb_pot_0511'), staged_dir))
+            self.assertEqual(warmup.stage_potentials_dir(tmpfs_dir), staged_dir)
+            self.assertTrue(warmup.is_current_copy(os.path.join(scoring_algo.DIR, 'bin', 'pdb_pot_0511'), staged_dir))
+            self.assertEqual(os.listdir(tmpfs_dir), [warmup.STAGED_DIR_NAME])
+
+    def test_shared_potentials(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            potentials_dir = os.path.join(tmp_dir, 'pdb_pot_0511')
+            shutil.copytree(potentials.POTENTIALS_DIR, potentials_dir)
+            shared = potentials.load_shared_potentials(potentials_dir, cache_dir=tmp_dir)
+            # Unchanged source files aren't hashed again
+            with patch.object(potentials, 'source_checksum') as source_checksum:
+                self.assertIs(potentials.load_shared_potentials(potentials_dir, cache_dir=tmp_dir), shared)
+                source_checksum.assert_not_called()
+            for name, keys_name in potentials.TABLE_KEYS.items():
+                values, columns = potentials.read_table(potentials_dir, name, keys_name)
+                np.testing.assert_array_equal(shared.tables[name], values)
+                self.assertEqual(shared.columns[name], columns)
+                self.assertFalse(shared.tables[name].flags.writeable)
+            # Changed source files rebuild the stale cache
+            values_path = os.path.join(potentials_dir, 'potentials_repulsive.bin')
+            with open(values_path, 'r+b') as f:
+                f.seek(potentials.HEADER_SIZE * potentials.HEADER_DTYPE.itemsize)
+                f.write(np.float32(42).tobytes())
+            rebuilt = potentials.load_shared_potentials(potentials_dir, cache_dir=tmp_dir)
+            self.assertNotEqual(rebuilt.checksum, shared.checksum)
+            self.assertEqual(rebuilt.tables['potentials_repulsive'][0, 0], 42)
+            # So does a cache written by another format version
+            cache_path = potentials.cache_path(potentials_dir, tmp_dir)
+            self.assertTrue(potentials.cache_is_valid(cache_path, rebuilt.checksum))
+            with patch.object(potentials, 'CACHE_VERSION', potentials.CACHE_VERSION + 1):
+                self.assertFalse(potentials.cache_is_valid(cache_path, rebuilt.checksum))
+            # Other potential sets have their own cache file
+            other_dir = os.path.join(tmp_dir, 'other_pot')
+            shutil.copytree(potentials.POTENTIALS_DIR, other_dir)
+            other = potentials.load_shared_potentials(other_dir, cache_dir=tmp_dir)
+            self.assertNotEqual(other.path, rebuilt.path)
+            self.assertEqual(rebuilt.tables['potentials_repulsive'][0, 0], 42)
+            self.assertTrue(potentials.cache_is_valid(cache_path, rebuilt.checksum))
+
+    def test_neighbor_list_scorer_matches_dsx(self):
+        results_file = os.path.join(assets_dir, 'dsx_output.txt')
+        with open(results_file, 'r') as f:
+            dsx_output = f.read()
+        store = PairContributionStore()
+        pairs = store.load_dsx_output(dsx_output)
+        receptor_atoms = read_pdb_atoms(os.path.join(assets_dir, '5ceo_protein.pdb'))
+        ligand_ids, ligand_positions, _, ligand_ignored = read_pdb_atoms(self.ligand_pdb, ignore_hetatms=False)
+        scorer = NeighborListScorer.from_pair_store(
+            load_pair_potentials(), store, receptor_atoms, (ligand_ids, ligand_positions, ligand_ignored))
+        self.assertEqual(scorer.contact_count, len(pairs))
+        self.assertAlmostEqual(scorer.total, float(pairs['score'].sum()), delta=0.05)
+        total_score, contact_count = scorer.full_score(ligand_positions)
+        self.assertAlmostEqual(scorer.total, total_score, places=6)
+
+    def test_incremental_rescore_matches_full_rescore(self):
+        pair_potentials = load_pair_potentials()
+        rng = np.random.default_rng(0)
+        receptor_positions = rng.uniform(-10, 10, (400, 3))
+        ligand_positions = rng.uniform(-3, 3, (20, 3))
+        atom_types = ['C.3', 'C.ar6', 'N.am', 'O.carb']
+        scorer = NeighborListScorer(
+            pair_potentials, pair_potentials.type_columns(atom_types), receptor_positions,
+            rng.integers(0, len(atom_types), 400), np.zeros(400, dtype=int),
+            rng.integers(0, len(atom_types), 20), skin=1.0, tolerance=0)
+        self.assertTrue(scorer.score(ligand_positions))
+        self.assertEqual(scorer.build_count, 1)
+        # Nudge single atoms, staying within the skin
+        for _ in range(20):
+            atom = rng.integers(len(ligand_positions))
+            ligand_positions[atom] += rng.normal(0, 0.05, 3)
+            self.assertTrue(scorer.score(ligand_positions))
+            total_score, contact_count = scorer.full_score(ligand_positions)
+            self.assertAlmostEqual(scorer.total, total_score, places=6)
+            self.assertEqual(scorer.contact_count, contact_count)
+        self.assertEqual(scorer.build_count, 1)
+        # Moving past the skin rebuilds the neighbor list
+        ligand_positions += 1.5
+        self.assertTrue(scorer.score(ligand_positions))
+        self.assertEqual(scorer.build_count, 2)
+        self.assertAlmostEqual(scorer.total, scorer.full_score(ligand_positions)[0], places=6)
+
+    def test_refine_pose(self):
+        results_file = os.path.join(assets_dir, 'dsx_output.txt')
+        with open(results_file, 'r') as f:
+            dsx_output = f.read()
+        store = PairContributionStore()
+        store.load_dsx_output(dsx_output)
+        receptor_atoms = read_pdb_atoms(os.path.join(assets_dir, '5ceo_protein.pdb'))
+        ligand_ids, ligand_positions, _, ligand_ignored = read_pdb_atoms(self.ligand_pdb, ignore_hetatms=False)
+        scorer = NeighborListScorer.from_pair_store(
+            load_pair_potentials(), store, receptor_atoms, (ligand_ids, ligand_positions, ligand_ignored))
+        # Batches of poses score like single poses, also against the pocket only
+        rng = np.random.default_rng(0)
+        moves = refine.random_moves(rng, 8, ligand_positions.mean(axis=0), 0.2, np.radians(3))
+        poses = refine.transform_positions(moves, ligand_positions)
+        pocket_rows = scorer.pocket_rows(ligand_positions, 1.0)
+        self.assertLess(len(pocket_rows), len(scorer.receptor_positions))
+        totals, scorable = scorer.batch_score(poses, pocket_rows)
+        for pose, total, pose_scorable in zip(poses, totals, scorable):
+            full_score = scorer.full_score(pose)
+            self.assertEqual(pose_scorable, full_score is not None)
+            if full_score is not None:
+                self.assertAlmostEqual(total, full_score[0], places=6)
+        # Only poses without untyped pairs, so scores are exact
+        result = refine.refine_pose(scorer, ligand_positions, 0.5, untyped_as_zero=False, seed=0)
+        self.assertGreater(result['trials'], 0)
+        self.assertAlmostEqual(result['initial_score'], scorer.full_score(ligand_positions)[0], places=6)
+        self.assertLess(result['score'], result['initial_score'])
+        best_pose = refine.transform_positions(result['transform'][None], ligand_positions)[0]
+        self.assertAlmostEqual(scorer.full_score(best_pose)[0], result['score'], places=6)
+        self.assertLessEqual(np.linalg.norm(best_pose - ligand_positions, axis=1).max(), refine.MAX_SHIFT)
+
+    def test_score_ensemble(self):
+        protein_comp = structure.Complex.io.from_pdb(path=os.path.join(assets_dir, '5ceo_protein.pdb'))
+        protein_comp.index = randint(1000000000, 9999999999)
+        receptors = [self.receptor_comp, protein_comp]
+        nanobabel_convert = scoring_algo.nanobabel_convert
+        conversions = []
+
+        async def counted_nanobabel_convert(*args):
+            conversions.append(args)
+            return await nanobabel_convert(*args)
+        # DSX runs outside of a plugin process
+        plugin = MagicMock(is_async=True)
+        with patch.object(scoring_algo, 'nanobabel_convert', counted_nanobabel_convert), \
+                patch.object(nanome.PluginInstance, '_instance', plugin), patch.object(Process, '_manager', None):
+            ensemble_scores = run_awaitable(scoring_algo.score_ensemble, receptors, [self.ligand_comp])
+            # Ligand is only prepared once for every receptor
+            self.assertEqual(len(conversions), 1)
+            self.assertEqual(
+                [scores['receptor_index'] for scores in ensemble_scores], [comp.index for comp in receptors])
+            for receptor, receptor_scores in zip(receptors, ensemble_scores):
+                single_scores = run_awaitable(scoring_algo.score_ligands, receptor, [self.ligand_comp])
+                self.assertEqual(
+                    receptor_scores['ligand_scores'][0]['aggregate_scores'],
+                    single_scores[0]['aggregate_scores'])
+            # Receptor files are reused while the receptors don't change
+            receptor_files = dict(scoring_algo.RECEPTOR_FILES)
+            mtimes = [os.stat(path).st_mtime_ns for path in receptor_files.values()]
+            run_awaitable(scoring_algo.score_ensemble, receptors, [self.ligand_comp])
+            self.assertEqual(scoring_algo.RECEPTOR_FILES, receptor_files)
+            self.assertEqual([os.stat(path).st_mtime_ns for path in receptor_files.values()], mtimes)
+            # and are deleted once their receptor leaves the ensemble
+            run_awaitable(scoring_algo.score_ensemble, receptors[:1], [self.ligand_comp])
+            self.assertEqual(len(scoring_algo.RECEPTOR_FILES), 1)
+            self.assertEqual(sum(os.path.exists(path) for path in receptor_files.values()), 1)
+            # The directory of receptor files is removed on exit
+            receptor_files_dir = os.path.dirname(next(iter(receptor_files.values())))
+            scoring_algo.remove_receptor_files_dir()
+            self.assertFalse(os.path.exists(receptor_files_dir))
+            self.assertEqual(scoring_algo.RECEPTOR_FILES, {})
+
+    def test_score_aggregates(self):
+        protein_comp = structure.Complex.io.from_pdb(path=os.path.join(assets_dir, '5ceo_protein.pdb'))
+        run_dsx = scoring_algo.run_dsx
+        dsx_runs = []
+
+        async def counted_run_dsx(*args, **kwargs):
+            dsx_runs.append(kwargs.get('pair_potentials', True))
+            return await run_dsx(*args, **kwargs)
+        # DSX runs outside of a plugin process
+        plugin = MagicMock(is_async=True)
+        with patch.object(scoring_algo, 'run_dsx', counted_run_dsx), \
+                patch.object(nanome.PluginInstance, '_instance', plugin), patch.object(Process, '_manager', None):
+            ligand_scores = run_awaitable(scoring_algo.score_ligands, protein_comp, [self.ligand_comp])
+            # Every ligand is scored by a single run, without pair potentials
+            aggregate_scores = run_awaitable(
+                scoring_algo.score_ligands, protein_comp, [self.ligand_comp] * 3, aggregate_only=True)
+        self.assertEqual(dsx_runs, [True, False])
+        self.assertEqual(len(aggregate_scores), 3)
+        for ligand_data in aggregate_scores:
+            self.assertEqual(ligand_data['aggregate_scores'], ligand_scores[0]['aggregate_scores'])
+            self.assertEqual(ligand_data['atom_scores'], [])
+            self.assertEqual(ligand_data['residue_scores'], [])
+
+    def test_distributed_scoring(self):
+        async def validate_distributed_scoring():
+            workers = [distributed.ScoringWorker() for _ in range(2)]
+            addresses = [':'.join(map(str, await worker.serve('localhost', 0))) for worker in workers]
+            # Nothing listens on the first address, its jobs are retried on the others
+            with socket.socket() as sock:
+                sock.bind(('localhost', 0))
+                dead_address = f'localhost:{sock.getsockname()[1]}'
+            dispatcher = distributed.Dispatcher([dead_address] + addresses)
+            try:
+                local_scores = await scoring_algo.score_ligands(self.receptor_comp, [self.ligand_comp])
+                ligand_scores = await dispatcher.score_ligands(self.receptor_comp, [self.ligand_comp])
+                self.assertEqual(ligand_scores, local_scores)
+                self.assertIsNotNone(dispatcher.workers[0].failed_at)
+                # The worker that prepared the receptor scores it again
+                await dispatcher.score_ligands(self.receptor_comp, [self.ligand_comp])
+                self.assertEqual(sorted(worker.jobs_scored for worker in workers), [0, 2])
+                self.assertEqual(sum(worker.receptor_loads for worker in workers), 1)
+                # Jobs are spread once that worker is busy
+                ligand_scores = await dispatcher.score_ligands(self.receptor_comp, [self.ligand_comp] * 3)
+                self.assertEqual(ligand_scores, local_scores * 3)
+                self.assertEqual(sorted(worker.jobs_scored for worker in workers), [1, 4])
+                # Jobs of a worker that goes away are retried on the other one
+                jobs_scored = workers[1].jobs_scored
+                await workers[0].close()
+                ligand_scores = await dispatcher.score_ligands(self.receptor_comp, [self.ligand_comp] * 2)
+                self.assertEqual(ligand_scores, local_scores * 2)
+                self.assertEqual(workers[1].jobs_scored, jobs_scored + 2)
+                # Ensembles are scored against every receptor on the workers
+                ensemble_scores = await dispatcher.score_ensemble(
+                    [self.receptor_comp, self.receptor_comp], [self.ligand_comp])
+                self.assertEqual(ensemble_scores, [
+                    {'receptor_index': self.receptor_comp.index, 'ligand_scores': local_scores}] * 2)
+            finally:
+                await dispatcher.close()
+                for worker in workers:
+                    await worker.close()
+            self.assertEqual([worker._reader_task for worker in dispatcher.workers], [None] * 3)
+            self.assertEqual([worker._connection_tasks for worker in workers], [set(), set()])
+        # Workers run DSX outside of a plugin process
+        with patch.object(Process, '_manager', None):
+            run_awaitable(validate_distributed_scoring)
+
+    def test_dispatcher_close(self):
+        """Closing a dispatcher fails the jobs waiting on workers right away."""
+        async def validate_dispatcher_close():
+            async def unresponsive_worker(reader, writer):
+                await distributed.write_message(writer, {'type': 'hello', 'receptor_cache_size': 8})
+                await reader.read()
+                writer.close()
+            server = await asyncio.start_server(unresponsive_worker, 'localhost', 0)
+            host, port = server.sockets[0].getsockname()[:2]
+            dispatcher = distributed.Dispatcher([f'{host}:{port}'])
+            job = asyncio.ensure_future(dispatcher.score_ligands(self.receptor_comp, [self.ligand_comp]))
+            while not dispatcher.workers[0]._pending:
+                await asyncio.sleep(0.01)
+            await asyncio.wait_for(dispatcher.close(), 1)
+            with self.assertRaises(distributed.WorkerError):
+                await asyncio.wait_for(job, 1)
+            self.assertIsNone(dispatcher.workers[0]._reader_task)
+            server.close()
+            await server.wait_closed()
+        run_awaitable(validate_dispatcher_close)
+
+    def test_run_process_outside_plugin(self):
+        """Processes run outside of a plugin don't block the event loop."""
+        async def validate_run_process():
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+            ticker = asyncio.ensure_future(tick())
+            other_task = asyncio.ensure_future(scoring_algo.run_process('true', [], label='other'))
+            runs = []
+            scoring_algo.add_process_hook(lambda label, secs: runs.append((label, secs)))
+            output = await scoring_algo.run_process('sh', ['-c', 'sleep 0.2; echo done'], label='sleep')
+            await other_task
+            ticker.cancel()
+            self.assertEqual(output, 'done\n')
+            self.assertGreater(ticks, 5)
+            # Hooks only see processes run in the context they were added to
+            self.assertEqual([label for label, _ in runs], ['sleep'])
+            self.assertGreater(runs[0][1], 0.1)
+        with patch.object(Process, '_manager', None):
+            run_awaitable(validate_run_process)
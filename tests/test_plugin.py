@@ -2,25 +2,26 @@ import asyncio
 import itertools
 import nanome
 import os
+import pstats
+import tempfile
 import unittest
+import numpy as np
+from datetime import timedelta
 from unittest.mock import MagicMock
 from nanome.api import structure, PluginInstance, shapes
-from nanome.util import Process
+from nanome.util import Process, Quaternion, Vector3
 from dsx import scoring_algo
 from plugin.RealtimeScoring import RealtimeScoring
+from plugin.recorder import SessionRecorder, load_trace
+from plugin.scheduler import PoseScheduler
 from random import randint
+from tests.utils import assets_dir, generate_random_indices, run_awaitable
 
 
-assets_dir = os.path.join(os.path.dirname(__file__), 'assets')
-
-
-def run_awaitable(awaitable, *args, **kwargs):
-    loop = asyncio.get_event_loop()
-    if loop.is_running:
-        loop = asyncio.new_event_loop()
-    result = loop.run_until_complete(awaitable(*args, **kwargs))
-    loop.close()
-    return result
+def completed_future(result=None):
+    fut = asyncio.Future()
+    fut.set_result(result)
+    return fut
 
 
 class RealtimeScoringTestCase(unittest.TestCase):
@@ -31,8 +32,8 @@ class RealtimeScoringTestCase(unittest.TestCase):
         cls.receptor_comp = structure.Complex.io.from_pdb(path=cls.receptor_pdb)
         cls.ligand_pdb = os.path.join(assets_dir, '50D.pdb')
         cls.ligand_comp = structure.Complex.io.from_pdb(path=cls.ligand_pdb)
-        cls.generate_random_indices(cls.receptor_comp)
-        cls.generate_random_indices(cls.ligand_comp)
+        generate_random_indices(cls.receptor_comp)
+        generate_random_indices(cls.ligand_comp)
         # Generate indices for receptor and ligand
         for residue in itertools.chain(cls.receptor_comp.residues, cls.ligand_comp.residues):
             residue.index = randint(1000000000, 9999999999)
@@ -41,13 +42,15 @@ class RealtimeScoringTestCase(unittest.TestCase):
 
     def setUp(self):
         RealtimeScoring.scoring_algorithm = scoring_algo.score_ligands
+        RealtimeScoring.refine_algorithm = scoring_algo.refine_ligand_pose
         self.plugin = RealtimeScoring()
         PluginInstance._instance = self.plugin
         self.plugin._network = MagicMock()
         nanome._internal.network.plugin_network.PluginNetwork._instance = MagicMock()
         # Mock args that are passed to setup plugin instance networking
-        session_id = plugin_network = pm_queue_in = pm_queue_out = custom_data = \
+        session_id = plugin_network = pm_queue_in = pm_queue_out = \
             log_pipe_conn = original_version_table = permissions = MagicMock()
+        custom_data = [{}]
         self.plugin._setup(
             session_id, plugin_network, pm_queue_in, pm_queue_out, log_pipe_conn,
             original_version_table, custom_data, permissions
@@ -84,8 +87,197 @@ class RealtimeScoringTestCase(unittest.TestCase):
             # Assert receptor and ligand were set
             self.assertEqual(self.plugin.receptor_comp, self.receptor_comp)
             self.assertEqual(self.plugin.ligand_residues, ligand_residues)
+            # Too few poses are selected to score them aggregate only
+            self.assertFalse(self.plugin.settings.aggregate_only_usable)
+            self.assertIn('20+ Poses', self.plugin.settings._lbl_aggregate_only.text_value)
+            self.plugin.stop_scoring()
+            self.assertTrue(self.plugin.settings.aggregate_only_usable)
         run_awaitable(validate_setup_receptor_and_ligands, self)
 
+    def test_incremental_ligand_streams(self):
+        """Only spheres and streams affected by topology changes are recreated."""
+        async def validate_incremental_ligand_streams(self):
+            upload_multiple_fut = asyncio.Future()
+            upload_multiple_fut.set_result(None)
+            shapes.Shape.upload_multiple = MagicMock(return_value=upload_multiple_fut)
+            shapes.Shape.destroy_multiple = MagicMock()
+            create_stream_fut = asyncio.Future()
+            create_stream_fut.set_result((MagicMock(), unittest.mock.ANY))
+            self.plugin.create_writing_stream = MagicMock(return_value=create_stream_fut)
+
+            ligand_atoms = list(self.ligand_comp.atoms)
+            await self.plugin.start_ligand_streams(ligand_atoms[:-1])
+            self.assertEqual(len(shapes.Shape.upload_multiple.call_args.args[0]), len(ligand_atoms) - 1)
+            self.assertEqual(self.plugin.create_writing_stream.call_count, 3)
+
+            # Same atoms, nothing is uploaded and streams are kept.
+            await self.plugin.start_ligand_streams(ligand_atoms[:-1])
+            self.assertEqual(shapes.Shape.upload_multiple.call_count, 1)
+            self.assertEqual(self.plugin.create_writing_stream.call_count, 3)
+
+            # Added atom, only its sphere is uploaded.
+            await self.plugin.start_ligand_streams(ligand_atoms)
+            self.assertEqual(shapes.Shape.upload_multiple.call_count, 2)
+            self.assertEqual(len(shapes.Shape.upload_multiple.call_args.args[0]), 1)
+            self.assertEqual(self.plugin.create_writing_stream.call_count, 6)
+            self.assertEqual(len(self.plugin.spheres), len(ligand_atoms))
+
+            # Removed atom, only its sphere is destroyed.
+            await self.plugin.start_ligand_streams(ligand_atoms[1:])
+            self.assertEqual(shapes.Shape.upload_multiple.call_count, 2)
+            self.assertEqual(len(shapes.Shape.destroy_multiple.call_args.args[0]), 1)
+            self.assertEqual(self.plugin.create_writing_stream.call_count, 9)
+        run_awaitable(validate_incremental_ligand_streams, self)
+
+    def test_lazy_complex_loading(self):
+        """Menu is populated from shallow complexes, deep complexes are fetched on selection."""
+        async def validate_lazy_complex_loading(self):
+            deep_comps = {comp.index: comp for comp in [self.receptor_comp, self.ligand_comp]}
+            shallow_comps = []
+            for comp in deep_comps.values():
+                shallow_comp = structure.Complex()
+                shallow_comp.index = comp.index
+                shallow_comp.name = comp.name
+                shallow_comps.append(shallow_comp)
+
+            def request_complexes(comp_indices):
+                fut = asyncio.Future()
+                fut.set_result([deep_comps.get(index) for index in comp_indices])
+                return fut
+            complex_list_fut = asyncio.Future()
+            complex_list_fut.set_result(shallow_comps)
+            self.plugin.request_complex_list = MagicMock(return_value=complex_list_fut)
+            self.plugin.request_complexes = MagicMock(side_effect=request_complexes)
+            self.plugin.update_menu = MagicMock()
+            self.plugin.update_content = MagicMock()
+            # Background ligand detection is covered by test_cached_ligand_detection
+            self.plugin.menu.prefetch_ligands = MagicMock()
+
+            await self.plugin.on_run()
+            await self.plugin.menu.render()
+            self.assertEqual(self.plugin.request_complexes.call_count, 0)
+            self.assertEqual(self.plugin.complex_cache, [])
+            ligand_items = self.plugin.menu._ls_ligands.items
+            self.assertEqual(len(ligand_items), 2)
+
+            ligand_btn = next(
+                item.get_content() for item in ligand_items
+                if item.get_content().index == self.ligand_comp.index)
+            ligand_btn.selected = True
+            await self.plugin.menu.on_ligand_pressed(ligand_btn)
+            self.plugin.request_complexes.assert_called_once_with([self.ligand_comp.index])
+            self.assertEqual(self.plugin.complex_cache, [self.ligand_comp])
+            self.assertEqual(
+                self.plugin.menu.ligand_residue_indices,
+                [res.index for res in self.ligand_comp.residues])
+
+            # Deselecting evicts the deep complex
+            ligand_btn.selected = False
+            await self.plugin.menu.on_ligand_pressed(ligand_btn)
+            self.assertEqual(self.plugin.complex_cache, [])
+
+            # Reselecting fetches it again, and its ligand is scored
+            ligand_btn.selected = True
+            await self.plugin.menu.on_ligand_pressed(ligand_btn)
+            self.assertEqual(self.plugin.request_complexes.call_count, 2)
+            self.assertEqual(self.plugin.complex_cache, [self.ligand_comp])
+            receptor_btn = next(
+                item.get_content() for item in self.plugin.menu._ls_receptors.items
+                if item.get_content().index == self.receptor_comp.index)
+            receptor_btn.selected = True
+            self.plugin.send_notification = MagicMock()
+            self.plugin.setup_receptor_and_ligands = MagicMock(return_value=completed_future())
+            self.plugin.score_ligands = MagicMock(return_value=completed_future())
+            await self.plugin.menu.start_scoring()
+            self.plugin.send_notification.assert_not_called()
+            self.assertEqual(
+                [comp.index for comp in self.plugin.complex_cache],
+                [self.ligand_comp.index, self.receptor_comp.index])
+            _, residue_indices, _ = self.plugin.setup_receptor_and_ligands.call_args[0]
+            self.plugin.ligand_residue_indices = residue_indices
+            self.assertEqual(
+                [res.index for res in self.plugin.ligand_residues],
+                [res.index for res in self.ligand_comp.residues])
+        run_awaitable(validate_lazy_complex_loading, self)
+
+    def test_cached_ligand_detection(self):
+        """Ligands are detected when the complex list loads, and again only when the topology changes."""
+        async def validate_cached_ligand_detection(self):
+            receptor_comp = structure.Complex.io.from_pdb(path=self.receptor_pdb)
+            generate_random_indices(receptor_comp)
+            ligand_residue = next(receptor_comp.residues)
+            deep_comps = {comp.index: comp for comp in [receptor_comp, self.ligand_comp]}
+            self.plugin.complex_list = []
+            for comp in deep_comps.values():
+                shallow_comp = structure.Complex()
+                shallow_comp.index = comp.index
+                shallow_comp.full_name = comp.full_name
+                self.plugin.complex_list.append(shallow_comp)
+
+            def request_complexes(comp_indices):
+                fut = asyncio.Future()
+                fut.set_result([deep_comps.get(index) for index in comp_indices])
+                return fut
+            detected_mols = []
+
+            def get_ligands(mol):
+                detected_mols.append(mol)
+                substructure = structure.Substructure()
+                substructure._name = 'LIG'
+                substructure._residues = [ligand_residue]
+                fut = asyncio.Future()
+                fut.set_result([substructure] if ligand_residue in mol.residues else [])
+                return fut
+            self.plugin.request_complexes = MagicMock(side_effect=request_complexes)
+            self.plugin.update_menu = MagicMock()
+            self.plugin.update_content = MagicMock()
+            menu = self.plugin.menu
+
+            with unittest.mock.patch.object(structure.Molecule, 'get_ligands', get_ligands):
+                await menu.prefetch_ligands()
+                self.assertEqual(len(detected_mols), 2)
+                self.assertEqual(set(menu.ligand_cache), set(deep_comps))
+                # Deep complexes used for detection aren't kept
+                self.assertEqual(self.plugin.complex_cache, [])
+
+                await menu.render()
+                receptor_btn = next(
+                    item.get_content() for item in menu._ls_receptors.items
+                    if item.get_content().index == receptor_comp.index)
+                receptor_btn.selected = True
+                await menu.on_receptor_pressed(receptor_btn)
+                self.assertEqual(len(detected_mols), 2)
+                extracted_btns = [
+                    item.get_content() for item in menu._ls_ligands.items
+                    if hasattr(item.get_content(), 'extracted_ligand')]
+                self.assertEqual(len(extracted_btns), 1)
+                self.assertEqual(extracted_btns[0].residue_indices, [ligand_residue.index])
+                # Cached ligands are kept while the complex list changes
+                request_count = self.plugin.request_complexes.call_count
+                await menu.prefetch_ligands()
+                self.assertEqual(self.plugin.request_complexes.call_count, request_count)
+                self.assertEqual(len(detected_mols), 2)
+
+                # A receptor edited in the workspace is requested again, and its ligands detected again
+                edited_comp = structure.Complex.io.from_pdb(path=self.receptor_pdb)
+                edited_comp.index = receptor_comp.index
+                for edited, original in zip(edited_comp.residues, receptor_comp.residues):
+                    edited.index = original.index
+                    for edited_atom, original_atom in zip(edited.atoms, original.atoms):
+                        edited_atom.index = original_atom.index
+                next(edited_comp.atoms).index += 1
+                deep_comps[receptor_comp.index] = edited_comp
+                await menu.on_receptor_pressed(receptor_btn)
+                self.assertEqual(len(detected_mols), 3)
+                self.assertIs(self.plugin.complex_cache[0], edited_comp)
+
+                # Complexes that are no longer listed are forgotten
+                self.plugin.complex_list = [
+                    comp for comp in self.plugin.complex_list if comp.index != receptor_comp.index]
+                await menu.prefetch_ligands()
+                self.assertEqual(set(menu.ligand_cache), {self.ligand_comp.index})
+        run_awaitable(validate_cached_ligand_detection, self)
+
     def test_score_ligands(self):
         async def validate_score_ligands(self):
             self.plugin.complex_cache = [self.receptor_comp, self.ligand_comp]
@@ -117,7 +309,7 @@ class RealtimeScoringTestCase(unittest.TestCase):
         async def validate_score_ligands_one_complex(self):
             pdb_path = os.path.join(assets_dir, '5ceo.pdb')
             comp = structure.Complex.io.from_pdb(path=pdb_path)
-            self.generate_random_indices(comp)
+            generate_random_indices(comp)
 
             # Residues we will be using as a ligand
             ligand_residue_indices = [
@@ -148,6 +340,67 @@ class RealtimeScoringTestCase(unittest.TestCase):
             self.assertEqual(self.plugin.label_stream.update.call_count, 1)
         run_awaitable(validate_score_ligands_one_complex, self)
 
+    def test_incremental_scoring(self):
+        """Unchanged ligands are rescored in-process, without running DSX again."""
+        async def validate_incremental_scoring(self):
+            self.plugin.complex_cache = [self.receptor_comp, self.ligand_comp]
+            self.plugin.receptor_index = self.receptor_comp.index
+            self.plugin.ligand_residue_indices = [
+                res.index for res in self.ligand_comp.residues]
+            self.plugin.color_stream = MagicMock()
+            self.plugin.size_stream = MagicMock()
+            self.plugin.label_stream = MagicMock()
+            self.plugin.menu.update_ligand_scores = MagicMock()
+            self.plugin.incremental_scoring = True
+            run_dsx = scoring_algo.run_dsx
+            dsx_runs = []
+
+            async def counted_run_dsx(*args):
+                dsx_runs.append(args)
+                return await run_dsx(*args)
+            with unittest.mock.patch.object(scoring_algo, 'run_dsx', counted_run_dsx):
+                await self.plugin.score_ligands()
+                dsx_scores = self.plugin.menu.update_ligand_scores.call_args.args[0]
+                await self.plugin.score_ligands()
+                incremental_scores = self.plugin.menu.update_ligand_scores.call_args.args[0]
+            self.assertEqual(len(dsx_runs), 1)
+            self.assertEqual(self.plugin.color_stream.update.call_count, 2)
+            self.assertAlmostEqual(
+                dsx_scores[0][0]['total_score'], incremental_scores[0][0]['total_score'], delta=0.01)
+        run_awaitable(validate_incremental_scoring, self)
+
+    def test_score_ensemble(self):
+        """Ligands are scored against every receptor, and rendered with their best receptor."""
+        async def validate_score_ensemble(self):
+            second_receptor_comp = structure.Complex.io.from_pdb(path=self.receptor_pdb)
+            generate_random_indices(second_receptor_comp)
+            ensemble_indices = [self.receptor_comp.index, second_receptor_comp.index]
+            self.plugin.complex_cache = [self.receptor_comp, second_receptor_comp, self.ligand_comp]
+            self.plugin.receptor_index = self.receptor_comp.index
+            self.plugin.ensemble_indices = ensemble_indices
+            self.plugin.ligand_residue_indices = [
+                res.index for res in self.ligand_comp.residues]
+            self.plugin.color_stream = MagicMock()
+            self.plugin.size_stream = MagicMock()
+            self.plugin.label_stream = MagicMock()
+            self.plugin.update_content = MagicMock()
+            await self.plugin.score_ligands()
+            self.assertEqual(self.plugin.color_stream.update.call_count, 1)
+            summary = self.plugin.summarize_ensemble(
+                await self.plugin.calculate_ensemble_scores(
+                    self.plugin.receptor_comps, self.plugin.ligand_residues))[0]
+            receptor_scores = dict(summary['receptor_scores'])
+            self.assertEqual(list(receptor_scores), ensemble_indices)
+            # Both receptors are identical, so are their scores
+            total_scores = [scores['total_score'] for scores in receptor_scores.values()]
+            self.assertEqual(total_scores[0], total_scores[1])
+            self.assertEqual(summary['mean_scores']['total_score'], total_scores[0])
+            self.assertEqual(summary['best_scores']['total_score'], total_scores[0])
+            self.assertTrue(summary['atom_scores'])
+            # One row per receptor, plus best and mean rows
+            self.assertEqual(len(self.plugin.menu.ln_results.get_content().items), 4)
+        run_awaitable(validate_score_ensemble, self)
+
     def test_non_async_scoring_algo(self):
         """Ensure that a non-async function can be used as scoring algorithm."""
         def non_async_scoring_algo(receptor, ligand_comps):
@@ -182,12 +435,316 @@ class RealtimeScoringTestCase(unittest.TestCase):
             self.assertEqual(self.plugin.label_stream.update.call_count, 1)
         run_awaitable(validate_non_async_scoring_algo, self)
 
-    @staticmethod
-    def generate_random_indices(comp):
-        min_index = 1000000000
-        max_index = 9999999999
-        comp.index = randint(min_index, max_index)
-        for residue in comp.residues:
-            residue.index = randint(min_index, max_index)
-            for atom in residue.atoms:
-                atom.index = randint(min_index, max_index)
+    def test_async_generator_scoring_algo(self):
+        """Ensure results are rendered after each ligand yielded by an async generator."""
+        async def iter_scoring_algo(receptor, ligand_comps):
+            for comp in ligand_comps:
+                yield {
+                    'complex_index': comp.index,
+                    'aggregate_scores': [{'total_score': -1.0}],
+                    'atom_scores': [
+                        (atom.index, 1.0) for atom in comp.atoms
+                    ]
+                }
+
+        async def validate_async_generator_scoring_algo(self):
+            RealtimeScoring.scoring_algorithm = iter_scoring_algo
+            second_ligand_comp = structure.Complex.io.from_pdb(path=self.ligand_pdb)
+            generate_random_indices(second_ligand_comp)
+            self.plugin.complex_cache = [self.receptor_comp, self.ligand_comp, second_ligand_comp]
+            self.plugin.receptor_index = self.receptor_comp.index
+            self.plugin.ligand_residue_indices = [
+                res.index for res in itertools.chain(
+                    self.ligand_comp.residues, second_ligand_comp.residues)]
+            self.plugin.color_stream = MagicMock()
+            self.plugin.size_stream = MagicMock()
+            self.plugin.label_stream = MagicMock()
+            result_counts = []
+            self.plugin.menu.update_ligand_scores = MagicMock(
+                side_effect=lambda scores, *args: result_counts.append(len(scores)))
+            await self.plugin.score_ligands()
+            # Streams and results panel are updated once per ligand
+            self.assertEqual(self.plugin.color_stream.update.call_count, 2)
+            self.assertEqual(self.plugin.size_stream.update.call_count, 2)
+            self.assertEqual(result_counts, [1, 2])
+        run_awaitable(validate_async_generator_scoring_algo, self)
+
+    def test_prioritized_scoring(self):
+        """Large pose sets are scored progressively, moved poses first."""
+        scored_indices = []
+
+        async def iter_scoring_algo(receptor, ligand_comps):
+            for comp in ligand_comps:
+                pose_index = pose_indices[next(comp.residues).index]
+                scored_indices.append(pose_index)
+                yield {
+                    'complex_index': comp.index,
+                    'aggregate_scores': [{'total_score': -float(pose_index)}],
+                    'atom_scores': [(atom.index, 1.0) for atom in comp.atoms]
+                }
+
+        async def validate_prioritized_scoring(self):
+            RealtimeScoring.scoring_algorithm = iter_scoring_algo
+            self.plugin.prioritized_min_poses = 3
+            ligand_comps = []
+            for i in range(3):
+                comp = structure.Complex.io.from_pdb(path=self.ligand_pdb)
+                generate_random_indices(comp)
+                comp.index = i
+                comp.full_name = 'Pose {}'.format(i)
+                ligand_comps.append(comp)
+            pose_indices.update(
+                (res.index, comp.index) for comp in ligand_comps for res in comp.residues)
+            self.plugin.complex_cache = [self.receptor_comp] + ligand_comps
+            self.plugin.receptor_index = self.receptor_comp.index
+            self.plugin.ligand_residue_indices = [
+                res.index for comp in ligand_comps for res in comp.residues]
+            self.plugin.color_stream = MagicMock()
+            self.plugin.size_stream = MagicMock()
+            self.plugin.label_stream = MagicMock()
+            self.plugin.update_content = MagicMock()
+            # No time to refresh more than one pose per update
+            self.plugin.scheduler = PoseScheduler(budget_secs=0)
+            self.assertTrue(self.plugin.prioritizing_poses)
+
+            await self.plugin.score_ligands()
+            self.assertEqual(scored_indices, [0])
+            results = self.plugin.menu.ln_results.get_content().items
+            self.assertEqual(
+                [item._get_content().text_value for item in results],
+                ['Scored 1/3 poses', '#1 Pose 0 total_score: -0.0'])
+            # Moved poses are scored before poses that were never scored
+            self.plugin.scheduler.mark_moved([2])
+            await self.plugin.score_ligands()
+            self.assertEqual(scored_indices, [0, 2])
+            await self.plugin.score_ligands()
+            self.assertEqual(scored_indices, [0, 2, 1])
+            self.assertEqual(self.plugin.scheduler.pending, [])
+            ranking = [key for key, _ in self.plugin.scheduler.ranking()]
+            self.assertEqual(ranking, [2, 1, 0])
+            self.assertEqual(len(self.plugin.menu.ln_results.get_content().items), 3)
+            # Every pose is refreshed once the receptor moves, oldest first
+            self.plugin.scheduler.invalidate()
+            self.plugin.scheduler.budget_secs = 60
+            await self.plugin.score_ligands()
+            self.assertEqual(scored_indices[3:], [0, 2, 1])
+
+            # Scores are matched to poses by complex index, in whatever order they come back
+            async def reversed_scoring_algo(receptor, ligand_comps):
+                for comp in reversed(ligand_comps):
+                    yield {
+                        'complex_index': comp.index,
+                        'aggregate_scores': [{'total_score': -10.0 * comp.index}],
+                        'atom_scores': []
+                    }
+            RealtimeScoring.scoring_algorithm = reversed_scoring_algo
+            self.plugin.scheduler.invalidate()
+            await self.plugin.score_ligands()
+            results = self.plugin.scheduler.results
+            self.assertEqual(
+                {key: results[key]['aggregate_scores'][0]['total_score'] for key in results},
+                {0: -0.0, 1: -10.0, 2: -20.0})
+        pose_indices = {}
+        run_awaitable(validate_prioritized_scoring, self)
+
+    def test_aggregate_only_scoring(self):
+        """Only the ranked poses are scored in detail when scoring aggregate scores only."""
+        scored = []
+
+        async def iter_scoring_algo(receptor, ligand_comps, aggregate_only=False):
+            for comp in ligand_comps:
+                pose_index = pose_indices[next(comp.residues).index]
+                scored.append((pose_index, aggregate_only))
+                yield {
+                    'complex_index': comp.index,
+                    'aggregate_scores': [{'total_score': -float(pose_index)}],
+                    'atom_scores': [] if aggregate_only else [(atom.index, 1.0) for atom in comp.atoms]
+                }
+
+        async def validate_aggregate_only_scoring(self):
+            RealtimeScoring.scoring_algorithm = iter_scoring_algo
+            self.plugin.prioritized_min_poses = 3
+            self.plugin.ranking_size = 1
+            ligand_comps = []
+            for i in range(3):
+                comp = structure.Complex.io.from_pdb(path=self.ligand_pdb)
+                generate_random_indices(comp)
+                comp.index = i
+                ligand_comps.append(comp)
+            pose_indices.update(
+                (res.index, comp.index) for comp in ligand_comps for res in comp.residues)
+            self.plugin.complex_cache = [self.receptor_comp] + ligand_comps
+            self.plugin.receptor_index = self.receptor_comp.index
+            self.plugin.ligand_residue_indices = [
+                res.index for comp in ligand_comps for res in comp.residues]
+            self.plugin.color_stream = MagicMock()
+            self.plugin.size_stream = MagicMock()
+            self.plugin.label_stream = MagicMock()
+            self.plugin.update_content = MagicMock()
+            self.plugin.scheduler = PoseScheduler(budget_secs=60)
+            self.plugin.settings.aggregate_only = True
+
+            await self.plugin.score_ligands()
+            # The best pose is scored again in detail
+            self.assertEqual(scored, [(0, True), (1, True), (2, True), (2, False)])
+            results = self.plugin.scheduler.results
+            self.assertEqual([bool(results[key]['atom_scores']) for key in range(3)], [False, False, True])
+            self.assertEqual(self.plugin.scheduler.missing_detail(), [1, 0])
+            # Every pose is rescored in detail once the mode is switched off
+            btn = self.plugin.settings._btn_aggregate_only
+            btn.selected = False
+            self.plugin.settings.on_aggregate_only_pressed(btn)
+            await self.plugin.score_ligands()
+            self.assertEqual(scored[4:], [(0, False), (1, False), (2, False)])
+            self.assertEqual(self.plugin.scheduler.missing_detail(), [])
+            # Ligands that aren't scored progressively are always scored in detail
+            self.plugin.prioritized_min_poses = 4
+            self.plugin.settings.aggregate_only = True
+            self.plugin.menu.update_ligand_scores = MagicMock()
+            await self.plugin.score_ligands()
+            self.assertEqual(scored[7:], [(0, False), (1, False), (2, False)])
+        pose_indices = {}
+        run_awaitable(validate_aggregate_only_scoring, self)
+
+    def test_scoring_workers(self):
+        """Scoring workers only replace the scoring algorithm of the session that configured them."""
+        self.plugin._custom_data = [{'scoring_workers': ['localhost:9030'], 'incremental_scoring': True}]
+        with unittest.mock.patch('nanome.util.Logs.warning') as warning:
+            self.plugin.start()
+        warning.assert_called_once()
+        dispatcher = self.plugin.dispatcher
+        self.assertEqual(self.plugin.session_scoring_algorithm, dispatcher.score_ligands)
+        self.assertEqual(self.plugin.session_ensemble_scoring_algorithm, dispatcher.score_ensemble)
+        self.assertEqual(RealtimeScoring.scoring_algorithm, scoring_algo.score_ligands)
+        self.assertEqual(
+            self.plugin.supported_options({'incremental': True, 'aggregate_only': True}, dispatcher.score_ligands),
+            {'aggregate_only': True})
+        dispatcher.close = unittest.mock.AsyncMock()
+
+        async def stop():
+            self.plugin.on_stop()
+            await asyncio.sleep(0)
+        run_awaitable(stop)
+        dispatcher.close.assert_awaited_once()
+
+    def test_refine_poses(self):
+        """Ligand complexes are moved to the refined pose, ligands of the receptor are skipped."""
+        transform = np.eye(4)
+        transform[:3, 3] = [0.5, 0, 0]
+        refined_ligands = []
+        budgets = []
+        # Refining spends the whole budget
+        clock = [0.0]
+
+        def refine_algorithm(receptor, ligand_comp, budget_secs):
+            refined_ligands.append(ligand_comp)
+            budgets.append(budget_secs)
+            clock[0] += budget_secs
+            return {'transform': transform, 'initial_score': -10.0, 'score': -12.0, 'trials': 256}
+
+        async def validate_refine_poses(self):
+            RealtimeScoring.refine_algorithm = refine_algorithm
+            ligand_comp = structure.Complex.io.from_pdb(path=self.ligand_pdb)
+            generate_random_indices(ligand_comp)
+            ligand_comp.position = Vector3(1, 2, 3)
+            self.plugin.complex_cache = [self.receptor_comp, ligand_comp]
+            self.plugin.receptor_index = self.receptor_comp.index
+            self.plugin.ensemble_indices = [self.receptor_comp.index]
+            receptor_ligand_residue = next(self.receptor_comp.residues)
+            self.plugin.ligand_residue_indices = [receptor_ligand_residue.index] + [
+                res.index for res in ligand_comp.residues]
+            self.plugin.update_structures_shallow = MagicMock()
+            await self.plugin.refine_poses()
+            self.assertEqual(len(refined_ligands), 1)
+            moved_comp, = self.plugin.update_structures_shallow.call_args.args[0]
+            self.assertEqual(moved_comp.index, ligand_comp.index)
+            self.assertEqual(moved_comp.full_name, ligand_comp.full_name)
+            for value, expected in zip(moved_comp.position.unpack(), (1.5, 2, 3)):
+                self.assertAlmostEqual(value, expected, places=6)
+            # Cached complex still has the old pose, so the move is picked up by update()
+            self.assertEqual(ligand_comp.position.unpack(), (1, 2, 3))
+
+            # Complexes share the budget, and each is moved once refined
+            ligand_comps = [ligand_comp]
+            for _ in range(3):
+                comp = structure.Complex.io.from_pdb(path=self.ligand_pdb)
+                generate_random_indices(comp)
+                ligand_comps.append(comp)
+            self.plugin.complex_cache = [self.receptor_comp] + ligand_comps
+            self.plugin.ligand_residue_indices = [res.index for comp in ligand_comps for res in comp.residues]
+            self.plugin.update_structures_shallow.reset_mock()
+            budgets.clear()
+            with unittest.mock.patch('time.perf_counter', lambda: clock[0]):
+                await self.plugin.refine_poses()
+            budget_secs = self.plugin.refine_budget.total_seconds()
+            self.assertEqual(budgets, [budget_secs / 4] * 4)
+            self.assertEqual(self.plugin.update_structures_shallow.call_count, 4)
+            # Complexes left once the budget is spent aren't refined
+            self.plugin.refine_budget = timedelta(0)
+            budgets.clear()
+            await self.plugin.refine_poses()
+            self.assertEqual(budgets, [])
+        run_awaitable(validate_refine_poses, self)
+
+    def test_profile_cycles(self):
+        """Scoring cycles are profiled, including the time spent in child processes."""
+        async def validate_profile_cycles(self):
+            self.plugin.complex_cache = [self.receptor_comp, self.ligand_comp]
+            self.plugin.receptor_index = self.receptor_comp.index
+            self.plugin.ligand_residue_indices = [
+                res.index for res in self.ligand_comp.residues]
+            self.plugin.color_stream = MagicMock()
+            self.plugin.size_stream = MagicMock()
+            self.plugin.label_stream = MagicMock()
+            self.plugin.update_content = MagicMock()
+            self.plugin.settings.profiling = True
+            self.plugin.start_profiling(2)
+            profiler = self.plugin.profiler
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                profiler.path = os.path.join(tmp_dir, 'capture.pstats')
+                await self.plugin.score_ligands()
+                self.assertFalse(profiler.finished)
+                await self.plugin.score_ligands()
+                self.assertTrue(profiler.finished)
+                stats = pstats.Stats(profiler.path)
+            self.assertEqual(stats.stats[('~child-process', 0, 'DSX')][0], 2)
+            self.assertTrue(any(name == 'score_ligands' for _, _, name in stats.stats))
+            # The process hook is removed once the capture is finished
+            self.assertEqual(scoring_algo._process_hooks.get(), ())
+            self.assertFalse(self.plugin.settings.profiling)
+            # Later cycles aren't profiled
+            await self.plugin.score_ligands()
+            self.assertEqual(profiler.cycles, 2)
+        run_awaitable(validate_profile_cycles, self)
+
+    def test_set_atoms_to_workspace_positions(self):
+        comp = structure.Complex.io.from_pdb(path=self.ligand_pdb)
+        comp.position = Vector3(1.5, -2.0, 3.25)
+        comp.rotation = Quaternion(0.2, 0.4, 0.1, 0.888)
+        mat = comp.get_complex_to_workspace_matrix()
+        expected_positions = [(mat * atom.position).unpack() for atom in comp.atoms]
+        RealtimeScoring.set_atoms_to_workspace_positions([comp])
+        for atom, expected in zip(comp.atoms, expected_positions):
+            for value, expected_value in zip(atom.position.unpack(), expected):
+                self.assertAlmostEqual(value, expected_value, places=4)
+
+    def test_session_recorder(self):
+        """Recorded sessions store each structure once, and every response received."""
+        receptor_comp = structure.Complex.io.from_pdb(path=self.receptor_pdb)
+        ligand_comp = structure.Complex.io.from_pdb(path=self.ligand_pdb)
+        generate_random_indices(receptor_comp)
+        generate_random_indices(ligand_comp)
+        recorder = SessionRecorder(self.plugin, 'session.trace.gz')
+        times = iter([0.0, 0.0, 0.3])
+        recorder.clock = lambda: next(times)
+        recorder.start_time = 0.0
+        recorder.record_selection(receptor_comp.index, [res.index for res in ligand_comp.residues])
+        recorder.record_complexes([receptor_comp, ligand_comp])
+        ligand_comp.position = Vector3(0.2, 0, 0)
+        recorder.record_complexes([receptor_comp, ligand_comp])
+        # Moving a complex doesn't store its structure again
+        self.assertEqual(len(recorder.structures), 2)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace = load_trace(recorder.save(os.path.join(tmp_dir, 'session.trace.gz')))
+        self.assertEqual(len(trace['structures']), 2)
+        self.assertEqual([event['type'] for event in trace['events']], ['select', 'complexes', 'complexes'])
@@ -0,0 +1,25 @@
+import asyncio
+import os
+from random import randint
+
+
+assets_dir = os.path.join(os.path.dirname(__file__), 'assets')
+
+
+def run_awaitable(awaitable, *args, **kwargs):
+    """Run a coroutine function to completion on a new event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(awaitable(*args, **kwargs))
+    finally:
+        loop.close()
+
+
+def generate_random_indices(comp):
+    min_index = 1000000000
+    max_index = 9999999999
+    comp.index = randint(min_index, max_index)
+    for residue in comp.residues:
+        residue.index = randint(min_index, max_index)
+        for atom in residue.atoms:
+            atom.index = randint(min_index, max_index)